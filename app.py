@@ -1,32 +1,250 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from flask_migrate import Migrate
+from flask_migrate import Migrate, stamp, upgrade
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import os
-from datetime import datetime
+import json
+import click
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from models import DermatologyAssistant
+from src.jobs import JobQueue, QueueFull
+from src.inference_server import InferenceServer, InferenceClient
+from src.classification_cache import content_hash
+from src.pagination import keyset_page, page_headers, parse_limit
+from src.sqlite_tuning import on_connect
+from src.deadline import Deadline
+from src.metrics import REGISTRY, span, start_request_timings, end_request_timings, request_timings
 import sqlite3
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///dermatology_assistant.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///dermatology_assistant.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Schema: migrations/ is applied on start (flask db upgrade).
+# DB_RESET_ON_START=1 restores the old drop-everything-on-start development behaviour.
+app.config['DB_RESET_ON_START'] = os.environ.get('DB_RESET_ON_START', '0') == '1'
+# WAL + tuned pragmas on every SQLite connection (see src/sqlite_tuning.py)
+app.config['SQLITE_TUNING'] = os.environ.get('SQLITE_TUNING', '1') == '1'
+# Classifier micro-batching: concurrent uploads wait up to N ms to share a forward pass
+app.config['CLASSIFIER_MAX_BATCH'] = int(os.environ.get('CLASSIFIER_MAX_BATCH', 8))
+app.config['CLASSIFIER_BATCH_WAIT_MS'] = float(os.environ.get('CLASSIFIER_BATCH_WAIT_MS', 10))
+# Classifier backend: eager | torchscript | onnx (see src/export_classifier.py)
+app.config['CLASSIFIER_BACKEND'] = os.environ.get('CLASSIFIER_BACKEND', 'eager')
+app.config['CLASSIFIER_ARTIFACT'] = os.environ.get('CLASSIFIER_ARTIFACT')
+app.config['CLASSIFIER_THREADS'] = int(os.environ.get('CLASSIFIER_THREADS', 0)) or None
+# Persistent (image hash, model version) -> top-k classification cache
+app.config['CLASSIFICATION_CACHE_PATH'] = os.environ.get(
+    'CLASSIFICATION_CACHE_PATH', os.path.join(app.instance_path, 'classification_cache.db'))
+app.config['CLASSIFICATION_CACHE_SIZE'] = int(os.environ.get('CLASSIFICATION_CACHE_SIZE', 10000))
+# Number of classifier top-k diseases whose Q/A pairs are searched for a new upload
+app.config['RAG_CLASSIFIER_TOPK'] = int(os.environ.get('RAG_CLASSIFIER_TOPK', 1))
+# Q/A search: exact | ann (IVF, for knowledge bases with tens of thousands of pairs)
+app.config['RAG_SEARCH_MODE'] = os.environ.get('RAG_SEARCH_MODE', 'exact')
+# Retrieval: dense (encoder only) | hybrid (BM25 shortlist re-ranked densely) | bm25 (no encoder).
+# RAG_LEXICAL_WEIGHT is BM25's share of the fused score (RAG_FUSION: linear | rrf)
+app.config['RAG_RETRIEVAL_MODE'] = os.environ.get('RAG_RETRIEVAL_MODE', 'dense')
+app.config['RAG_SHORTLIST'] = int(os.environ.get('RAG_SHORTLIST', 64))
+app.config['RAG_LEXICAL_WEIGHT'] = float(os.environ.get('RAG_LEXICAL_WEIGHT', 0.3))
+app.config['RAG_FUSION'] = os.environ.get('RAG_FUSION', 'linear')
+# Question encoder: optional ONNX int8 export (src/query_encoder.py), token limit, LRU of embeddings
+app.config['RAG_QUERY_ENCODER'] = os.environ.get('RAG_QUERY_ENCODER')
+app.config['RAG_MAX_SEQ_LENGTH'] = int(os.environ.get('RAG_MAX_SEQ_LENGTH', 0)) or None
+app.config['RAG_QUERY_CACHE_SIZE'] = int(os.environ.get('RAG_QUERY_CACHE_SIZE', 256))
+# Per-chat retrieval sessions: follow-ups re-rank the chat's cached candidates
+app.config['RAG_SESSION_CACHE_SIZE'] = int(os.environ.get('RAG_SESSION_CACHE_SIZE', 1024))
+app.config['RAG_SESSION_TTL'] = float(os.environ.get('RAG_SESSION_TTL', 3600))
+app.config['RAG_FOLLOWUP_REFORMULATE'] = os.environ.get('RAG_FOLLOWUP_REFORMULATE', '0') == '1'
+app.config['RAG_SESSION_CARRY'] = float(os.environ.get('RAG_SESSION_CARRY', 0))
+# Multi-turn answers: every text message not yet in the chat's rolling summary is loaded, the
+# newest that fit the token budget are sent verbatim and the rest are folded into the summary.
+# CHAT_HISTORY_MESSAGES only caps the rows loaded per turn (0 disables history)
+app.config['CHAT_HISTORY_MESSAGES'] = int(os.environ.get('CHAT_HISTORY_MESSAGES', 200))
+app.config['CHAT_HISTORY_TOKENS'] = int(os.environ.get('CHAT_HISTORY_TOKENS', 1024))
+# Model startup: eager (parallel, blocking) | background (parallel, non-blocking) | lazy (on first use)
+app.config['MODEL_LOAD_MODE'] = os.environ.get('MODEL_LOAD_MODE', 'eager')
+app.config['WARMUP_MODELS'] = os.environ.get('WARMUP_MODELS', '0') == '1'
+# Async message mode: /api/message returns a job id and a bounded worker pool does the work
+app.config['ASYNC_MESSAGES'] = os.environ.get('ASYNC_MESSAGES', '0') == '1'
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+# Ollama client: at most N concurrent generations, the rest wait up to OLLAMA_QUEUE_TIMEOUT seconds
+app.config['OLLAMA_HOST'] = os.environ.get('OLLAMA_HOST')
+app.config['OLLAMA_MAX_IN_FLIGHT'] = int(os.environ.get('OLLAMA_MAX_IN_FLIGHT', 2))
+app.config['OLLAMA_QUEUE_TIMEOUT'] = float(os.environ.get('OLLAMA_QUEUE_TIMEOUT', 30))
+app.config['OLLAMA_RETRIES'] = int(os.environ.get('OLLAMA_RETRIES', 2))
+app.config['OLLAMA_KEEP_ALIVE'] = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')
+# Latency budget per chat turn (seconds, 0 = none): reformulation is skipped and the answer
+# shortened to fit, and a turn that still runs out gets a "try again" reply (see src/deadline.py)
+app.config['REQUEST_DEADLINE'] = float(os.environ.get('REQUEST_DEADLINE', 90))
+# Shared inference server: with a socket path set, web workers call one model process
+# (`flask --app app inference-server`) instead of each loading the models
+app.config['INFERENCE_SOCKET'] = os.environ.get('INFERENCE_SOCKET')
+app.config['INFERENCE_AUTHKEY'] = os.environ.get('INFERENCE_AUTHKEY', '').encode() or None
+app.config['INFERENCE_POOL_SIZE'] = int(os.environ.get('INFERENCE_POOL_SIZE', 8))
+# Load testing only: random-weight classifier + hashing encoder instead of the real models,
+# with OLLAMA_HOST pointed at a fake Ollama (see src/standins.py and src/loadtest.py)
+app.config['MODEL_STANDINS'] = os.environ.get('MODEL_STANDINS', '0') == '1'
+app.config['STANDIN_QA_JSON'] = os.environ.get('STANDIN_QA_JSON', 'dataset/dermatology_qa.json')
+app.config['STANDIN_INDEX_DIR'] = os.environ.get(
+    'STANDIN_INDEX_DIR', os.path.join(app.instance_path, 'standin_qa_index'))
+app.config['STANDIN_FORWARD_MS'] = float(os.environ.get('STANDIN_FORWARD_MS', 0))
+app.config['STANDIN_ENCODE_MS'] = float(os.environ.get('STANDIN_ENCODE_MS', 0))
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+if app.config['SQLITE_TUNING']:
+    event.listen(Engine, 'connect', on_connect)
+
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Initialize the assistant
-dermatology_assistant = DermatologyAssistant()
+def create_assistant():
+    loaders = None
+    if app.config['MODEL_STANDINS']:
+        from src.standins import standin_loaders
+        loaders = standin_loaders(
+            app.config['STANDIN_QA_JSON'],
+            app.config['STANDIN_INDEX_DIR'],
+            forward_ms=app.config['STANDIN_FORWARD_MS'],
+            encode_ms=app.config['STANDIN_ENCODE_MS'],
+        )
+    return DermatologyAssistant(
+        batch_max_size=app.config['CLASSIFIER_MAX_BATCH'],
+        batch_max_wait_ms=app.config['CLASSIFIER_BATCH_WAIT_MS'],
+        classifier_opts={
+            'backend': app.config['CLASSIFIER_BACKEND'],
+            'artifact_path': app.config['CLASSIFIER_ARTIFACT'],
+            'num_threads': app.config['CLASSIFIER_THREADS'],
+            'channels_last': app.config['CLASSIFIER_BACKEND'] != 'onnx',
+        },
+        rag_opts={
+            'search_mode': app.config['RAG_SEARCH_MODE'],
+            'retrieval_mode': app.config['RAG_RETRIEVAL_MODE'],
+            'shortlist': app.config['RAG_SHORTLIST'],
+            'lexical_weight': app.config['RAG_LEXICAL_WEIGHT'],
+            'fusion': app.config['RAG_FUSION'],
+            'query_encoder': app.config['RAG_QUERY_ENCODER'],
+            'max_seq_length': app.config['RAG_MAX_SEQ_LENGTH'],
+            'query_cache_size': app.config['RAG_QUERY_CACHE_SIZE'],
+        },
+        llm_opts={
+            **({'host': app.config['OLLAMA_HOST']} if app.config['OLLAMA_HOST'] else {}),
+            'max_in_flight': app.config['OLLAMA_MAX_IN_FLIGHT'],
+            'queue_timeout': app.config['OLLAMA_QUEUE_TIMEOUT'],
+            'retries': app.config['OLLAMA_RETRIES'],
+            'keep_alive': app.config['OLLAMA_KEEP_ALIVE'],
+        },
+        load_mode=app.config['MODEL_LOAD_MODE'],
+        warmup=app.config['WARMUP_MODELS'],
+        cache_path=app.config['CLASSIFICATION_CACHE_PATH'] or None,
+        cache_max_entries=app.config['CLASSIFICATION_CACHE_SIZE'],
+        session_cache_size=app.config['RAG_SESSION_CACHE_SIZE'],
+        session_ttl=app.config['RAG_SESSION_TTL'],
+        followup_reformulate=app.config['RAG_FOLLOWUP_REFORMULATE'],
+        session_carry=app.config['RAG_SESSION_CARRY'],
+        history_tokens=app.config['CHAT_HISTORY_TOKENS'],
+        loaders=loaders,
+    )
+
+# Initialize the assistant (or a client for the shared inference server)
+if app.config['INFERENCE_SOCKET']:
+    dermatology_assistant = InferenceClient(
+        app.config['INFERENCE_SOCKET'],
+        authkey=app.config['INFERENCE_AUTHKEY'],
+        pool_size=app.config['INFERENCE_POOL_SIZE'],
+    )
+else:
+    dermatology_assistant = create_assistant()
+
+@app.cli.command('inference-server')
+@click.option('--socket', 'socket_path', default=None, help='Unix socket path (default: INFERENCE_SOCKET)')
+def inference_server(socket_path):
+    """Load the models once and serve them to web workers over a Unix socket."""
+    socket_path = socket_path or app.config['INFERENCE_SOCKET']
+    if not socket_path:
+        raise click.UsageError('set INFERENCE_SOCKET or pass --socket')
+    assistant = dermatology_assistant if isinstance(dermatology_assistant, DermatologyAssistant) else create_assistant()
+    InferenceServer(assistant, socket_path, authkey=app.config['INFERENCE_AUTHKEY']).serve_forever()
+
+# Uploads are classified from memory and written to disk in the background
+upload_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='upload-writer')
+pending_uploads = {}
+pending_uploads_lock = threading.Lock()
+
+# Bounded in-process queue for async message turns
+message_jobs = JobQueue(
+    num_workers=app.config['JOB_WORKERS'],
+    max_queue=app.config['JOB_QUEUE_SIZE'],
+    name='messages',
+)
+
+def _gauge_values(stats, fields):
+    if not stats:
+        return None
+    return {(f,): stats.get(f) for f in fields}
+
+REGISTRY.gauge_callback(
+    'derm_classifier_batching', 'Classifier micro-batching counters and averages.',
+    lambda: _gauge_values(dermatology_assistant.batching_stats(), ('batches', 'items', 'errors', 'queue_depth', 'avg_batch_size')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_classifier_queue_delay_p95_seconds', 'p95 queueing delay before a classifier batch runs.',
+    lambda: ((dermatology_assistant.batching_stats() or {}).get('queue_delay_ms', {}).get('p95') or 0) / 1000.0,
+)
+REGISTRY.gauge_callback(
+    'derm_classification_cache', 'Classification cache counters.',
+    lambda: _gauge_values(dermatology_assistant.cache_stats(), ('entries', 'hits', 'misses', 'evictions', 'hit_rate')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_llm_cache', 'LLM completion cache counters.',
+    lambda: _gauge_values(dermatology_assistant.llm_cache_stats(), ('entries', 'hits', 'misses', 'coalesced', 'evictions', 'hit_rate')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_llm_pool', 'Ollama client slots in use, waiters and retry/reject counters.',
+    lambda: _gauge_values(dermatology_assistant.llm_pool_stats(), ('max_in_flight', 'in_flight', 'waiting', 'requests', 'retries', 'rejected', 'errors')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_rag_sessions', 'Per-chat retrieval session cache counters.',
+    lambda: _gauge_values(dermatology_assistant.session_stats(), ('entries', 'hits', 'misses', 'evictions', 'expired', 'hit_rate')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_conversation_summaries', 'Per-chat rolling conversation summary cache counters.',
+    lambda: _gauge_values(dermatology_assistant.conversation_stats(), ('entries', 'hits', 'misses', 'evictions', 'expired', 'hit_rate')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_query_embedding_cache', 'Query embedding cache counters.',
+    lambda: _gauge_values(dermatology_assistant.query_cache_stats(), ('entries', 'hits', 'misses', 'evictions', 'hit_rate')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_message_jobs', 'Async message job queue state.',
+    lambda: _gauge_values(message_jobs.stats(), ('queue_depth', 'queue_capacity', 'running', 'submitted', 'rejected', 'done', 'failed')),
+    labelnames=('field',),
+)
+REGISTRY.gauge_callback(
+    'derm_model_ready', '1 when a model component is loaded.',
+    lambda: {(name,): int(st['state'] == 'ready') for name, st in dermatology_assistant.status()['components'].items()},
+    labelnames=('component',),
+)
 
 # Database Models
 class User(UserMixin, db.Model):
@@ -49,6 +267,11 @@ class Chat(db.Model):
     messages = db.relationship('Message', backref='chat', lazy=True)
     image_path = db.Column(db.String(255), nullable=True)
     classification_result = db.Column(db.String(255), nullable=True)
+    # JSON list of the diseases searched for the upload (classifier top-k), reused by follow-ups
+    rag_classes = db.Column(db.Text, nullable=True)
+
+    # keyset pagination of a user's chats walks this index
+    __table_args__ = (db.Index('ix_chat_user_created', 'user_id', 'created_at', 'id'),)
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -57,11 +280,25 @@ class Message(db.Model):
     is_user = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # keyset pagination / `since` polling of a chat's messages walks this index
+    __table_args__ = (db.Index('ix_message_chat_created', 'chat_id', 'created_at', 'id'),)
+
+# first revision in migrations/versions: the schema the app created before it had migrations
+BASELINE_REVISION = '4b1d0c2a9e71'
+
 def init_db():
     with app.app_context():
-        # Drop all tables and recreate them
-        db.drop_all()
-        db.create_all()
+        if app.config['DB_RESET_ON_START']:
+            # Development only: drop all tables and recreate them
+            db.drop_all()
+            db.create_all()
+            stamp(directory=migrate.directory, revision='head')
+        else:
+            tables = inspect(db.engine).get_table_names()
+            if 'user' in tables and 'alembic_version' not in tables:
+                # created by db.create_all() before migrations existed: adopt it at the baseline
+                stamp(directory=migrate.directory, revision=BASELINE_REVISION)
+            upgrade(directory=migrate.directory)
         print("Database initialized successfully")
 
 # Initialize the database
@@ -123,12 +360,35 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
+def page_args():
+    """limit / before / after / since query parameters of the paginated history endpoints."""
+    since = request.args.get('since')
+    if since:
+        since = datetime.fromisoformat(since.replace('Z', '+00:00'))
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)    # stored as naive UTC
+    return {
+        'limit': parse_limit(request.args.get('limit')),
+        'before': request.args.get('before'),
+        'after': request.args.get('after'),
+        'since': since or None,
+    }
+
 @app.route('/chat')
 @login_required
 def chat():
     chat_id = request.args.get('chat_id')
-    chats = Chat.query.filter_by(user_id=current_user.id).order_by(Chat.created_at.desc()).all()
-    return render_template('chat.html', chats=chats, current_chat_id=int(chat_id) if chat_id else None)
+    try:
+        args = page_args()
+    except ValueError as e:
+        return str(e), 400
+    chats, has_more = keyset_page(Chat.query.filter_by(user_id=current_user.id), Chat, **args)
+    return render_template(
+        'chat.html',
+        chats=chats,
+        current_chat_id=int(chat_id) if chat_id else None,
+        chats_cursor=page_headers(chats, has_more).get('X-Before-Cursor') if has_more else None,
+    )
 
 @app.route('/api/chats')
 @login_required
@@ -137,13 +397,21 @@ def get_chats():
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        chats = db.session.query(Chat).filter_by(user_id=current_user.id).order_by(Chat.created_at.desc()).all()
+        args = page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        # newest first; page with ?before=<X-Before-Cursor>, poll with ?after=<X-After-Cursor>
+        chats, has_more = keyset_page(
+            db.session.query(Chat).filter_by(user_id=current_user.id), Chat, **args
+        )
         return jsonify([{
             'id': chat.id,
             'title': chat.classification_result or 'New Chat',
             'created_at': chat.created_at.isoformat(),
             'image_path': chat.image_path
-        } for chat in chats])
+        } for chat in chats]), 200, page_headers(chats, has_more)
     except Exception as e:
         print(f"Error in get_chats: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -159,13 +427,21 @@ def get_messages(chat_id):
         if not chat or chat.user_id != current_user.id:
             return jsonify({'error': 'Chat not found'}), 404
         
-        messages = db.session.query(Message).filter_by(chat_id=chat_id).order_by(Message.created_at.asc()).all()
+        try:
+            args = page_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # oldest first within the page; with `limit` the default page is the latest `limit` messages
+        messages, has_more = keyset_page(
+            db.session.query(Message).filter_by(chat_id=chat_id), Message, newest_first=False, **args
+        )
         return jsonify([{
             'id': message.id,
             'content': message.content,
             'is_user': message.is_user,
             'created_at': message.created_at.isoformat()
-        } for message in messages])
+        } for message in messages]), 200, page_headers(messages, has_more)
     except Exception as e:
         print(f"Error in get_messages: {str(e)}")
         return jsonify({'error': str(e)}), 500
@@ -185,6 +461,230 @@ def create_chat():
         print(f"Error in create_chat: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def commit_session():
+    with span("db.commit"):
+        db.session.commit()
+
+def write_upload(path, data):
+    # write to a temp name first so /uploads never serves a partial file
+    tmp_path = f"{path}.{threading.get_ident()}.part"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def upload_filename(original_name, image_hash):
+    """Uploads are stored by content hash, so a re-uploaded photo maps to the same file."""
+    ext = os.path.splitext(secure_filename(original_name))[1].lower() or '.img'
+    return f"{image_hash}{ext}"
+
+def store_upload(filename, data):
+    """Write an upload to disk off the request's critical path (skipped if already stored)."""
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    with pending_uploads_lock:
+        future = pending_uploads.get(filename)
+        if future is not None:
+            return future
+        if os.path.exists(path):
+            return None
+        future = upload_writer.submit(write_upload, path, data)
+        pending_uploads[filename] = future
+    future.add_done_callback(lambda _: _forget_pending_upload(filename, future))
+    return future
+
+def _forget_pending_upload(filename, future):
+    with pending_uploads_lock:
+        if pending_uploads.get(filename) is future:
+            del pending_uploads[filename]
+
+def wait_for_upload(filename, timeout=10):
+    with pending_uploads_lock:
+        future = pending_uploads.get(filename)
+    if future is not None:
+        future.result(timeout=timeout)
+
+def discard_upload(filename):
+    # content-addressed files can be shared by several chats
+    if Chat.query.filter(Chat.image_path == filename).count() > 0:
+        return
+    wait_for_upload(filename)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(path):
+        os.remove(path)
+
+def save_user_turn(chat, message, image):
+    """
+    Take a first upload into memory and stage the user's messages for `chat`.
+    The file is written to disk in the background; classification works on
+    the in-memory bytes. Returns (image_bytes, image_hash, text_message);
+    the first two are None unless a new image was uploaded, text_message is
+    None without text.
+    """
+    image_bytes = None
+    image_hash = None
+    text_message = None
+    
+    # Check if chat already has an image
+    has_image = bool(chat.image_path)
+    
+    # Take image if provided and chat doesn't have one
+    if image and image.filename and not has_image:
+        with span("upload.read"):
+            image_bytes = image.read()
+            image_hash = content_hash(image_bytes)
+        filename = upload_filename(image.filename, image_hash)
+        with span("upload.store"):
+            store_upload(filename, image_bytes)
+        chat.image_path = filename
+        
+        # Create image message (timestamps are set here so they are known before the turn is committed)
+        image_message = Message(
+            chat_id=chat.id,
+            content=f'<img src="/uploads/{filename}" alt="Uploaded image">',
+            is_user=True,
+            created_at=datetime.utcnow()
+        )
+        db.session.add(image_message)
+    
+    # Create text message if there is one
+    if message:
+        text_message = Message(
+            chat_id=chat.id,
+            content=message,
+            is_user=True,
+            created_at=datetime.utcnow()
+        )
+        db.session.add(text_message)
+    
+    return image_bytes, image_hash, text_message
+
+def load_history(chat):
+    """
+    The chat's text messages after those already folded into its conversation
+    summary, oldest first, as {'id', 'role', 'content'}. Which of them are sent
+    verbatim is decided by the token budget (src/conversation.py).
+    Call it before staging the current turn; image messages are left out.
+    """
+    limit = app.config['CHAT_HISTORY_MESSAGES']
+    if not limit:
+        return []
+    upto = dermatology_assistant.summarized_upto(chat.id)
+    with span("db.history"):
+        query = Message.query.filter_by(chat_id=chat.id)
+        if upto is not None:
+            query = query.filter(Message.id > upto)
+        rows = (query
+                .order_by(Message.created_at.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+    return [{
+        'id': m.id,
+        'role': 'user' if m.is_user else 'assistant',
+        'content': m.content
+    } for m in reversed(rows) if not m.content.startswith('<img ')]
+
+def classify_and_retrieve(chat, image, image_hash=None, deadline=None):
+    """Classify a new upload (in-memory bytes) and fetch its RAG context."""
+    # Classify image
+    result, topk = dermatology_assistant.classify(image, image_hash=image_hash)
+    
+    # Update chat with classification (committed with the rest of the turn)
+    chat.classification_result = result
+    
+    # Get RAG context, optionally searching the classifier's top-k diseases
+    classes = [c for c, _ in topk[:app.config['RAG_CLASSIFIER_TOPK']]] or None
+    chat.rag_classes = json.dumps(classes) if classes else None
+    return dermatology_assistant.get_rag_context(
+        result, result, classes=classes, chat_id=chat.id, deadline=deadline)
+
+def rag_classes(chat):
+    """Diseases the chat's upload searched, so an evicted retrieval session is rebuilt over the same set."""
+    return json.loads(chat.rag_classes) if chat.rag_classes else None
+
+def process_user_turn(chat, message, image, deadline=None):
+    """
+    Save/classify a first upload and stage the user's messages for `chat`.
+    Returns (rag_context, text_message); text_message is None without text.
+    """
+    image_bytes, image_hash, text_message = save_user_turn(chat, message, image)
+    rag_context = classify_and_retrieve(chat, image_bytes, image_hash, deadline) if image_bytes else None
+    return rag_context, text_message
+
+def run_message_job(chat_id, message, image_bytes, image_hash=None, history=None):
+    """Background half of an async /api/message turn: classify, retrieve, generate, persist."""
+    with app.app_context():
+        deadline = Deadline.start(app.config['REQUEST_DEADLINE'])
+        try:
+            chat = db.session.get(Chat, chat_id)
+            rag_context = classify_and_retrieve(chat, image_bytes, image_hash, deadline) if image_bytes else None
+            
+            assistant_response = dermatology_assistant.generate_response(
+                image_class=chat.classification_result,
+                user_message=message,
+                rag_context=rag_context,
+                chat_id=chat.id,
+                deadline=deadline,
+                history=history,
+                classes=rag_classes(chat)
+            )
+            
+            assistant_message = Message(
+                chat_id=chat.id,
+                content=assistant_response,
+                is_user=False
+            )
+            db.session.add(assistant_message)
+            commit_session()
+            
+            return {
+                'chat_id': chat.id,
+                'classification_result': chat.classification_result,
+                'assistant_message': {
+                    'content': assistant_response,
+                    'timestamp': assistant_message.created_at.isoformat()
+                },
+                'degraded': degradations(deadline)
+            }
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def enqueue_message(chat, message, image):
+    """Async mode: persist the user side of the turn now, run the rest on the job queue."""
+    history = load_history(chat)
+    image_bytes, image_hash, text_message = save_user_turn(chat, message, image)
+    staged = [m for m in db.session.new if isinstance(m, Message)]
+    commit_session()
+    
+    try:
+        job = message_jobs.submit(
+            run_message_job, chat.id, message, image_bytes, image_hash, history, owner=current_user.id
+        )
+    except QueueFull:
+        # Undo the turn so the client can simply resend it later
+        for m in staged:
+            db.session.delete(m)
+        if image_bytes:
+            filename, chat.image_path = chat.image_path, None
+            db.session.flush()
+            discard_upload(filename)
+        commit_session()
+        return jsonify({
+            'error': 'Server is busy, please retry shortly',
+            'queue': message_jobs.stats()
+        }), 503, {'Retry-After': '5'}
+    
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('get_job', job_id=job.id),
+        'user_message': {
+            'content': message,
+            'timestamp': text_message.created_at.isoformat() if text_message else None
+        }
+    }), 202
+
 @app.route('/api/message', methods=['POST'])
 @login_required
 def send_message():
@@ -200,53 +700,23 @@ def send_message():
         if not chat or chat.user_id != current_user.id:
             return jsonify({'error': 'Chat not found'}), 404
         
-        # Check if chat already has an image
-        has_image = bool(chat.image_path)
+        # Opt-in async mode: return a job id right away instead of pinning this worker
+        if app.config['ASYNC_MESSAGES'] or request.form.get('async') in ('1', 'true'):
+            return enqueue_message(chat, message, image)
         
-        # Process image if provided and chat doesn't have one
-        if image and image.filename and not has_image:
-            # Save image
-            filename = secure_filename(image.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{filename}"
-            image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            image.save(image_path)
-            
-            # Classify image
-            result = dermatology_assistant.predict_image(image_path)
-            
-            # Update chat with image path and classification
-            chat.image_path = filename
-            chat.classification_result = result
-            db.session.commit()
-            
-            # Get RAG context
-            rag_context = dermatology_assistant.get_rag_context(result, result)
-            
-            # Create image message
-            image_message = Message(
-                chat_id=chat.id,
-                content=f'<img src="/uploads/{filename}" alt="Uploaded image">',
-                is_user=True
-            )
-            db.session.add(image_message)
-        else:
-            rag_context = None
-        
-        # Create text message if there is one
-        if message:
-            text_message = Message(
-                chat_id=chat.id,
-                content=message,
-                is_user=True
-            )
-            db.session.add(text_message)
+        deadline = Deadline.start(app.config['REQUEST_DEADLINE'])
+        history = load_history(chat)
+        rag_context, text_message = process_user_turn(chat, message, image, deadline)
         
         # Generate assistant response
         assistant_response = dermatology_assistant.generate_response(
             image_class=chat.classification_result,
             user_message=message,
-            rag_context=rag_context
+            rag_context=rag_context,
+            chat_id=chat.id,
+            deadline=deadline,
+            history=history,
+            classes=rag_classes(chat)
         )
         
         # Create assistant message
@@ -256,18 +726,22 @@ def send_message():
             is_user=False
         )
         db.session.add(assistant_message)
-        db.session.commit()
+        commit_session()
         
-        return jsonify({
+        response = {
             'user_message': {
                 'content': message,
-                'timestamp': text_message.created_at.isoformat() if message else None
+                'timestamp': text_message.created_at.isoformat() if text_message else None
             },
             'assistant_message': {
                 'content': assistant_response,
                 'timestamp': assistant_message.created_at.isoformat()
-            }
-        })
+            },
+            'degraded': degradations(deadline)
+        }
+        if wants_timings():
+            response['timings'] = request_timings()
+        return jsonify(response)
         
     except Exception as e:
         print(f"Error in send_message: {str(e)}")
@@ -276,9 +750,209 @@ def send_message():
         print(f"Traceback: {traceback.format_exc()}")
         return jsonify({'error': str(e)}), 500
 
+def degradations(deadline):
+    """What was skipped or shortened to meet the turn's deadline, e.g. [{'kind': 'reformulation_skipped'}]."""
+    return deadline.degradations if deadline is not None else []
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/message/stream', methods=['POST'])
+@login_required
+def send_message_stream():
+    """
+    Streaming variant of /api/message (Server-Sent Events).
+    Emits `token` events as the LLM produces them and a final `done` event
+    with the persisted assistant message and time-to-first-token vs total latency.
+    """
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    started = time.perf_counter()
+    chat_id = request.form.get('chat_id')
+    message = request.form.get('message', '')
+    image = request.files.get('image')
+    
+    chat = db.session.get(Chat, chat_id)
+    if not chat or chat.user_id != current_user.id:
+        return jsonify({'error': 'Chat not found'}), 404
+    
+    deadline = Deadline.start(app.config['REQUEST_DEADLINE'])
+    
+    def generate():
+        try:
+            history = load_history(chat)
+            rag_context, text_message = process_user_turn(chat, message, image, deadline)
+            yield sse_event('user_message', {
+                'content': message,
+                'timestamp': text_message.created_at.isoformat() if text_message else None,
+                'classification_result': chat.classification_result
+            })
+            
+            generation_started = time.perf_counter()
+            first_token_at = None
+            parts = []
+            for token in dermatology_assistant.generate_response_stream(
+                image_class=chat.classification_result,
+                user_message=message,
+                rag_context=rag_context,
+                chat_id=chat.id,
+                deadline=deadline,
+                history=history,
+                classes=rag_classes(chat)
+            ):
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(token)
+                yield sse_event('token', {'content': token})
+            finished = time.perf_counter()
+            
+            assistant_message = Message(
+                chat_id=chat.id,
+                content=''.join(parts),
+                is_user=False
+            )
+            db.session.add(assistant_message)
+            commit_session()
+            
+            first_token_at = first_token_at or finished
+            yield sse_event('done', {
+                'assistant_message': {
+                    'content': assistant_message.content,
+                    'timestamp': assistant_message.created_at.isoformat()
+                },
+                'timings': {
+                    'time_to_first_token_ms': round((first_token_at - started) * 1000, 1),
+                    'generation_ttft_ms': round((first_token_at - generation_started) * 1000, 1),
+                    'total_ms': round((finished - started) * 1000, 1)
+                },
+                'degraded': degradations(deadline)
+            })
+        except GeneratorExit:
+            # client went away mid-answer: keep the user side of the turn
+            commit_session()
+            raise
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in send_message_stream: {str(e)}")
+            import traceback
+            print(f"Traceback: {traceback.format_exc()}")
+            yield sse_event('error', {'error': str(e)})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# Per-request latency: every request gets a timing collector that spans feed into
+HTTP_LATENCY = REGISTRY.histogram(
+    'derm_http_request_duration_seconds',
+    'End-to-end HTTP request latency.',
+    labelnames=('endpoint', 'method', 'status'),
+)
+
+def wants_timings():
+    """Clients can ask for a per-stage breakdown with ?timings=1 (or a form field)."""
+    return (request.args.get('timings') or request.form.get('timings')) in ('1', 'true')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.timings_token = start_request_timings()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_LATENCY.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=str(response.status_code),
+        )
+    return response
+
+@app.teardown_request
+def end_request_timer(exc):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        try:
+            end_request_timings(token)
+        except ValueError:
+            pass    # streamed responses finish in a different context
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of stage/request latency histograms, counters and gauges."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/inference')
+def inference_metrics():
+    """Metrics of the shared inference server process (404 when models run in-process)."""
+    if not isinstance(dermatology_assistant, InferenceClient):
+        return Response('models run in this process; see /metrics\n', status=404, mimetype='text/plain')
+    return Response(dermatology_assistant.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz')
+def healthz():
+    """
+    Liveness: the process is up; includes per-component load state and times.
+    Stays 200 while the shared inference server is unreachable (that is readiness).
+    """
+    try:
+        status = dermatology_assistant.status()
+    except OSError as e:
+        return jsonify({'status': 'ok', 'inference_server': str(e)})
+    return jsonify({'status': 'ok', **status})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once the models can serve requests, 503 while loading or after a failure."""
+    try:
+        status = dermatology_assistant.status()
+    except OSError as e:
+        # shared inference server not reachable (yet)
+        return jsonify({'ready': False, 'error': str(e)}), 503
+    return jsonify(status), (200 if status['ready'] else 503)
+
+@app.route('/api/jobs/<job_id>')
+@login_required
+def get_job(job_id):
+    job = message_jobs.get(job_id)
+    if not job or job.owner != current_user.id:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    data = job.to_dict()
+    data['queue_position'] = message_jobs.position(job)
+    return jsonify(data)
+
+@app.route('/api/metrics/jobs')
+@login_required
+def job_metrics():
+    return jsonify(message_jobs.stats())
+
+@app.route('/api/metrics/llm')
+@login_required
+def llm_metrics():
+    return jsonify({
+        'cache': dermatology_assistant.llm_cache_stats(),
+        'pool': dermatology_assistant.llm_pool_stats(),
+    })
+
+@app.route('/api/metrics/classifier')
+@login_required
+def classifier_metrics():
+    return jsonify({
+        'batching': dermatology_assistant.batching_stats(),
+        'cache': dermatology_assistant.cache_stats()
+    })
+
 @app.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
+    # the upload may still be in flight on the background writer
+    wait_for_upload(filename)
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 @app.route('/api/chat/<int:chat_id>/messages')
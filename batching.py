@@ -0,0 +1,169 @@
+import threading, time, queue
+from collections import deque, Counter
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+
+class _Request:
+    __slots__ = ("item", "kwargs", "future", "enqueued_at")
+
+    def __init__(self, item: Any, kwargs: dict):
+        self.item = item
+        self.kwargs = kwargs
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Collects single-item requests from concurrent threads and runs them
+    through `predict_fn` as one batch.
+
+    A batch is flushed when `max_batch_size` items are waiting or when the
+    oldest item has waited `max_wait_ms`, whichever comes first.
+    `predict_fn(items, **kwargs)` must return a list with one result per
+    item (see `ConvNeXtTinyClassifier.predict_batch`).
+    """
+
+    def __init__(
+        self,
+        predict_fn: Callable[..., Any],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        name: str = "batcher",
+        history: int = 1024,
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be >= 1")
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._closed = False
+
+        # ---------- metrics ----------
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._num_batches = 0
+        self._num_items = 0
+        self._num_errors = 0
+        self._queue_delays = deque(maxlen=history)   # seconds
+        self._batch_latencies = deque(maxlen=history)
+
+        self._worker = threading.Thread(target=self._run, name=f"{name}-worker", daemon=True)
+        self._worker.start()
+
+    # ------------- public API -------------
+    def submit(self, item: Any, **kwargs) -> Future:
+        if self._closed:
+            raise RuntimeError(f"{self.name} is closed")
+        req = _Request(item, kwargs)
+        self._queue.put(req)
+        return req.future
+
+    def predict(self, item: Any, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Blocking single-item call; returns this caller's own result."""
+        return self.submit(item, **kwargs).result(timeout=timeout)
+
+    def close(self, timeout: Optional[float] = None):
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join(timeout)
+
+    def stats(self) -> dict:
+        with self._lock:
+            delays = sorted(self._queue_delays)
+            lats = sorted(self._batch_latencies)
+            return {
+                "name": self.name,
+                "batches": self._num_batches,
+                "items": self._num_items,
+                "errors": self._num_errors,
+                "queue_depth": self._queue.qsize(),
+                "avg_batch_size": (self._num_items / self._num_batches) if self._num_batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "queue_delay_ms": _summary_ms(delays),
+                "batch_latency_ms": _summary_ms(lats),
+            }
+
+    # ------------- worker -------------
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                req = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:               # close() sentinel: flush what we have
+                self._queue.put(None)
+                break
+            batch.append(req)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+
+            # requests with different kwargs (e.g. top_k) can't share a forward pass
+            groups: dict = {}
+            for req in batch:
+                key = tuple(sorted(req.kwargs.items()))
+                groups.setdefault(key, []).append(req)
+            for reqs in groups.values():
+                self._run_group(reqs)
+
+    def _run_group(self, reqs: List[_Request]):
+        started = time.perf_counter()
+        for req in reqs:
+            # the caller may have given up (cancel) while queued
+            if not req.future.running() and not req.future.done():
+                req.future.set_running_or_notify_cancel()
+        try:
+            out = self.predict_fn([r.item for r in reqs], **reqs[0].kwargs)
+            if len(out) != len(reqs):
+                raise RuntimeError(f"{self.name}: expected {len(reqs)} results, got {len(out)}")
+        except Exception as e:
+            with self._lock:
+                self._num_errors += 1
+            if len(reqs) > 1:
+                # one bad input (e.g. a corrupt upload) must not fail its batch-mates
+                for req in reqs:
+                    self._run_group([req])
+                return
+            if not reqs[0].future.done():
+                reqs[0].future.set_exception(e)
+            return
+        finished = time.perf_counter()
+
+        for req, res in zip(reqs, out):
+            if not req.future.done():
+                req.future.set_result(res)
+
+        with self._lock:
+            self._num_batches += 1
+            self._num_items += len(reqs)
+            self._batch_sizes[len(reqs)] += 1
+            self._batch_latencies.append(finished - started)
+            for req in reqs:
+                self._queue_delays.append(started - req.enqueued_at)
+
+
+def _summary_ms(sorted_vals: list) -> dict:
+    if not sorted_vals:
+        return {"count": 0}
+    n = len(sorted_vals)
+    pick = lambda q: sorted_vals[min(n - 1, int(q * n))] * 1000.0
+    return {
+        "count": n,
+        "mean": sum(sorted_vals) / n * 1000.0,
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "max": sorted_vals[-1] * 1000.0,
+    }
@@ -0,0 +1,124 @@
+"""
+Prompt tokens and prompt-eval time per turn of a multi-turn conversation.
+
+Plays the same scripted conversation against Ollama with two prompt layouts:
+
+    single     every question on its own, the turn's Q&A pairs inside the
+               system prompt (the layout before multi-turn support)
+    multiturn  stable system prefix (instructions, disease, description,
+               rolling summary) + recent turns + this turn's Q&A pairs and
+               question, history bounded by ConversationMemory
+
+and prints, per turn, the estimated prompt size, the tokens Ollama actually
+evaluated (prompt_eval_count; a prefix reused from its KV cache is not
+counted) and the prompt-eval time.
+
+    python -m src.bench_context --host http://localhost:11434 --turns 8
+    python -m src.bench_context --fake --turns 8     # fake Ollama from src/standins.py
+"""
+import argparse, json, random
+
+from src.conversation import ConversationMemory
+from src.llm import MedicalLLMHelper, prompt_tokens
+from src.standins import serve_fake_ollama, synthetic_qa
+
+QUESTIONS = [
+    "What is this condition and is it serious?",
+    "Is it contagious?",
+    "How long does it usually take to heal?",
+    "Which creams or ointments can I use?",
+    "It got worse after I went swimming, why?",
+    "Should I stop using my usual moisturizer?",
+    "Can I wear makeup on it?",
+    "When should I see a dermatologist?",
+    "Will it leave a scar?",
+    "How do I stop the itching at night?",
+]
+
+
+def single_turn_messages(helper: MedicalLLMHelper, disease: str, question: str, rag_out: dict) -> list:
+    """The previous layout: Q&A pairs in the system prompt, no history."""
+    qa_block = "\n".join(f"Q: {qa['question']}\nA: {qa['answer']}" for qa in rag_out["matched_qa_pairs"])
+    system_prompt = helper._system_prompt(disease, rag_out["description"]) + f"\n\n**Relevant Q&A Pairs**\n{qa_block}"
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"User Question: {question}\n(refined: {rag_out['refined_question']})"},
+    ]
+
+
+def play(helper: MedicalLLMHelper, layout: str, disease: str, entry: dict, turns: int,
+         top_k: int, history_tokens: int) -> list:
+    memory = ConversationMemory(history_tokens)
+    history, rows = [], []
+    for t in range(turns):
+        question = QUESTIONS[t % len(QUESTIONS)]
+        rng = random.Random(t)      # same "retrieved" pairs for both layouts
+        rag_out = {
+            "description": entry["description"],
+            "matched_qa_pairs": rng.sample(entry["qa_pairs"], min(top_k, len(entry["qa_pairs"]))),
+            "refined_question": question,
+        }
+        summarized = False
+        if layout == "single":
+            messages = single_turn_messages(helper, disease, question, rag_out)
+        else:
+            before = memory.summaries.get(1)
+            summary, recent = memory.context(helper, 1, history)
+            summarized = memory.summaries.get(1) is not before
+            messages = helper._answer_messages(disease, question, rag_out, recent, summary)
+
+        resp = helper.pool.chat(model=helper.model, messages=messages, options=helper.gen_opts)
+        rows.append({
+            "turn": t + 1,
+            "prompt_tokens_est": prompt_tokens(messages),
+            "prompt_eval_count": resp.get("prompt_eval_count") or 0,
+            "prompt_eval_ms": (resp.get("prompt_eval_duration") or 0) / 1e6,
+            "summarized": summarized,
+        })
+        history.append({"id": 2 * t + 1, "role": "user", "content": question})
+        history.append({"id": 2 * t + 2, "role": "assistant", "content": resp["message"]["content"]})
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-turn prompt-eval cost of the answer prompt layouts.")
+    parser.add_argument("--host", default="http://localhost:11434")
+    parser.add_argument("--model", default="hf.co/unsloth/medgemma-4b-it-GGUF:Q8_K_XL")
+    parser.add_argument("--fake", action="store_true", help="run against a local fake Ollama")
+    parser.add_argument("--qa-json", default=None, help="knowledge base (default: synthetic)")
+    parser.add_argument("--disease", default=None, help="default: the first one in the knowledge base")
+    parser.add_argument("--turns", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=5, help="Q&A pairs per turn")
+    parser.add_argument("--history-tokens", type=int, default=1024)
+    args = parser.parse_args(argv)
+
+    if args.qa_json:
+        with open(args.qa_json) as f:
+            derm_data = json.load(f)
+    else:
+        derm_data = synthetic_qa()
+    disease = args.disease or next(iter(derm_data))
+
+    host = args.host
+    if args.fake:
+        server = serve_fake_ollama("127.0.0.1", 0, tokens_per_sec=400.0, prefill_tokens_per_sec=4000.0, reply_tokens=80)
+        host = f"http://127.0.0.1:{server.server_address[1]}"
+    helper = MedicalLLMHelper(model=args.model, host=host, cache_size=0, max_in_flight=1)
+
+    header = f"{'layout':<10} {'turn':>4} {'prompt_est':>10} {'evaluated':>9} {'prompt_eval':>12}"
+    print(header)
+    print("-" * len(header))
+    for layout in ("single", "multiturn"):
+        rows = play(helper, layout, disease, derm_data[disease], args.turns, args.top_k, args.history_tokens)
+        for r in rows:
+            print(
+                f"{layout:<10} {r['turn']:>4} {r['prompt_tokens_est']:>10} {r['prompt_eval_count']:>9} "
+                f"{r['prompt_eval_ms']:>10.1f}ms" + ("  (history summarized)" if r["summarized"] else "")
+            )
+        evaluated = sum(r["prompt_eval_count"] for r in rows)
+        ms = sum(r["prompt_eval_ms"] for r in rows)
+        print(f"{layout:<10} {'all':>4} {sum(r['prompt_tokens_est'] for r in rows):>10} {evaluated:>9} {ms:>10.1f}ms\n")
+
+
+if __name__ == "__main__":
+    main()
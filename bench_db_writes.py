@@ -0,0 +1,118 @@
+"""
+Concurrent chat-write benchmark for the SQLite database.
+
+N client processes (like N web workers) each write chat turns -- an
+image message, a text message and the assistant reply, plus the chat's
+classification -- and we report messages/sec, commit latency and lock
+errors for:
+
+    legacy      default rollback journal, two commits per turn (as before)
+    production  WAL + tuned pragmas, one commit per turn
+
+    python -m src.bench_db_writes --clients 1 4 8 --turns 200
+"""
+import argparse, os, sqlite3, statistics, tempfile, time
+from datetime import datetime
+from multiprocessing import Pool
+
+from src.bench_history import INDEXES, SCHEMA
+from src.sqlite_tuning import apply_pragmas
+
+MODES = ("legacy", "production")
+
+
+def setup(path: str, clients: int):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA + INDEXES)
+    conn.executemany("INSERT INTO user VALUES (?, ?)", [(u, f"user{u}") for u in range(1, clients + 1)])
+    conn.commit()
+    conn.close()
+
+
+def _connect(path: str, mode: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=5.0)
+    if mode == "production":
+        apply_pragmas(conn)
+    return conn
+
+
+def client(job) -> dict:
+    path, mode, user, turns = job
+    conn = _connect(path, mode)
+    commit_ms, errors, written = [], 0, 0
+    reply = "assistant reply " * 40
+
+    def commit():
+        t0 = time.perf_counter()
+        conn.commit()
+        commit_ms.append((time.perf_counter() - t0) * 1000.0)
+
+    for t in range(turns):
+        now = datetime.utcnow().isoformat(" ")
+        try:
+            cur = conn.execute("INSERT INTO chat (user_id, created_at) VALUES (?, ?)", (user, now))
+            chat_id = cur.lastrowid
+            conn.execute(
+                "INSERT INTO message (chat_id, content, is_user, created_at) VALUES (?, ?, 1, ?)",
+                (chat_id, '<img src="/uploads/x.jpg">', now),
+            )
+            conn.execute(
+                "INSERT INTO message (chat_id, content, is_user, created_at) VALUES (?, ?, 1, ?)",
+                (chat_id, "Is this contagious?", now),
+            )
+            conn.execute("UPDATE chat SET classification_result = ? WHERE id = ?", ("Eczema", chat_id))
+            if mode == "legacy":
+                commit()    # old send_message: commit after classification ...
+            conn.execute(
+                "INSERT INTO message (chat_id, content, is_user, created_at) VALUES (?, ?, 0, ?)",
+                (chat_id, reply, datetime.utcnow().isoformat(" ")),
+            )
+            commit()    # ... and again at the end; production commits the turn only here
+            written += 3
+        except sqlite3.OperationalError:     # "database is locked"
+            conn.rollback()
+            errors += 1
+    conn.close()
+    return {"commit_ms": commit_ms, "errors": errors, "written": written}
+
+
+def run(mode: str, clients: int, turns: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "writes.db")
+        setup(path, clients)
+        jobs = [(path, mode, u, turns) for u in range(1, clients + 1)]
+        with Pool(clients) as pool:
+            t0 = time.perf_counter()
+            results = pool.map(client, jobs)
+            elapsed = time.perf_counter() - t0
+
+    commit_ms = sorted(ms for r in results for ms in r["commit_ms"])
+    written = sum(r["written"] for r in results)
+    return {
+        "messages_per_sec": written / elapsed,
+        "commit_p50_ms": statistics.median(commit_ms) if commit_ms else 0.0,
+        "commit_p95_ms": commit_ms[int(0.95 * (len(commit_ms) - 1))] if commit_ms else 0.0,
+        "errors": sum(r["errors"] for r in results),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark concurrent chat writes to SQLite.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--turns", type=int, default=200, help="turns written per client")
+    args = parser.parse_args(argv)
+
+    header = f"{'mode':<11} {'clients':>7} {'msgs/s':>9} {'commit_p50':>11} {'commit_p95':>11} {'errors':>7}"
+    print(header)
+    print("-" * len(header))
+    for clients in args.clients:
+        for mode in MODES:
+            r = run(mode, clients, args.turns)
+            print(
+                f"{mode:<11} {clients:>7} {r['messages_per_sec']:>9.0f} "
+                f"{r['commit_p50_ms']:>10.2f}ms {r['commit_p95_ms']:>10.2f}ms {r['errors']:>7}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Decode + preprocess benchmark for the upload -> classification path.
+
+Compares the old path (save upload to disk, reopen, full decode, resize)
+with the in-memory path (decode from bytes with reduced-scale JPEG draft)
+for a range of photo sizes:
+
+    python -m src.bench_decode --sizes 640x480 1920x1080 4032x3024 --repeat 20
+
+Peak memory is reported as the size of the decoded pixel buffer (what
+PIL allocates outside the Python heap) plus the Python-heap peak from
+tracemalloc.
+"""
+import argparse, io, os, statistics, tempfile, time, tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from src.classifier import INPUT_SIZE, default_transform, open_image
+
+
+def make_jpeg(width: int, height: int, quality: int = 90) -> bytes:
+    # smooth gradient + noise compresses roughly like a real skin photo
+    rng = np.random.default_rng(0)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def disk_full_decode(data: bytes, tf, tmp_dir: str):
+    path = os.path.join(tmp_dir, "upload.jpg")
+    with open(path, "wb") as f:
+        f.write(data)
+    img = Image.open(path)
+    img.load()
+    decoded = img.size
+    tf(img.convert("RGB"))
+    return decoded
+
+
+def memory_draft_decode(data: bytes, tf, tmp_dir: str):
+    img = open_image(data, INPUT_SIZE)
+    img.load()
+    decoded = img.size
+    tf(img.convert("RGB"))
+    return decoded
+
+
+def measure(fn, data: bytes, tf, tmp_dir: str, repeat: int) -> dict:
+    fn(data, tf, tmp_dir)      # warm-up
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(data, tf, tmp_dir)
+        times.append((time.perf_counter() - t0) * 1000.0)
+
+    tracemalloc.start()
+    decoded = fn(data, tf, tmp_dir)
+    _, py_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "mean_ms": statistics.fmean(times),
+        "p50_ms": statistics.median(times),
+        "decoded_size": f"{decoded[0]}x{decoded[1]}",
+        "decoded_buffer_mb": decoded[0] * decoded[1] * 3 / 2**20,
+        "python_peak_mb": py_peak / 2**20,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark upload decode + preprocessing.")
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1920x1080", "4032x3024"])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    tf = default_transform()
+    header = f"{'size':>10} {'jpeg_kb':>8} | {'path':<14} {'mean_ms':>8} {'p50_ms':>8} {'decoded':>10} {'buf_mb':>7} {'py_mb':>6}"
+    print(header)
+    print("-" * len(header))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            w, h = (int(v) for v in size.lower().split("x"))
+            data = make_jpeg(w, h)
+            for name, fn in (("disk+full", disk_full_decode), ("memory+draft", memory_draft_decode)):
+                r = measure(fn, data, tf, tmp_dir, args.repeat)
+                print(
+                    f"{size:>10} {len(data) / 1024:>8.0f} | {name:<14} {r['mean_ms']:>8.2f} {r['p50_ms']:>8.2f} "
+                    f"{r['decoded_size']:>10} {r['decoded_buffer_mb']:>7.2f} {r['python_peak_mb']:>6.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Chat/message history query benchmark on a seeded SQLite database.
+
+Seeds the app's `chat` / `message` tables (same columns and indexes as
+app.py) with large histories and compares, with and without the composite
+indexes, what the history endpoints used to do (load everything) against
+keyset pages, deep OFFSET pages and `since` polling:
+
+    python -m src.bench_history --users 50 --chats 200 --messages 100 --repeat 50
+"""
+import argparse, os, random, sqlite3, statistics, tempfile, time
+from datetime import datetime, timedelta
+
+SCHEMA = """
+CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(80));
+CREATE TABLE chat (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES user(id),
+    created_at DATETIME,
+    image_path VARCHAR(255),
+    classification_result VARCHAR(255)
+);
+CREATE TABLE message (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL REFERENCES chat(id),
+    content TEXT NOT NULL,
+    is_user BOOLEAN,
+    created_at DATETIME
+);
+"""
+INDEXES = """
+CREATE INDEX ix_chat_user_created ON chat (user_id, created_at, id);
+CREATE INDEX ix_message_chat_created ON message (chat_id, created_at, id);
+"""
+
+QUERIES = {
+    "chats: all (old)":
+        "SELECT * FROM chat WHERE user_id = :user ORDER BY created_at DESC",
+    "chats: first page":
+        "SELECT * FROM chat WHERE user_id = :user ORDER BY created_at DESC, id DESC LIMIT :limit",
+    "chats: deep keyset page":
+        "SELECT * FROM chat WHERE user_id = :user AND (created_at, id) < (:ts, :id) "
+        "ORDER BY created_at DESC, id DESC LIMIT :limit",
+    "chats: deep OFFSET page":
+        "SELECT * FROM chat WHERE user_id = :user ORDER BY created_at DESC, id DESC LIMIT :limit OFFSET :offset",
+    "messages: all (old)":
+        "SELECT * FROM message WHERE chat_id = :chat ORDER BY created_at ASC",
+    "messages: latest page":
+        "SELECT * FROM message WHERE chat_id = :chat ORDER BY created_at DESC, id DESC LIMIT :limit",
+    "messages: since poll":
+        "SELECT * FROM message WHERE chat_id = :chat AND created_at > :since "
+        "ORDER BY created_at ASC, id ASC LIMIT :limit",
+}
+
+
+def _ts(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S.%f")     # SQLAlchemy's SQLite DATETIME format
+
+
+def seed(path: str, users: int, chats: int, messages: int, seed: int = 0):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    start = datetime(2024, 1, 1)
+    chat_id = 0
+    chat_rows, message_rows = [], []
+    conn.executemany("INSERT INTO user VALUES (?, ?)", [(u, f"user{u}") for u in range(1, users + 1)])
+    # chats of different users interleave in time, as they do in production
+    for c in range(users * chats):
+        chat_id += 1
+        user = rng.randint(1, users)
+        created = start + timedelta(minutes=c)
+        chat_rows.append((chat_id, user, _ts(created), None, "Eczema"))
+        for m in range(messages):
+            message_rows.append((chat_id, "lorem ipsum " * 20, m % 2 == 0, _ts(created + timedelta(seconds=m))))
+    conn.executemany("INSERT INTO chat VALUES (?, ?, ?, ?, ?)", chat_rows)
+    conn.executemany("INSERT INTO message (chat_id, content, is_user, created_at) VALUES (?, ?, ?, ?)", message_rows)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def params_for(conn, limit: int) -> dict:
+    (user,) = conn.execute("SELECT user_id FROM chat GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+    n_chats = conn.execute("SELECT COUNT(*) FROM chat WHERE user_id = ?", (user,)).fetchone()[0]
+    offset = n_chats * 3 // 4
+    ts, row_id = conn.execute(
+        "SELECT created_at, id FROM chat WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?",
+        (user, offset),
+    ).fetchone()
+    (chat,) = conn.execute("SELECT chat_id FROM message GROUP BY chat_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+    (since,) = conn.execute(
+        "SELECT created_at FROM message WHERE chat_id = ? ORDER BY created_at DESC LIMIT 1 OFFSET 2", (chat,)
+    ).fetchone()
+    return {"user": user, "chat": chat, "limit": limit, "offset": offset, "ts": ts, "id": row_id, "since": since}
+
+
+def measure(conn, sql: str, params: dict, repeat: int) -> dict:
+    conn.execute(sql, params).fetchall()     # warm-up
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    plan = " / ".join(r[-1] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+    return {"rows": len(rows), "p50_ms": statistics.median(times), "plan": plan}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark chat/message history queries.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=200, help="chats per user (on average)")
+    parser.add_argument("--messages", type=int, default=100, help="messages per chat")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "history.db")
+        t0 = time.perf_counter()
+        seed(path, args.users, args.chats, args.messages)
+        print(f"seeded {args.users * args.chats} chats / {args.users * args.chats * args.messages} messages "
+              f"in {time.perf_counter() - t0:.1f}s")
+
+        conn = sqlite3.connect(path)
+        params = params_for(conn, args.limit)
+        for label, ddl in (("no indexes", None), ("composite indexes", INDEXES)):
+            if ddl:
+                conn.executescript(ddl)
+                conn.execute("ANALYZE")
+            print(f"\n== {label}")
+            print(f"{'query':<26} {'rows':>6} {'p50_ms':>9}  plan")
+            for name, sql in QUERIES.items():
+                r = measure(conn, sql, params, args.repeat)
+                print(f"{name:<26} {r['rows']:>6} {r['p50_ms']:>9.3f}  {r['plan']}")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
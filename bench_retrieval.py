@@ -0,0 +1,116 @@
+"""
+Latency and hit rate of the retrieval modes (see RetrievalAugmentedGeneration).
+
+Every query is a knowledge-base question with a share of its words dropped
+(a crude paraphrase); a hit means the pair it came from is in the top-k.
+Each query is searched in its own disease, like a first turn with
+RAG_CLASSIFIER_TOPK=1, or across the whole knowledge base with --all-classes.
+Reformulation is skipped, so the timings are encoder + search only.
+
+    dense   encoder + similarity against every candidate (the default path)
+    hybrid  BM25 shortlist, dense re-ranking of the shortlist, fused scores
+    bm25    lexical only, no encoder call
+
+    python -m src.bench_retrieval --queries 300
+    python -m src.bench_retrieval --fake --classes 20 --pairs 200 --all-classes
+"""
+import argparse, json, random, tempfile, time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from src.rag import RETRIEVAL_MODES, RetrievalAugmentedGeneration
+
+
+def paraphrase(question: str, rng: random.Random, drop: float) -> str:
+    words = question.split()
+    kept = [w for w in words if rng.random() >= drop]
+    return " ".join(kept or words[:1])
+
+
+def run(rag: RetrievalAugmentedGeneration, queries: list, top_k: int, thresh, all_classes: bool) -> dict:
+    """queries: [(disease, question, target pair)]; returns a report per mode."""
+    everything = list(rag.derm_data) if all_classes else None
+    report, dense_hits = {}, None
+    for mode in RETRIEVAL_MODES:
+        rag.retrieval_mode = mode
+        rag.retrieve(queries[0][0], queries[0][1], top_k=top_k, thresh=thresh, reformulate=False)    # warm-up
+        lat, hits, found = [], 0, []
+        for disease, question, target in queries:
+            t0 = time.perf_counter()
+            out = rag.retrieve(disease, question, top_k=top_k, thresh=thresh, classes=everything, reformulate=False)
+            lat.append((time.perf_counter() - t0) * 1000.0)
+            pairs = out["matched_qa_pairs"] if out else []
+            hits += any(p is target for p in pairs)
+            found.append({id(p) for p in pairs})
+        if mode == "dense":
+            dense_hits = found
+        overlap = [len(a & b) / len(b) for a, b in zip(found, dense_hits) if b]
+        lat.sort()
+        report[mode] = {
+            "mean_ms": float(np.mean(lat)),
+            "p50_ms": lat[len(lat) // 2],
+            "p95_ms": lat[int(0.95 * (len(lat) - 1))],
+            f"hit@{top_k}": hits / len(queries),
+            f"overlap@{top_k}_with_dense": float(np.mean(overlap)) if overlap else None,
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency / hit rate of dense, hybrid and BM25 retrieval.")
+    parser.add_argument("--qa-json", default="dataset/dermatology_qa.json")
+    parser.add_argument("--encoder", default="dmis-lab/biobert-base-cased-v1.1")
+    parser.add_argument("--index-dir", default="dataset/qa_index")
+    parser.add_argument("--fake", action="store_true",
+                        help="synthetic knowledge base and the hashing encoder from src/standins.py")
+    parser.add_argument("--classes", type=int, default=10, help="--fake: number of diseases")
+    parser.add_argument("--pairs", type=int, default=40, help="--fake: Q/A pairs per disease")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--drop", type=float, default=0.3, help="share of words dropped from each question")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--thresh", type=float, default=0.75, help="dense score threshold (negative: none)")
+    parser.add_argument("--all-classes", action="store_true", help="search the whole knowledge base")
+    parser.add_argument("--shortlist", type=int, default=64)
+    parser.add_argument("--lexical-weight", type=float, default=0.3)
+    parser.add_argument("--fusion", choices=("linear", "rrf"), default="linear")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    opts = dict(retrieval_mode="hybrid", shortlist=args.shortlist, lexical_weight=args.lexical_weight,
+                fusion=args.fusion, lexical_fallback=False)
+    if args.fake:
+        from src.standins import HashingEncoder, synthetic_qa
+        tmp = Path(tempfile.mkdtemp(prefix="bench-retrieval-"))
+        qa_json = tmp / "qa.json"
+        qa_json.write_text(json.dumps(synthetic_qa(args.classes, args.pairs, args.seed)))
+        rag = RetrievalAugmentedGeneration(
+            helper=None, qa_json_path=str(qa_json), encoder_name="standin-hashing-768", device="cpu",
+            index_dir=str(tmp / "index"), encoder=HashingEncoder(), **opts,
+        )
+    else:
+        rag = RetrievalAugmentedGeneration(
+            helper=None, qa_json_path=args.qa_json, encoder_name=args.encoder,
+            device="cuda" if torch.cuda.is_available() else "cpu", index_dir=args.index_dir, **opts,
+        )
+
+    rng = random.Random(args.seed)
+    pairs = [(d, qa) for d, entry in rag.derm_data.items() for qa in entry["qa_pairs"]]
+    sample = rng.sample(pairs, min(args.queries, len(pairs)))
+    queries = [(d, paraphrase(qa["question"], rng, args.drop), qa) for d, qa in sample]
+
+    report = run(rag, queries, args.top_k, args.thresh if args.thresh >= 0 else None, args.all_classes)
+    print(json.dumps({
+        "pairs": len(pairs),
+        "queries": len(queries),
+        "scope": "all classes" if args.all_classes else "own class",
+        "shortlist": args.shortlist,
+        "fusion": args.fusion,
+        "lexical_weight": args.lexical_weight,
+        "modes": report,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import hashlib, json, os, sqlite3, threading, time
+from typing import Optional
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Persistent (image hash, model version) -> top-k classifier result cache.
+
+    Backed by a local SQLite file so results survive restarts and are shared
+    by every worker process on the box. Size is bounded by `max_entries`;
+    the least recently used rows are evicted first.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS classification_cache (
+                image_hash    TEXT NOT NULL,
+                model_version TEXT NOT NULL,
+                result        TEXT NOT NULL,
+                created_at    REAL NOT NULL,
+                last_used     REAL NOT NULL,
+                PRIMARY KEY (image_hash, model_version)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_classification_cache_last_used "
+            "ON classification_cache (last_used)"
+        )
+        self._conn.commit()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, image_hash: str, model_version: str) -> Optional[list]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM classification_cache WHERE image_hash = ? AND model_version = ?",
+                (image_hash, model_version),
+            ).fetchone()
+            if row is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._conn.execute(
+                "UPDATE classification_cache SET last_used = ? WHERE image_hash = ? AND model_version = ?",
+                (time.time(), image_hash, model_version),
+            )
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, image_hash: str, model_version: str, result: list):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO classification_cache VALUES (?, ?, ?, ?, ?)",
+                (image_hash, model_version, json.dumps(result), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM classification_cache").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM classification_cache WHERE rowid IN ("
+                "SELECT rowid FROM classification_cache ORDER BY last_used ASC LIMIT ?)",
+                (excess,),
+            )
+            self._evictions += excess
+
+    def stats(self) -> dict:
+        with self._lock:
+            (size,) = self._conn.execute("SELECT COUNT(*) FROM classification_cache").fetchone()
+            lookups = self._hits + self._misses
+            return {
+                "entries": size,
+                "max_entries": self.max_entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": (self._hits / lookups) if lookups else 0.0,
+            }
@@ -1,8 +1,79 @@
+import glob, hashlib, io, os
 import torch, timm
 import torch.nn as nn
 from torchvision import transforms
 from PIL import Image
-from typing import List, Union, Optional
+from typing import List, Union, Optional, Tuple
+from src.metrics import span
+
+
+BACKENDS = ("eager", "torchscript", "onnx")
+INPUT_SIZE = (224, 224)
+
+# anything `predict` accepts for one image
+ImageInput = Union[str, os.PathLike, bytes, bytearray, memoryview, io.IOBase, Image.Image]
+
+
+def default_transform() -> transforms.Compose:
+    return transforms.Compose(
+        [
+            transforms.Resize(INPUT_SIZE),
+            transforms.ToTensor(),
+            transforms.Normalize([0.5] * 3, [0.5] * 3),
+        ]
+    )
+
+
+def build_class_list(dataset_root: str = "dataset/train") -> List[str]:
+    """
+    Class names in model output order: the sorted class folder names of
+    dataset_root/<class_name>/**, as the classifier was trained.
+    """
+    class_dirs = sorted(
+        os.path.basename(p) for p in glob.glob(os.path.join(dataset_root, "*")) if os.path.isdir(p)
+    )
+    if not class_dirs:
+        raise RuntimeError(f"No class folders found in {dataset_root}")
+    return class_dirs
+
+
+def open_image(src: ImageInput, draft_size: Optional[Tuple[int, int]] = INPUT_SIZE) -> Image.Image:
+    """
+    Open an image from a path, raw bytes, a binary buffer or a PIL image.
+
+    JPEGs are decoded with `Image.draft`, which lets libjpeg scale by
+    1/2, 1/4 or 1/8 during decoding while keeping both sides >= draft_size,
+    so a 12 MP photo is never fully materialised just to become 224x224.
+    """
+    if isinstance(src, Image.Image):
+        return src
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        src = io.BytesIO(src)
+    img = Image.open(src)
+    if draft_size is not None and img.format == "JPEG":
+        img.draft("RGB", draft_size)
+    return img
+
+
+def load_convnext_tiny(
+    weights_path: str,
+    num_classes: int,
+    drop_path_rate: float = 0.2,
+    pretrained: bool = False,
+) -> nn.Module:
+    """
+    Eager timm ConvNeXt-Tiny with the fine-tuned dermatology weights.
+    ImageNet weights are not downloaded by default: the full state dict
+    (including the head) is overwritten by `weights_path` anyway.
+    """
+    model = timm.create_model(
+        "convnext_tiny",
+        pretrained=pretrained,
+        num_classes=num_classes,
+        drop_path_rate=drop_path_rate,
+    )
+    model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    return model.eval()
 
 
 class ConvNeXtTinyClassifier:
@@ -13,59 +84,120 @@ class ConvNeXtTinyClassifier:
         transform: Optional[transforms.Compose] = None,
         device: Union[str, torch.device] = "cuda",   # 🖥️→ default GPU
         drop_path_rate: float = 0.2,
+        backend: str = "eager",
+        artifact_path: Optional[str] = None,
+        channels_last: bool = False,
+        num_threads: Optional[int] = None,
+        jpeg_draft: bool = True,
     ):
+        """
+        backend:
+            "eager"        timm model in fp32 (default)
+            "torchscript"  frozen TorchScript module from export_classifier.py
+                           (optionally int8 dynamic-quantized), CPU only
+            "onnx"         ONNX Runtime session over an exported (optionally
+                           int8 quantized) .onnx file, CPU only
+        artifact_path: exported file for the non-eager backends.
+        num_threads:   intra-op threads for torch / onnxruntime on CPU.
+        jpeg_draft:    reduced-scale JPEG decoding (see `open_image`).
+        """
         if class_names is None:
             raise ValueError("class_names listesi gereklidir.")
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
+        if backend != "eager" and artifact_path is None:
+            raise ValueError(f"artifact_path is required for the {backend!r} backend.")
 
         self.class_names = class_names
-        self.device = torch.device(device)
+        self.backend = backend
+        self.device = torch.device(device if backend == "eager" else "cpu")
+        self.channels_last = channels_last and backend != "onnx"
+        if num_threads:
+            torch.set_num_threads(num_threads)
 
         # ---------- model ----------
-        self.model = timm.create_model(
-            "convnext_tiny",
-            pretrained=True,
-            num_classes=len(class_names),
-            drop_path_rate=drop_path_rate,
-        )
-        self.model.load_state_dict(torch.load(weights_path, map_location="cpu"))
-        self.model.to(self.device).eval()
+        self.model = None
+        self.session = None
+        if backend == "eager":
+            self.model = load_convnext_tiny(
+                weights_path, len(class_names), drop_path_rate=drop_path_rate
+            )
+            self.model.to(self.device)
+            if self.channels_last:
+                self.model.to(memory_format=torch.channels_last)
+        elif backend == "torchscript":
+            self.model = torch.jit.load(artifact_path, map_location="cpu").eval()
+        else:
+            import onnxruntime as ort
+
+            opts = ort.SessionOptions()
+            opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if num_threads:
+                opts.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(
+                artifact_path, sess_options=opts, providers=["CPUExecutionProvider"]
+            )
+            self._onnx_input = self.session.get_inputs()[0].name
 
         # ---------- transform ----------
-        default_tf = transforms.Compose(
-            [
-                transforms.Resize((224, 224)),
-                transforms.ToTensor(),
-                transforms.Normalize([0.5] * 3, [0.5] * 3),
-            ]
+        self.transform = transform or default_transform()
+        self.draft_size = INPUT_SIZE if jpeg_draft else None
+
+        # identifies (weights, backend, classes, preprocessing) for result caches
+        self.model_version = self._model_version(
+            artifact_path if backend != "eager" else weights_path
         )
-        self.transform = transform or default_tf
+
+    def _model_version(self, path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        h.update("\0".join(self.class_names).encode("utf-8"))
+        h.update(repr((self.transform, self.draft_size)).encode("utf-8"))
+        return f"{self.backend}-{h.hexdigest()[:16]}"
+
+    def _forward(self, batch_tensor: torch.Tensor) -> torch.Tensor:
+        if self.session is not None:
+            logits = self.session.run(None, {self._onnx_input: batch_tensor.numpy()})[0]
+            return torch.from_numpy(logits)
+        if self.channels_last:
+            batch_tensor = batch_tensor.contiguous(memory_format=torch.channels_last)
+        return self.model(batch_tensor)
 
     def _prep(self, img: Image.Image) -> torch.Tensor:
         if img.mode != "RGB":
             img = img.convert("RGB")
         return self.transform(img).unsqueeze(0)
 
-    @torch.no_grad()
     def predict(
         self,
-        imgs: Union[str, Image.Image, List[Union[str, Image.Image]]],
+        imgs: Union[ImageInput, List[ImageInput]],
         top_k: int = 1,
         return_probs: bool = False,
     ):
         if not isinstance(imgs, (list, tuple)):
             imgs = [imgs]
 
-        batch = []
-        for im in imgs:
-            img = Image.open(im) if isinstance(im, (str, bytes)) else im
-            batch.append(self._prep(img))
-        batch_tensor = torch.cat(batch).to(self.device)
+        results = self.predict_batch(imgs, top_k=top_k, return_probs=return_probs)
+        return results[0] if len(results) == 1 else results
 
-        logits = self.model(batch_tensor)
-        probs = torch.softmax(logits, dim=1)
+    @torch.no_grad()
+    def predict_batch(
+        self,
+        imgs: List[ImageInput],
+        top_k: int = 1,
+        return_probs: bool = False,
+    ) -> list:
+        """Like `predict`, but always returns one result per input image."""
+        with span("classifier.preprocess"):
+            batch = []
+            for im in imgs:
+                img = open_image(im, self.draft_size)
+                batch.append(self._prep(img))
+            batch_tensor = torch.cat(batch)
 
-        top_probs, top_idx = torch.topk(probs, k=top_k, dim=1)
-        top_idx, top_probs = top_idx.cpu(), top_probs.cpu()
+        top_idx, top_probs = self.predict_tensor(batch_tensor, top_k=top_k)
 
         results = []
         for idxs, prbs in zip(top_idx, top_probs):
@@ -76,4 +208,14 @@ class ConvNeXtTinyClassifier:
             else:
                 results.append(self.class_names[idxs[0]])
 
-        return results[0] if len(results) == 1 else results
+        return results
+
+    @torch.no_grad()
+    def predict_tensor(self, batch_tensor: torch.Tensor, top_k: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Top-k (class indices, probabilities) on CPU for an already preprocessed NCHW batch."""
+        with span("classifier.forward"):
+            logits = self._forward(batch_tensor.to(self.device, non_blocking=True))
+            probs = torch.softmax(logits, dim=1)
+
+        top_probs, top_idx = torch.topk(probs, k=top_k, dim=1)
+        return top_idx.cpu(), top_probs.cpu()
@@ -0,0 +1,234 @@
+"""
+Bulk classification of a class-folder tree (e.g. dataset/val/<class>/**).
+
+Images are decoded and preprocessed in DataLoader worker processes with
+prefetching while the main process runs large batches through the model;
+top-k predictions stream to JSONL or Parquet, and the run ends with
+images/sec, top-1 accuracy and a confusion matrix. Class indices follow
+`build_class_list` (the training folder order), so labels line up with the
+model's outputs even when a split is missing some classes.
+
+    python -m src.classify_dir --root dataset/val --out val_predictions.jsonl \
+        --batch-size 64 --workers 4 --top-k 3
+
+    # int8 ONNX backend, Parquet output, confusion matrix as CSV
+    python -m src.classify_dir --root dataset/test --out test.parquet \
+        --backend onnx --artifact src/convnext_tiny_int8.onnx --confusion-csv test_confusion.csv
+"""
+import argparse, json, os, time
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from src.classifier import BACKENDS, INPUT_SIZE, ConvNeXtTinyClassifier, build_class_list, open_image
+from src.export_classifier import DEFAULT_WEIGHTS, IMAGE_EXTS
+
+
+class ClassFolderDataset(Dataset):
+    """(tensor, label, index, ok) for every image under root/<class>/**; label -1 for unknown classes."""
+
+    def __init__(self, root: str, class_names: List[str], transform, draft_size=INPUT_SIZE):
+        self.transform = transform
+        self.draft_size = draft_size
+        index = {c: i for i, c in enumerate(class_names)}
+        self.samples = []
+        for class_dir in sorted(p for p in Path(root).iterdir() if p.is_dir()):
+            label = index.get(class_dir.name, -1)
+            for path in sorted(class_dir.rglob("*")):
+                if path.suffix.lower() in IMAGE_EXTS:
+                    self.samples.append((str(path), label))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, i):
+        path, label = self.samples[i]
+        try:
+            img = open_image(path, self.draft_size).convert("RGB")
+            return self.transform(img), label, i, True
+        except Exception:
+            # unreadable file: keep the batch shape, report it instead of killing the run
+            return torch.zeros(3, *INPUT_SIZE), label, i, False
+
+
+class PredictionWriter:
+    """Streams prediction rows to .jsonl, or to .parquet (pyarrow) one row group per batch."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            self._pa = pa
+            self._schema = pa.schema([
+                ("path", pa.string()),
+                ("label", pa.string()),
+                ("pred", pa.string()),
+                ("prob", pa.float32()),
+                ("topk_classes", pa.list_(pa.string())),
+                ("topk_probs", pa.list_(pa.float32())),
+            ])
+            self._writer = pq.ParquetWriter(path, self._schema)
+        else:
+            self._file = open(path, "w")
+
+    def write(self, rows: List[dict]):
+        if not rows:
+            return
+        if self.parquet:
+            self._writer.write_table(self._pa.Table.from_pylist(rows, schema=self._schema))
+        else:
+            for row in rows:
+                self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self.parquet:
+            self._writer.close()
+        else:
+            self._file.close()
+
+
+def format_confusion(cm: np.ndarray, class_names: List[str]) -> str:
+    """Rows = true class, columns = predicted class (column headers are class indices)."""
+    width = max(len(c) for c in class_names)
+    cell = max(4, len(str(int(cm.max()))) + 1)
+    lines = [" " * (width + 3) + "".join(f"{j:>{cell}}" for j in range(len(class_names))) + "   recall"]
+    for i, name in enumerate(class_names):
+        total = cm[i].sum()
+        recall = f"{cm[i, i] / total:8.3f}" if total else f"{'-':>8}"
+        lines.append(f"{i:>2} {name:<{width}}" + "".join(f"{int(v):>{cell}}" for v in cm[i]) + " " + recall)
+    return "\n".join(lines)
+
+
+def run(
+    clf: ConvNeXtTinyClassifier,
+    root: str,
+    out_path: str,
+    batch_size: int = 64,
+    workers: int = 4,
+    prefetch: int = 4,
+    top_k: int = 3,
+    limit: Optional[int] = None,
+) -> dict:
+    names = clf.class_names
+    dataset = ClassFolderDataset(root, names, clf.transform, clf.draft_size)
+    if limit:
+        dataset.samples = dataset.samples[:limit]
+    if not len(dataset):
+        raise SystemExit(f"No images found under {root}")
+
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=workers,
+        prefetch_factor=prefetch if workers else None,
+        persistent_workers=False,
+        pin_memory=clf.device.type == "cuda",
+    )
+    top_k = min(top_k, len(names))
+    confusion = np.zeros((len(names), len(names)), dtype=np.int64)
+    writer = PredictionWriter(out_path)
+    seen, failed, wait_s, model_s = 0, 0, 0.0, 0.0
+
+    started = time.perf_counter()
+    t_wait = started
+    try:
+        for n, (batch, labels, idxs, ok) in enumerate(loader, 1):
+            t_ready = time.perf_counter()
+            wait_s += t_ready - t_wait
+            top_idx, top_probs = clf.predict_tensor(batch, top_k=top_k)
+            model_s += time.perf_counter() - t_ready
+
+            rows = []
+            for j in range(len(idxs)):
+                path, _ = dataset.samples[int(idxs[j])]
+                label = int(labels[j])
+                if not ok[j]:
+                    failed += 1
+                    continue
+                pred = int(top_idx[j, 0])
+                if label >= 0:
+                    confusion[label, pred] += 1
+                rows.append({
+                    "path": path,
+                    "label": names[label] if label >= 0 else Path(path).relative_to(root).parts[0],
+                    "pred": names[pred],
+                    "prob": float(top_probs[j, 0]),
+                    "topk_classes": [names[int(k)] for k in top_idx[j]],
+                    "topk_probs": [float(p) for p in top_probs[j]],
+                })
+            writer.write(rows)
+            seen += len(idxs)
+            if n % 20 == 0:
+                print(f"{seen}/{len(dataset)} images ({seen / (time.perf_counter() - started):.1f} img/s)")
+            t_wait = time.perf_counter()
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - started
+    labelled = int(confusion.sum())
+    return {
+        "images": seen,
+        "failed": failed,
+        "seconds": elapsed,
+        "images_per_sec": seen / elapsed,
+        "loader_wait_s": wait_s,
+        "model_s": model_s,
+        "top1_accuracy": float(np.trace(confusion) / labelled) if labelled else None,
+        "confusion": confusion,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Classify every image in a class-folder tree.")
+    parser.add_argument("--root", required=True, help="<root>/<class>/**/<image>")
+    parser.add_argument("--out", required=True, help="predictions .jsonl or .parquet")
+    parser.add_argument("--classes-root", default="dataset/train", help="folder whose class dirs define the model's class order")
+    parser.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    parser.add_argument("--backend", choices=BACKENDS, default="eager")
+    parser.add_argument("--artifact", default=None)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--prefetch", type=int, default=4, help="batches prefetched per worker")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--confusion-csv", default=None)
+    args = parser.parse_args(argv)
+
+    clf = ConvNeXtTinyClassifier(
+        args.weights,
+        build_class_list(args.classes_root),
+        device=args.device,
+        backend=args.backend,
+        artifact_path=args.artifact,
+        num_threads=args.threads,
+        channels_last=args.backend == "eager",
+    )
+    r = run(clf, args.root, args.out, args.batch_size, args.workers, args.prefetch, args.top_k, args.limit)
+
+    print(f"\nWrote {args.out}")
+    print(
+        f"{r['images']} images in {r['seconds']:.1f}s -> {r['images_per_sec']:.1f} img/s "
+        f"(waiting on loader {r['loader_wait_s']:.1f}s, model {r['model_s']:.1f}s, {r['failed']} unreadable)"
+    )
+    if r["top1_accuracy"] is not None:
+        print(f"top-1 accuracy: {r['top1_accuracy']:.4f}\n")
+        print(format_confusion(r["confusion"], clf.class_names))
+    if args.confusion_csv:
+        names = clf.class_names
+        with open(args.confusion_csv, "w") as f:
+            f.write("true\\pred," + ",".join(names) + "\n")
+            for name, row in zip(names, r["confusion"]):
+                f.write(name + "," + ",".join(str(int(v)) for v in row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
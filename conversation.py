@@ -0,0 +1,83 @@
+"""
+Bounded multi-turn context for the answer prompt.
+
+The web app hands the assistant the chat's text messages not yet covered
+by its summary (oldest first, each with its database id; see
+`summarized_upto`). The newest turns that fit in
+`history_tokens` go into the prompt verbatim; once they no longer fit, the
+older ones are folded into a rolling summary by the LLM. Summaries are
+cached per chat together with the id of the last message they cover, so
+each message is summarized once and the summary only changes when another
+batch is folded in -- folding keeps half the budget free, which keeps the
+prompt prefix stable for several turns.
+"""
+from dataclasses import dataclass
+from typing import Hashable, List, Optional, Tuple
+
+from src.llm import prompt_tokens
+from src.retrieval_session import SessionCache
+
+
+@dataclass
+class ConversationSummary:
+    text: str
+    upto_id: int        # last message id folded into `text`
+
+
+def _turns(messages: List[dict]) -> List[dict]:
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+
+class ConversationMemory:
+    def __init__(self, history_tokens: int = 1024, cache_size: int = 1024, ttl: Optional[float] = 3600.0):
+        self.history_tokens = history_tokens
+        self.summaries = SessionCache(cache_size, ttl)
+
+    def context(self, llm, chat_id: Optional[Hashable], history: List[dict],
+                deadline=None) -> Tuple[Optional[str], List[dict]]:
+        """
+        (summary or None, recent turns as {"role", "content"}) for a prompt.
+        `history` items are {"id", "role", "content"}, oldest first. Without a
+        chat id, or when the deadline leaves no time to summarize, turns that
+        do not fit are simply dropped.
+        """
+        entry = self.summaries.get(chat_id) if chat_id is not None else None
+        summary = entry.text if entry else None
+        pending = [m for m in history if entry is None or m["id"] > entry.upto_id]
+        if prompt_tokens(pending) <= self.history_tokens:
+            return summary, _turns(pending)
+
+        keep = self._newest_within(pending, self.history_tokens // 2)
+        if keep and keep[0]["role"] == "assistant":
+            keep = keep[1:]     # keep whole question/answer turns
+        fold = pending[:len(pending) - len(keep)]
+        if chat_id is None:
+            return summary, _turns(keep)
+        if deadline is not None and not llm.can_summarize(deadline, _turns(fold)):
+            deadline.degrade("history_trimmed", messages=len(fold))
+            return summary, _turns(keep)
+        try:
+            summary = llm.summarize_conversation(summary, _turns(fold), deadline=deadline)
+        except Exception as e:
+            print(f"Conversation summary failed, dropping {len(fold)} older messages: {e}")
+            return summary, _turns(keep)
+        self.summaries.put(chat_id, ConversationSummary(summary, fold[-1]["id"]))
+        return summary, _turns(keep)
+
+    def summarized_upto(self, chat_id: Hashable) -> Optional[int]:
+        """Id of the last message folded into the chat's cached summary, None without one."""
+        entry = self.summaries.peek(chat_id)
+        return entry.upto_id if entry else None
+
+    @staticmethod
+    def _newest_within(messages: List[dict], budget: int) -> List[dict]:
+        kept, used = [], 0
+        for m in reversed(messages):
+            used += prompt_tokens([m])
+            if used > budget:
+                break
+            kept.append(m)
+        return kept[::-1]
+
+    def stats(self) -> dict:
+        return self.summaries.stats()
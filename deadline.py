@@ -0,0 +1,68 @@
+"""
+Per-request latency budgets.
+
+A `Deadline` is created when a chat turn arrives and handed down the
+pipeline (DermatologyAssistant -> RetrievalAugmentedGeneration ->
+MedicalLLMHelper -> OllamaPool). Each stage looks at the time left and
+degrades rather than overrunning: reformulation is skipped when it would
+not leave room for the answer, the answer's num_predict is capped to what
+the measured token rate can produce in time, and queue waits / generations
+stop at the deadline. What was given up is recorded on the deadline (and
+counted in /metrics) so the response can say so.
+
+The clock is time.monotonic(), which is system-wide, so a deadline pickled
+to the inference server on the same machine keeps its meaning.
+"""
+import time
+from typing import Optional
+
+from src.metrics import REGISTRY
+
+DEGRADATIONS = REGISTRY.counter(
+    "derm_degradations_total",
+    "Work skipped or shortened to fit a request deadline.",
+    labelnames=("kind",),
+)
+DEADLINE_EXCEEDED = REGISTRY.counter(
+    "derm_deadline_exceeded_total",
+    "Requests that ran out of budget, by the stage that noticed.",
+    labelnames=("stage",),
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, stage: str):
+        super().__init__(f"Request deadline exceeded during {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self.degradations = []
+
+    @classmethod
+    def start(cls, budget: Optional[float]) -> Optional["Deadline"]:
+        """A deadline `budget` seconds from now; None for no budget (0 / None)."""
+        return cls(budget) if budget else None
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage: str):
+        """Raise DeadlineExceeded if the budget is used up."""
+        if self.expired():
+            self.fail(stage)
+
+    def fail(self, stage: str):
+        """Give up on the request at `stage` (the remaining budget is too small)."""
+        DEADLINE_EXCEEDED.inc(stage=stage)
+        raise DeadlineExceeded(stage)
+
+    def degrade(self, kind: str, **detail):
+        self.degradations.append({"kind": kind, **detail})
+        DEGRADATIONS.inc(kind=kind)
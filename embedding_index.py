@@ -0,0 +1,458 @@
+import argparse, hashlib, json, os, shutil, tempfile, time
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Bump when the on-disk layout changes; old directories are rebuilt automatically.
+INDEX_FORMAT_VERSION = 1
+
+
+def index_key(qa_json_path: str, encoder_name: str) -> str:
+    """
+    Content hash of the knowledge base + encoder name.
+    Any edit to dermatology_qa.json or a different encoder gives a new key.
+    """
+    h = hashlib.sha256()
+    h.update(f"v{INDEX_FORMAT_VERSION}\0{encoder_name}\0".encode("utf-8"))
+    h.update(Path(qa_json_path).read_bytes())
+    return h.hexdigest()
+
+
+class QAEmbeddingIndex:
+    """
+    Precomputed, L2-normalised question/answer embeddings for every
+    disease in dermatology_qa.json.
+
+    Layout on disk:
+        <index_dir>/v<version>-<key[:16]>/
+            meta.json       # encoder, key, per-disease row ranges
+            questions.npy   # (N, dim) float32
+            answers.npy     # (N, dim) float32
+
+    Rows follow the order of `derm_data[disease]["qa_pairs"]`, so row
+    `start + i` belongs to `qa_pairs[i]` of that disease.
+    """
+
+    def __init__(self, path: Path, meta: dict, q_emb: np.ndarray, a_emb: np.ndarray):
+        self.path = path
+        self.meta = meta
+        self.q_emb = q_emb
+        self.a_emb = a_emb
+
+        # row -> (disease, position inside that disease's qa_pairs)
+        self.disease_names = list(meta["diseases"])
+        self.row_disease = np.zeros(len(q_emb), dtype=np.int32)
+        for i, name in enumerate(self.disease_names):
+            start, end = self.disease_rows(name)
+            self.row_disease[start:end] = i
+
+        self._combined = {}     # alpha -> alpha*q + (1-alpha)*a
+        self._ivf = {}          # (alpha, nlist) -> IVFIndex
+
+    # ---------- lookups ----------
+    @property
+    def encoder_name(self) -> str:
+        return self.meta["encoder_name"]
+
+    @property
+    def diseases(self) -> dict:
+        return self.meta["diseases"]
+
+    def __contains__(self, disease: str) -> bool:
+        return disease in self.meta["diseases"]
+
+    def disease_rows(self, disease: str) -> tuple[int, int]:
+        rng = self.meta["diseases"][disease]
+        return rng["start"], rng["end"]
+
+    def disease_embeddings(self, disease: str) -> tuple[np.ndarray, np.ndarray]:
+        start, end = self.disease_rows(disease)
+        return self.q_emb[start:end], self.a_emb[start:end]
+
+    def locate(self, row: int) -> Tuple[str, int]:
+        name = self.disease_names[self.row_disease[row]]
+        return name, int(row - self.meta["diseases"][name]["start"])
+
+    # ---------- search ----------
+    def combined(self, alpha: float) -> np.ndarray:
+        """
+        cos(u, q)*alpha + cos(u, a)*(1-alpha) == u . (alpha*q + (1-alpha)*a)
+        for unit-norm u, so the hybrid score needs a single matrix product.
+        """
+        key = round(float(alpha), 6)
+        if key not in self._combined:
+            self._combined[key] = np.ascontiguousarray(
+                alpha * self.q_emb + (1.0 - alpha) * self.a_emb, dtype=np.float32
+            )
+        return self._combined[key]
+
+    def rows_for(self, classes: Optional[Iterable[str]]) -> Optional[np.ndarray]:
+        """Row ids belonging to `classes` (None = no filter)."""
+        if classes is None:
+            return None
+        ranges = [self.disease_rows(c) for c in classes if c in self]
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(a, b) for a, b in ranges])
+
+    def search(
+        self,
+        query: np.ndarray,
+        classes: Optional[Iterable[str]] = None,
+        top_k: int = 5,
+        alpha: float = 0.7,
+        thresh: Optional[float] = None,
+        mode: str = "exact",
+        nprobe: int = 8,
+        nlist: Optional[int] = None,
+        ann_min_rows: int = 4096,
+    ) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, hybrid score) for a unit-norm query, optionally restricted
+        to one or several diseases. mode="ann" probes an IVF index instead of
+        scoring every candidate row; filtered searches over fewer than
+        `ann_min_rows` rows stay exact, which is both cheaper and lossless.
+        """
+        rows = self.rows_for(classes)
+        if rows is not None and len(rows) == 0:
+            return []
+        if mode == "ann" and rows is not None and len(rows) < ann_min_rows:
+            mode = "exact"
+
+        if mode == "ann":
+            ivf = self.ivf(alpha, nlist)
+            cand, scores = ivf.search(query, nprobe=nprobe, allowed=self.row_disease_mask(classes))
+        elif mode == "exact":
+            mat = self.combined(alpha)
+            cand = rows if rows is not None else np.arange(len(mat))
+            scores = (mat[cand] if rows is not None else mat) @ query
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+
+        if thresh is not None:
+            keep = scores >= thresh
+            cand, scores = cand[keep], scores[keep]
+        order = top_k_order(scores, top_k)
+        return [(int(cand[i]), float(scores[i])) for i in order]
+
+    def search_many(
+        self,
+        queries: np.ndarray,
+        classes: Optional[List[Optional[Iterable[str]]]] = None,
+        top_k: int = 5,
+        alpha: float = 0.7,
+        thresh: Optional[float] = None,
+        exclude: Optional[List[Iterable[int]]] = None,
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Exact search for a (B, dim) batch of unit-norm queries with one
+        matrix product. classes[i] / exclude[i] filter query i's candidates.
+        """
+        scores = queries.astype(np.float32) @ self.combined(alpha).T     # (B, N)
+        results = []
+        for i in range(len(queries)):
+            row_scores = scores[i]
+            if classes is not None and classes[i] is not None:
+                mask = self.row_disease_mask(classes[i])
+                row_scores = np.where(mask, row_scores, -np.inf)
+            if exclude is not None and exclude[i]:
+                row_scores = row_scores.copy()
+                row_scores[list(exclude[i])] = -np.inf
+            valid = np.isfinite(row_scores)
+            if thresh is not None:
+                valid &= row_scores >= thresh
+            cand = np.flatnonzero(valid)
+            order = top_k_order(row_scores[cand], top_k)
+            results.append([(int(cand[j]), float(row_scores[cand[j]])) for j in order])
+        return results
+
+    def row_of(self, disease: str, i: int) -> int:
+        return self.meta["diseases"][disease]["start"] + i
+
+    def row_disease_mask(self, classes: Optional[Iterable[str]]) -> Optional[np.ndarray]:
+        if classes is None:
+            return None
+        mask = np.zeros(len(self.disease_names), dtype=bool)
+        for c in classes:
+            if c in self:
+                mask[self.disease_names.index(c)] = True
+        return mask[self.row_disease]
+
+    def ivf(self, alpha: float = 0.7, nlist: Optional[int] = None) -> "IVFIndex":
+        n = len(self.q_emb)
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        key = (round(float(alpha), 6), nlist)
+        if key not in self._ivf:
+            self._ivf[key] = IVFIndex.build(self.combined(alpha), nlist)
+        return self._ivf[key]
+
+    # ---------- build / load ----------
+    @staticmethod
+    def dir_for(index_dir: str, key: str) -> Path:
+        return Path(index_dir) / f"v{INDEX_FORMAT_VERSION}-{key[:16]}"
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "QAEmbeddingIndex":
+        path = Path(path)
+        with (path / "meta.json").open() as f:
+            meta = json.load(f)
+        mode = "r" if mmap else None
+        q_emb = np.load(path / "questions.npy", mmap_mode=mode)
+        a_emb = np.load(path / "answers.npy", mmap_mode=mode)
+        return cls(path, meta, q_emb, a_emb)
+
+    @classmethod
+    def build(
+        cls,
+        encoder,
+        encoder_name: str,
+        qa_json_path: str,
+        index_dir: str,
+        batch_size: int = 64,
+    ) -> "QAEmbeddingIndex":
+        with Path(qa_json_path).open() as f:
+            derm_data = json.load(f)
+
+        key = index_key(qa_json_path, encoder_name)
+        q_texts, a_texts, diseases = [], [], {}
+        for disease, entry in derm_data.items():
+            start = len(q_texts)
+            for qa in entry["qa_pairs"]:
+                q_texts.append(qa["question"])
+                a_texts.append(qa["answer"])
+            diseases[disease] = {"start": start, "end": len(q_texts)}
+
+        enc_kw = dict(batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        q_emb = np.asarray(encoder.encode(q_texts, **enc_kw), dtype=np.float32)
+        a_emb = np.asarray(encoder.encode(a_texts, **enc_kw), dtype=np.float32)
+
+        meta = {
+            "format_version": INDEX_FORMAT_VERSION,
+            "key": key,
+            "encoder_name": encoder_name,
+            "qa_json": str(qa_json_path),
+            "num_pairs": len(q_texts),
+            "dim": int(q_emb.shape[1]) if q_texts else 0,
+            "diseases": diseases,
+        }
+
+        # write into a temp dir first, then swap in atomically
+        final = cls.dir_for(index_dir, key)
+        final.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix=".build-", dir=final.parent))
+        try:
+            np.save(tmp / "questions.npy", q_emb)
+            np.save(tmp / "answers.npy", a_emb)
+            with (tmp / "meta.json").open("w") as f:
+                json.dump(meta, f, indent=2)
+            if final.exists():
+                shutil.rmtree(final)
+            os.replace(tmp, final)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        cls.prune(index_dir, keep=final)
+        return cls.load(final)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        encoder,
+        encoder_name: str,
+        qa_json_path: str,
+        index_dir: str,
+        force: bool = False,
+    ) -> "QAEmbeddingIndex":
+        """Reuse the index matching (JSON content, encoder); rebuild otherwise."""
+        path = cls.dir_for(index_dir, index_key(qa_json_path, encoder_name))
+        if not force and (path / "meta.json").exists():
+            try:
+                return cls.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Embedding index at {path} unreadable, rebuilding: {e}")
+        return cls.build(encoder, encoder_name, qa_json_path, index_dir)
+
+    @staticmethod
+    def prune(index_dir: str, keep: Optional[Path] = None):
+        """Remove index directories for stale JSON/encoder versions."""
+        for p in Path(index_dir).glob("v*-*"):
+            if p.is_dir() and (keep is None or p.resolve() != keep.resolve()):
+                shutil.rmtree(p, ignore_errors=True)
+
+def top_k_order(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first, via partial selection."""
+    n = len(scores)
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1)[:k]
+    else:
+        part = np.arange(n)
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate search: rows are clustered with spherical
+    k-means and a query only scores rows in its `nprobe` closest clusters.
+    Pure numpy, so it needs no extra dependency; worth it once the knowledge
+    base reaches tens of thousands of pairs.
+    """
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, lists: List[np.ndarray]):
+        self.centroids = centroids
+        self.vectors = vectors
+        self.lists = lists
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, nlist: int, iters: int = 20, seed: int = 0) -> "IVFIndex":
+        rng = np.random.default_rng(seed)
+        n = len(vectors)
+        nlist = min(nlist, n)
+        unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        centroids = unit[rng.choice(n, size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = np.argmax(unit @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = unit[assign == c]
+                if len(members):
+                    v = members.sum(axis=0)
+                    centroids[c] = v / max(np.linalg.norm(v), 1e-12)
+                else:       # re-seed empty clusters
+                    centroids[c] = unit[rng.integers(n)]
+        assign = np.argmax(unit @ centroids.T, axis=1)
+        lists = [np.flatnonzero(assign == c) for c in range(nlist)]
+        return cls(centroids.astype(np.float32), vectors, lists)
+
+    def search(self, query: np.ndarray, nprobe: int = 8, allowed: Optional[np.ndarray] = None):
+        probe = top_k_order(self.centroids @ query, nprobe)
+        cand = np.concatenate([self.lists[c] for c in probe]) if len(probe) else np.empty(0, dtype=np.int64)
+        if allowed is not None:
+            cand = cand[allowed[cand]]
+        return cand, self.vectors[cand] @ query
+
+
+# ---------- benchmark ----------
+def synthetic_index(base: QAEmbeddingIndex, size: int, noise: float = 0.05, seed: int = 0) -> QAEmbeddingIndex:
+    """Grow `base` to `size` rows by jittering existing pairs (keeps disease labels)."""
+    rng = np.random.default_rng(seed)
+    src = rng.integers(0, len(base.q_emb), size=size)
+    src.sort()
+
+    def jitter(m):
+        out = np.asarray(m)[src] + rng.normal(0, noise, (size, m.shape[1])).astype(np.float32)
+        return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+    owners = base.row_disease[src]
+    diseases, start = {}, 0
+    for i, name in enumerate(base.disease_names):
+        end = start + int(np.sum(owners == i))
+        diseases[name] = {"start": start, "end": end}
+        start = end
+    meta = dict(base.meta, diseases=diseases, num_pairs=size)
+    return QAEmbeddingIndex(base.path, meta, jitter(base.q_emb), jitter(base.a_emb))
+
+
+def benchmark_search(
+    index: QAEmbeddingIndex,
+    num_queries: int = 200,
+    top_k: int = 5,
+    alpha: float = 0.7,
+    nprobe: int = 8,
+    num_classes: Optional[int] = None,
+    seed: int = 0,
+) -> dict:
+    """
+    Recall@k and latency of ANN vs exact search. Queries are perturbed
+    knowledge-base questions, standing in for paraphrased user questions.
+    With num_classes, each query is filtered to that many diseases.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(index.q_emb), size=num_queries)
+    queries = np.asarray(index.q_emb)[rows] + rng.normal(0, 0.05, (num_queries, index.q_emb.shape[1]))
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+    index.combined(alpha)
+    t0 = time.perf_counter()
+    index.ivf(alpha)
+    build_s = time.perf_counter() - t0
+
+    lat = {"exact": [], "ann": []}
+    recall = []
+    for row, q in zip(rows, queries):
+        classes = None
+        if num_classes:
+            own = index.disease_names[index.row_disease[row]]
+            others = [c for c in index.disease_names if c != own]
+            picked = rng.choice(len(others), size=min(num_classes - 1, len(others)), replace=False)
+            classes = [own] + [others[i] for i in picked]
+        hits = {}
+        for mode in ("exact", "ann"):
+            t0 = time.perf_counter()
+            hits[mode] = index.search(q, classes=classes, top_k=top_k, alpha=alpha, mode=mode, nprobe=nprobe)
+            lat[mode].append((time.perf_counter() - t0) * 1000.0)
+        exact_rows = {r for r, _ in hits["exact"]}
+        if exact_rows:
+            recall.append(len(exact_rows & {r for r, _ in hits["ann"]}) / len(exact_rows))
+
+    def summary(v):
+        v = sorted(v)
+        return {"mean_ms": float(np.mean(v)), "p50_ms": v[len(v) // 2], "p95_ms": v[int(0.95 * (len(v) - 1))]}
+
+    return {
+        "rows": len(index.q_emb),
+        "queries": num_queries,
+        "top_k": top_k,
+        "nprobe": nprobe,
+        "filter_classes": num_classes,
+        "ivf_build_s": build_s,
+        f"recall@{top_k}": float(np.mean(recall)) if recall else None,
+        "exact": summary(lat["exact"]),
+        "ann": summary(lat["ann"]),
+    }
+
+
+# ---------- CLI ----------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the QA embedding index used by RAG retrieval.")
+    parser.add_argument("--qa-json", default="dataset/dermatology_qa.json")
+    parser.add_argument("--encoder", default="dmis-lab/biobert-base-cased-v1.1")
+    parser.add_argument("--index-dir", default="dataset/qa_index")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--force", action="store_true", help="rebuild even if an up-to-date index exists")
+    parser.add_argument("--bench", action="store_true", help="compare ANN vs exact search on the index")
+    parser.add_argument("--bench-size", type=int, default=None, help="grow the index synthetically to this many rows")
+    parser.add_argument("--bench-queries", type=int, default=200)
+    parser.add_argument("--bench-classes", type=int, default=None, help="filter each query to this many classes")
+    parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    path = QAEmbeddingIndex.dir_for(args.index_dir, index_key(args.qa_json, args.encoder))
+    if args.force or not (path / "meta.json").exists():
+        from sentence_transformers import SentenceTransformer
+        encoder = SentenceTransformer(args.encoder, device=args.device)
+        index = QAEmbeddingIndex.build(
+            encoder, args.encoder, args.qa_json, args.index_dir, batch_size=args.batch_size
+        )
+        print(f"Built index with {index.meta['num_pairs']} pairs at {index.path}")
+    else:
+        print(f"Index is up to date: {path}")
+
+    if args.bench:
+        index = QAEmbeddingIndex.load(path)
+        if args.bench_size:
+            index = synthetic_index(index, args.bench_size)
+        report = benchmark_search(
+            index,
+            num_queries=args.bench_queries,
+            nprobe=args.nprobe,
+            num_classes=args.bench_classes,
+        )
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
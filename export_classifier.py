@@ -0,0 +1,234 @@
+"""
+Export the fine-tuned ConvNeXt-Tiny for CPU inference and check it against
+the eager fp32 model.
+
+    # TorchScript, int8 dynamic quantization of the Linear (MLP) layers
+    python -m src.export_classifier export --format torchscript --quantize dynamic \
+        --out src/convnext_tiny_dermatology_int8.ts
+
+    # ONNX, int8 static quantization calibrated on a folder of images
+    python -m src.export_classifier export --format onnx --quantize static \
+        --calib-dir dataset/val --out src/convnext_tiny_dermatology_int8.onnx
+
+    # top-1 agreement + per-image latency against the eager model
+    python -m src.export_classifier parity --backend onnx \
+        --artifact src/convnext_tiny_dermatology_int8.onnx --images dataset/test
+"""
+import argparse, glob, json, os, shutil, statistics, tempfile, time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from src.classifier import ConvNeXtTinyClassifier, default_transform, load_convnext_tiny
+
+DEFAULT_WEIGHTS = os.path.join("src", "convnext_tiny_dermatology_best.pt")
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def num_classes_from_weights(weights_path: str) -> int:
+    state = torch.load(weights_path, map_location="cpu")
+    return state["head.fc.weight"].shape[0]
+
+
+def list_images(root: str, limit: Optional[int] = None) -> List[str]:
+    paths = sorted(
+        p for p in glob.glob(os.path.join(root, "**", "*"), recursive=True)
+        if p.lower().endswith(IMAGE_EXTS)
+    )
+    return paths[:limit] if limit else paths
+
+
+# ---------- export ----------
+def export_torchscript(model: nn.Module, out: str, quantize: str):
+    if quantize == "dynamic":
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    elif quantize == "static":
+        raise SystemExit("Static quantization is only supported for --format onnx.")
+
+    example = torch.randn(1, 3, 224, 224)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+    traced.save(out)
+
+
+def export_onnx(model: nn.Module, out: str, quantize: str, calib_dir: Optional[str], calib_limit: int):
+    from onnxruntime.quantization import QuantType, quantize_dynamic, quantize_static
+
+    tmp_dir = tempfile.mkdtemp(prefix="convnext-onnx-")
+    fp32_path = out if quantize == "none" else os.path.join(tmp_dir, "model_fp32.onnx")
+    try:
+        torch.onnx.export(
+            model,
+            torch.randn(1, 3, 224, 224),
+            fp32_path,
+            input_names=["pixel_values"],
+            output_names=["logits"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=17,
+        )
+        if quantize == "dynamic":
+            quantize_dynamic(fp32_path, out, weight_type=QuantType.QInt8)
+        elif quantize == "static":
+            if not calib_dir:
+                raise SystemExit("--calib-dir is required for static quantization.")
+            quantize_static(
+                fp32_path,
+                out,
+                _calibration_reader(list_images(calib_dir, calib_limit)),
+                per_channel=True,
+                weight_type=QuantType.QInt8,
+                activation_type=QuantType.QUInt8,
+            )
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _calibration_reader(paths: List[str]):
+    """Feeds preprocessed images to onnxruntime's static calibration."""
+    from onnxruntime.quantization import CalibrationDataReader
+
+    if not paths:
+        raise SystemExit("No calibration images found.")
+    tf = default_transform()
+
+    class _Reader(CalibrationDataReader):
+        def __init__(self):
+            self.rewind()
+
+        def get_next(self):
+            return next(self._it, None)
+
+        def rewind(self):
+            self._it = (
+                {"pixel_values": tf(Image.open(p).convert("RGB")).unsqueeze(0).numpy()}
+                for p in paths
+            )
+
+    return _Reader()
+
+
+# ---------- parity ----------
+def _time_predict(clf: ConvNeXtTinyClassifier, images: List[Image.Image], warmup: int = 3):
+    for im in images[:warmup]:
+        clf.predict_batch([im])
+    top1, lat = [], []
+    for im in images:
+        t0 = time.perf_counter()
+        top1.append(clf.predict_batch([im])[0])
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    return top1, lat
+
+
+def _latency_summary(lat: List[float]) -> dict:
+    s = sorted(lat)
+    return {
+        "mean_ms": statistics.fmean(s),
+        "p50_ms": s[len(s) // 2],
+        "p95_ms": s[min(len(s) - 1, int(0.95 * len(s)))],
+    }
+
+
+def parity_check(
+    weights_path: str,
+    backend: str,
+    artifact: str,
+    image_dir: str,
+    limit: Optional[int] = None,
+    num_threads: Optional[int] = None,
+    channels_last: bool = False,
+) -> dict:
+    paths = list_images(image_dir, limit)
+    if not paths:
+        raise SystemExit(f"No images found in {image_dir}")
+    # decode once so both models are timed on inference + preprocessing only
+    images = [Image.open(p).convert("RGB") for p in paths]
+    class_names = [str(i) for i in range(num_classes_from_weights(weights_path))]
+
+    ref = ConvNeXtTinyClassifier(
+        weights_path, class_names, device="cpu", num_threads=num_threads
+    )
+    cand = ConvNeXtTinyClassifier(
+        weights_path,
+        class_names,
+        device="cpu",
+        backend=backend,
+        artifact_path=artifact,
+        channels_last=channels_last,
+        num_threads=num_threads,
+    )
+
+    ref_top1, ref_lat = _time_predict(ref, images)
+    cand_top1, cand_lat = _time_predict(cand, images)
+    agree = sum(a == b for a, b in zip(ref_top1, cand_top1))
+
+    ref_stats, cand_stats = _latency_summary(ref_lat), _latency_summary(cand_lat)
+    return {
+        "images": len(images),
+        "backend": backend,
+        "artifact": artifact,
+        "artifact_mb": os.path.getsize(artifact) / 2**20,
+        "top1_agreement": agree / len(images),
+        "eager": ref_stats,
+        "candidate": cand_stats,
+        "speedup": ref_stats["mean_ms"] / cand_stats["mean_ms"],
+    }
+
+
+# ---------- CLI ----------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export / validate CPU backends for the ConvNeXt-Tiny classifier.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    ex = sub.add_parser("export", help="write a TorchScript or ONNX artifact")
+    ex.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    ex.add_argument("--format", choices=("torchscript", "onnx"), default="onnx")
+    ex.add_argument("--quantize", choices=("none", "dynamic", "static"), default="dynamic")
+    ex.add_argument("--calib-dir", default=None, help="images for static quantization")
+    ex.add_argument("--calib-limit", type=int, default=200)
+    ex.add_argument("--out", required=True)
+
+    pc = sub.add_parser("parity", help="compare an exported backend with the eager model")
+    pc.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    pc.add_argument("--backend", choices=("torchscript", "onnx"), required=True)
+    pc.add_argument("--artifact", required=True)
+    pc.add_argument("--images", required=True)
+    pc.add_argument("--limit", type=int, default=None)
+    pc.add_argument("--threads", type=int, default=None)
+    pc.add_argument("--channels-last", action="store_true")
+    pc.add_argument("--json", default=None, help="also write the report to this file")
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "export":
+        model = load_convnext_tiny(
+            args.weights, num_classes_from_weights(args.weights), pretrained=False
+        )
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        if args.format == "torchscript":
+            export_torchscript(model, args.out, args.quantize)
+        else:
+            export_onnx(model, args.out, args.quantize, args.calib_dir, args.calib_limit)
+        print(f"Wrote {args.out} ({os.path.getsize(args.out) / 2**20:.1f} MB)")
+        return
+
+    report = parity_check(
+        args.weights,
+        args.backend,
+        args.artifact,
+        args.images,
+        limit=args.limit,
+        num_threads=args.threads,
+        channels_last=args.channels_last,
+    )
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""
+Generate the dermatology Q/A dataset from labelled images with a vision LLM.
+
+Replaces the one-image-at-a-time loop in data_generator.ipynb:
+
+- requests run concurrently (asyncio) under token-bucket limits on
+  requests/min and tokens/min instead of a fixed sleep(60),
+- images are downscaled and re-encoded as JPEG before base64 encoding,
+- every finished image is recorded in a JSONL manifest, so a rerun only
+  does what is missing (no folder listing to decide what's done),
+- transient errors are retried with backoff; BadRequestError (e.g. the
+  content filter rejecting an image) is skipped, retried or fatal per
+  --on-bad-request,
+- `merge` builds dermatology_qa.json ({disease: {description, qa_pairs}}).
+
+    python -m src.generate_qa generate --images-dir ./facial_diseases --rpm 30 --concurrency 4
+    python -m src.generate_qa merge --images-dir ./facial_diseases --out dataset/dermatology_qa.json
+
+Point it at any OpenAI-compatible server with --base-url; `stub-server`
+starts a local one that returns canned answers (and optional injected
+400/429 errors) for trying the pipeline without an Azure deployment:
+
+    python -m src.generate_qa stub-server --port 8089 --bad-request-rate 0.1 &
+    python -m src.generate_qa generate --images-dir ./facial_diseases --base-url http://127.0.0.1:8089/v1
+"""
+import argparse, asyncio, base64, io, json, os, random, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Optional
+
+from PIL import Image
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+EXAMPLE_JSON = {
+    "description": "",
+    "q_a": [{"question": "", "answer": ""} for _ in range(5)],
+}
+
+PROMPT = (
+    "Provide a valid JSON output. You know that the provided image contains {disease} disease. "
+    "Provide a detailed description of the image and create 5 questions with their answers about the description."
+)
+
+
+# ---------------- rate limiting ----------------
+class TokenBucket:
+    """`rate` tokens per second refill up to `capacity`; `acquire(n)` waits until n are available."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def per_minute(cls, amount: Optional[float], burst: Optional[float] = None) -> Optional["TokenBucket"]:
+        if not amount:
+            return None
+        return cls(amount / 60.0, burst or amount)
+
+    async def acquire(self, n: float = 1.0):
+        n = min(n, self.capacity)
+        async with self._lock:      # FIFO: later callers wait behind the one refilling
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                await asyncio.sleep((n - self._tokens) / self.rate)
+
+
+# ---------------- images ----------------
+def image_to_data_url(path: str, max_side: int = 768, quality: int = 85) -> str:
+    """Downscale so the longer side is <= max_side and re-encode as JPEG."""
+    img = Image.open(path)
+    img.draft("RGB", (max_side, max_side))     # cheap reduced-scale decode for big JPEGs
+    img = img.convert("RGB")
+    img.thumbnail((max_side, max_side), Image.BICUBIC)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def estimate_tokens(prompt: str, max_tokens: int, detail: str) -> int:
+    # ~4 characters per text token; gpt-4o bills a low-detail image as 85
+    # tokens and a high-detail <=768px image as at most 4 tiles * 170 + 85
+    image_tokens = 85 if detail == "low" else 765
+    return len(prompt) // 4 + image_tokens + max_tokens
+
+
+def list_images(images_dir: str) -> list:
+    """[(disease, image path)] for <images_dir>/<disease>/<image>, in a stable order."""
+    root = Path(images_dir)
+    items = []
+    for disease_dir in sorted(p for p in root.iterdir() if p.is_dir()):
+        for img in sorted(disease_dir.iterdir(), key=lambda p: natural_key(p.name)):
+            if img.suffix.lower() in IMAGE_EXTS:
+                items.append((disease_dir.name, img))
+    return items
+
+
+def natural_key(name: str):
+    return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", name)]
+
+
+# ---------------- manifest ----------------
+def _repair_tail(path: str):
+    """Drop a half-written last line left by an interrupted run."""
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def load_manifest(path: str) -> dict:
+    """image path -> last manifest record."""
+    records = {}
+    if not os.path.exists(path):
+        return records
+    _repair_tail(path)
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[rec["image"]] = rec
+    return records
+
+
+# ---------------- generation ----------------
+class Generator:
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.requests = TokenBucket.per_minute(args.rpm)
+        self.tokens = TokenBucket.per_minute(args.tpm)
+        self.counters = {"done": 0, "skipped": 0, "failed": 0, "retries": 0}
+
+    async def call(self, prompt: str, data_url: str) -> dict:
+        a = self.args
+        if self.requests:
+            await self.requests.acquire()
+        if self.tokens:
+            await self.tokens.acquire(estimate_tokens(prompt, a.max_tokens, a.detail))
+        response = await self.client.chat.completions.create(
+            model=a.model,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": "Provide valid JSON output. The data scheme should be like this: " + json.dumps(EXAMPLE_JSON)},
+                {"role": "user", "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": data_url, "detail": a.detail}},
+                ]},
+            ],
+            max_tokens=a.max_tokens,
+        )
+        data = json.loads(response.choices[0].message.content)
+        if not isinstance(data.get("description"), str) or not isinstance(data.get("q_a"), list):
+            raise ValueError("response does not follow the description/q_a schema")
+        return data
+
+    async def process(self, disease: str, img: Path) -> dict:
+        import openai
+
+        a = self.args
+        transient = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                     openai.InternalServerError, json.JSONDecodeError, ValueError)
+        prompt = PROMPT.format(disease=disease)
+        data_url = await asyncio.to_thread(image_to_data_url, str(img), a.max_side, a.jpeg_quality)
+        out_path = img.with_suffix(".json")
+
+        bad_requests = 0
+        error = None
+        for attempt in range(a.retries + 1):
+            try:
+                data = await self.call(prompt, data_url)
+            except openai.BadRequestError as e:
+                error = e
+                bad_requests += 1
+                if a.on_bad_request == "fail":
+                    raise
+                if a.on_bad_request == "skip" or bad_requests > a.bad_request_retries:
+                    # sometimes images are flagged by the content filter; move on
+                    return {"status": "skipped", "error": f"BadRequestError: {e}", "attempts": attempt + 1}
+            except transient as e:
+                error = e
+                if attempt >= a.retries:
+                    return {"status": "failed", "error": f"{type(e).__name__}: {e}", "attempts": attempt + 1}
+            else:
+                tmp = out_path.with_suffix(".json.tmp")
+                tmp.write_text(json.dumps(data, indent=4))
+                os.replace(tmp, out_path)
+                return {"status": "done", "output": str(out_path), "attempts": attempt + 1}
+            if attempt < a.retries:
+                self.counters["retries"] += 1
+                await asyncio.sleep(min(a.max_backoff, a.backoff * 2 ** attempt) * random.uniform(0.5, 1.0))
+        return {"status": "failed", "error": f"{type(error).__name__}: {error}", "attempts": a.retries + 1}
+
+    async def run(self, todo: list, manifest_path: str):
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in todo:
+            queue.put_nowait(item)
+        started = time.perf_counter()
+
+        with open(manifest_path, "a") as manifest:
+            async def worker():
+                while True:
+                    try:
+                        disease, img = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    t0 = time.perf_counter()
+                    rec = await self.process(disease, img)
+                    rec.update(image=str(img), disease=disease, seconds=round(time.perf_counter() - t0, 2), ts=time.time())
+                    manifest.write(json.dumps(rec) + "\n")
+                    manifest.flush()
+                    self.counters[rec["status"]] += 1
+                    finished = sum(self.counters[k] for k in ("done", "skipped", "failed"))
+                    rate = finished / (time.perf_counter() - started)
+                    print(f"[{finished}/{len(todo)}] {rec['status']:<7} {img} ({rate * 60:.1f} images/min)")
+
+            await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+
+def make_client(args):
+    import openai
+
+    if args.base_url:
+        return openai.AsyncOpenAI(base_url=args.base_url, api_key=args.api_key or "stub", max_retries=0)
+    return openai.AsyncAzureOpenAI(
+        api_key=args.api_key,
+        api_version=args.api_version,
+        azure_endpoint=args.azure_endpoint,
+        max_retries=0,      # retries are handled here, with the rate limiter in the loop
+    )
+
+
+def generate(args):
+    manifest_path = args.manifest or os.path.join(args.images_dir, "generation_manifest.jsonl")
+    records = load_manifest(manifest_path)
+    finished = {"done", "skipped"} if not args.retry_skipped else {"done"}
+    todo = []
+    for d, img in list_images(args.images_dir):
+        rec = records.get(str(img))
+        if rec is None:
+            if img.with_suffix(".json").exists():
+                continue    # written before the manifest existed (e.g. by the notebook)
+        elif rec["status"] in finished:
+            continue
+        todo.append((d, img))
+    todo = todo[:args.limit]
+    print(f"{len(records)} images in manifest, {len(todo)} to generate")
+    if not todo:
+        return
+    gen = Generator(make_client(args), args)
+    asyncio.run(gen.run(todo, manifest_path))
+    print(json.dumps(gen.counters))
+
+
+# ---------------- merge ----------------
+def merge(images_dir: str, out_path: str) -> dict:
+    """
+    Combine per-image JSON files into {disease: {"description", "qa_pairs"}}.
+    A disease's description is taken from its first image (natural order);
+    its qa_pairs are the Q/A pairs of all images, in order.
+    """
+    merged = {}
+    for disease, img in list_images(images_dir):
+        path = img.with_suffix(".json")      # written atomically, so present means complete
+        if not path.exists():
+            continue
+        try:
+            data = json.loads(path.read_text())
+        except json.JSONDecodeError:
+            print(f"Skipping unreadable {path}")
+            continue
+        entry = merged.setdefault(disease, {"description": data.get("description", ""), "qa_pairs": []})
+        for qa in data.get("q_a", []):
+            if qa.get("question") and qa.get("answer"):
+                entry["qa_pairs"].append({"question": qa["question"], "answer": qa["answer"]})
+
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(out_path, "w") as f:
+        json.dump(merged, f, indent=2, ensure_ascii=False)
+    print(f"Wrote {out_path}: " + ", ".join(f"{d} ({len(e['qa_pairs'])})" for d, e in merged.items()))
+    return merged
+
+
+# ---------------- stub server ----------------
+def describe_reply(body: dict) -> str:
+    """Canned description/q_a JSON for the disease named in the prompt."""
+    text = body["messages"][-1]["content"][0]["text"]
+    disease = text.split("contains ", 1)[-1].split(" disease", 1)[0]
+    return json.dumps({
+        "description": f"A close-up image showing {disease}.",
+        "q_a": [{"question": f"Question {i} about {disease}?", "answer": f"Answer {i}."} for i in range(1, 6)],
+    })
+
+
+def make_stub_handler(bad_request_rate: float = 0.0, rate_limit_rate: float = 0.0, latency: float = 0.0,
+                      reply=describe_reply):
+    class StubHandler(BaseHTTPRequestHandler):
+        """Minimal OpenAI-compatible /chat/completions; `reply(request body)` makes the content."""
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if latency:
+                time.sleep(latency)
+            roll = random.random()
+            if roll < bad_request_rate:
+                return self._send(400, {"error": {"message": "content filter triggered", "type": "invalid_request_error", "code": "content_filter"}})
+            if roll < bad_request_rate + rate_limit_rate:
+                return self._send(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}})
+            content = reply(body)
+            self._send(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()),
+                "model": body.get("model", "stub"),
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+        def _send(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+def serve_stub(host: str = "127.0.0.1", port: int = 8089, **kw) -> ThreadingHTTPServer:
+    """Start the stub server in a background thread; returns it (call .shutdown() to stop)."""
+    server = ThreadingHTTPServer((host, port), make_stub_handler(**kw))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate and merge the dermatology Q/A dataset.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    g = sub.add_parser("generate", help="describe every image and write <image>.json next to it")
+    g.add_argument("--images-dir", default="./facial_diseases", help="<dir>/<disease>/<image>")
+    g.add_argument("--manifest", default=None, help="default: <images-dir>/generation_manifest.jsonl")
+    g.add_argument("--model", default="gpt-4o", help="model / Azure deployment name")
+    g.add_argument("--base-url", default=None, help="OpenAI-compatible endpoint (instead of Azure)")
+    g.add_argument("--azure-endpoint", default=os.environ.get("AZURE_OPENAI_ENDPOINT"))
+    g.add_argument("--api-version", default="2024-05-01-preview")
+    g.add_argument("--api-key", default=os.environ.get("AZURE_OPENAI_API_KEY") or os.environ.get("OPENAI_API_KEY"))
+    g.add_argument("--concurrency", type=int, default=4)
+    g.add_argument("--rpm", type=float, default=30, help="requests per minute (0 = unlimited)")
+    g.add_argument("--tpm", type=float, default=0, help="estimated tokens per minute (0 = unlimited)")
+    g.add_argument("--max-tokens", type=int, default=2000)
+    g.add_argument("--max-side", type=int, default=768, help="downscale images so the longer side fits")
+    g.add_argument("--jpeg-quality", type=int, default=85)
+    g.add_argument("--detail", choices=("low", "high", "auto"), default="high")
+    g.add_argument("--retries", type=int, default=4)
+    g.add_argument("--backoff", type=float, default=2.0)
+    g.add_argument("--max-backoff", type=float, default=60.0)
+    g.add_argument("--on-bad-request", choices=("skip", "retry", "fail"), default="skip")
+    g.add_argument("--bad-request-retries", type=int, default=1, help="with --on-bad-request retry")
+    g.add_argument("--retry-skipped", action="store_true", help="also redo images skipped earlier")
+    g.add_argument("--limit", type=int, default=None)
+
+    m = sub.add_parser("merge", help="build dermatology_qa.json from the per-image files")
+    m.add_argument("--images-dir", default="./facial_diseases")
+    m.add_argument("--out", default="dataset/dermatology_qa.json")
+
+    s = sub.add_parser("stub-server", help="local OpenAI-compatible server with canned answers")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=8089)
+    s.add_argument("--bad-request-rate", type=float, default=0.0)
+    s.add_argument("--rate-limit-rate", type=float, default=0.0)
+    s.add_argument("--latency", type=float, default=0.0, help="seconds per response")
+
+    args = parser.parse_args(argv)
+    if args.cmd == "generate":
+        generate(args)
+    elif args.cmd == "merge":
+        merge(args.images_dir, args.out)
+    else:
+        server = serve_stub(args.host, args.port, bad_request_rate=args.bad_request_rate,
+                            rate_limit_rate=args.rate_limit_rate, latency=args.latency)
+        print(f"Stub OpenAI server on http://{args.host}:{args.port}/v1")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Run one `DermatologyAssistant` in its own process and let web workers call
+it over a local Unix socket, so the models are loaded (and classifier
+requests batched) once per machine instead of once per WSGI worker.
+
+    INFERENCE_SOCKET=/tmp/derm-inference.sock flask --app app inference-server
+    INFERENCE_SOCKET=/tmp/derm-inference.sock gunicorn -w 4 app:app
+
+With INFERENCE_SOCKET set, app.py talks to the server through
+`InferenceClient`, which has the same methods as the assistant.
+"""
+import os, queue, socket, threading
+from multiprocessing.connection import Client, Listener
+from typing import Optional
+
+from src.metrics import REGISTRY, span
+
+# Methods forwarded to the assistant; everything else is rejected
+METHODS = (
+    "predict_image",
+    "predict_image_topk",
+    "classify",
+    "get_rag_context",
+    "generate_response",
+    "batching_stats",
+    "cache_stats",
+    "llm_cache_stats",
+    "llm_pool_stats",
+    "session_stats",
+    "conversation_stats",
+    "summarized_upto",
+    "query_cache_stats",
+    "status",
+    "is_ready",
+)
+STREAM_METHODS = ("generate_response_stream",)
+
+
+class RemoteError(Exception):
+    """An exception raised by the assistant inside the inference server."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(f"{kind}: {message}")
+        self.kind = kind
+
+
+class InferenceServer:
+    """
+    Serves `assistant` on `socket_path`. Each client connection gets its own
+    thread, so concurrent web requests reach the assistant concurrently and
+    its micro-batcher / LLM pool see the combined load of every worker.
+
+    Messages are pickled (multiprocessing.connection); the socket is created
+    with 0600 permissions, and `authkey` adds an HMAC handshake on top.
+    Degradations recorded on a call's `deadline` kwarg travel back to the
+    caller's Deadline in a "degraded" message before the result.
+    """
+
+    def __init__(self, assistant, socket_path: str, authkey: Optional[bytes] = None):
+        self.assistant = assistant
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self._listener = None
+        self._closed = threading.Event()
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)     # stale socket from a previous run
+        old_umask = os.umask(0o177)
+        try:
+            self._listener = Listener(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(old_umask)
+        print(f"Inference server listening on {self.socket_path}")
+        try:
+            while not self._closed.is_set():
+                try:
+                    conn = self._listener.accept()
+                except (OSError, EOFError) as e:
+                    if self._closed.is_set():
+                        break
+                    print(f"Inference server: rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self):
+        self._closed.set()
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                deadline = kwargs.get("deadline")
+                seen = len(deadline.degradations) if deadline is not None else 0
+                try:
+                    if method in STREAM_METHODS:
+                        for chunk in getattr(self.assistant, method)(*args, **kwargs):
+                            conn.send(("chunk", chunk))
+                        self._send_degradations(conn, deadline, seen)
+                        conn.send(("end", None))
+                    elif method in METHODS:
+                        result = getattr(self.assistant, method)(*args, **kwargs)
+                        self._send_degradations(conn, deadline, seen)
+                        conn.send(("ok", result))
+                    elif method == "render_metrics":
+                        conn.send(("ok", REGISTRY.render()))
+                    else:
+                        conn.send(("err", ("AttributeError", f"method not exposed: {method}")))
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                except Exception as e:
+                    try:
+                        conn.send(("err", (type(e).__name__, str(e))))
+                    except OSError:
+                        return
+
+    @staticmethod
+    def _send_degradations(conn, deadline, seen):
+        if deadline is not None and len(deadline.degradations) > seen:
+            conn.send(("degraded", deadline.degradations[seen:]))
+
+
+class InferenceClient:
+    """
+    Drop-in stand-in for `DermatologyAssistant` in a web worker. Keeps up
+    to `pool_size` idle connections to the server; a call borrows one for
+    its duration (a stream keeps it until the last chunk).
+    """
+
+    def __init__(self, socket_path: str, authkey: Optional[bytes] = None, pool_size: int = 8,
+                 timeout: Optional[float] = 300.0):
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+
+    def __getattr__(self, name):
+        if name in METHODS:
+            return lambda *args, **kwargs: self._call(name, args, kwargs)
+        if name in STREAM_METHODS:
+            return lambda *args, **kwargs: self._stream(name, args, kwargs)
+        raise AttributeError(name)
+
+    def render_metrics(self) -> str:
+        """The server process's own /metrics text (stage histograms, LLM pool, ...)."""
+        return self._call("render_metrics", (), {})
+
+    # ------------- connections -------------
+    def _connect(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return Client(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _recv(self, conn, deadline=None):
+        while True:
+            if self.timeout is not None and not conn.poll(self.timeout):
+                raise socket.timeout(f"inference server did not answer within {self.timeout}s")
+            status, payload = conn.recv()
+            if status == "err":
+                raise RemoteError(*payload)
+            if status != "degraded":
+                return status, payload
+            if deadline is not None:
+                deadline.degradations.extend(payload)
+
+    # ------------- calls -------------
+    def _call(self, method, args, kwargs):
+        with span(f"rpc.{method}"):
+            conn = self._connect()
+            try:
+                conn.send((method, args, kwargs))
+                _, value = self._recv(conn, kwargs.get("deadline"))
+            except RemoteError:
+                self._release(conn)     # the connection itself is still in sync
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            self._release(conn)
+            return value
+
+    def _stream(self, method, args, kwargs):
+        conn = self._connect()
+        finished = False
+        try:
+            conn.send((method, args, kwargs))
+            while True:
+                status, chunk = self._recv(conn, kwargs.get("deadline"))
+                if status == "end":
+                    finished = True
+                    return
+                yield chunk
+        except RemoteError:
+            finished = True
+            raise
+        finally:
+            # a stream abandoned half-way leaves unread chunks on the connection
+            if finished:
+                self._release(conn)
+            else:
+                conn.close()
@@ -0,0 +1,143 @@
+import threading, time, queue, uuid, traceback
+from typing import Any, Callable, Optional
+
+
+class QueueFull(Exception):
+    """Raised by `JobQueue.submit` when the bounded queue is at capacity."""
+
+
+class Job:
+    __slots__ = ("id", "owner", "status", "result", "error",
+                 "created_at", "started_at", "finished_at", "fn", "args", "kwargs")
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict, owner: Any = None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.status = "queued"          # queued -> running -> done | failed
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+
+    def to_dict(self) -> dict:
+        d = {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.started_at:
+            d["queue_wait_ms"] = round((self.started_at - self.created_at) * 1000, 1)
+        if self.finished_at and self.started_at:
+            d["run_ms"] = round((self.finished_at - self.started_at) * 1000, 1)
+        if self.status == "done":
+            d["result"] = self.result
+        elif self.status == "failed":
+            d["error"] = self.error
+        return d
+
+
+class JobQueue:
+    """
+    Bounded in-process job queue with a fixed pool of worker threads.
+
+    Everything lives in this process (no broker or external service):
+    `submit` raises `QueueFull` once `max_queue` jobs are waiting, which the
+    caller turns into backpressure (HTTP 503). Finished jobs are kept for
+    `result_ttl` seconds so clients can poll for the result.
+    """
+
+    def __init__(self, num_workers: int = 2, max_queue: int = 32, result_ttl: float = 600.0, name: str = "jobs"):
+        self.name = name
+        self.result_ttl = result_ttl
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue(maxsize=max_queue)
+        self._jobs: dict = {}
+        self._lock = threading.Lock()
+        self._running = 0
+        self._counters = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0}
+
+        self._workers = [
+            threading.Thread(target=self._run, name=f"{name}-worker-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for t in self._workers:
+            t.start()
+
+    # ------------- public API -------------
+    def submit(self, fn: Callable, *args, owner: Any = None, **kwargs) -> Job:
+        job = Job(fn, args, kwargs, owner=owner)
+        with self._lock:
+            self._prune()
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self._counters["rejected"] += 1
+                raise QueueFull(f"{self.name}: {self._queue.maxsize} jobs already queued")
+            self._jobs[job.id] = job
+            self._counters["submitted"] += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> Optional[int]:
+        """1-based position among queued jobs, None once it has started."""
+        if job.status != "queued":
+            return None
+        with self._lock:
+            queued = sorted(
+                (j for j in self._jobs.values() if j.status == "queued"),
+                key=lambda j: j.created_at,
+            )
+        return next((i + 1 for i, j in enumerate(queued) if j.id == job.id), None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "workers": len(self._workers),
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+                "running": self._running,
+                **self._counters,
+            }
+
+    def shutdown(self, timeout: Optional[float] = None):
+        for _ in self._workers:
+            self._queue.put(None)
+        for t in self._workers:
+            t.join(timeout)
+
+    # ------------- worker -------------
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                self._running += 1
+            job.status = "running"
+            job.started_at = time.time()
+            try:
+                job.result = job.fn(*job.args, **job.kwargs)
+                job.status = "done"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+                print(f"Job {job.id} failed: {e}\n{traceback.format_exc()}")
+            finally:
+                job.finished_at = time.time()
+                job.fn = job.args = job.kwargs = None
+                with self._lock:
+                    self._running -= 1
+                    self._counters[job.status] += 1
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        stale = [jid for jid, j in self._jobs.items() if j.finished_at and j.finished_at < cutoff]
+        for jid in stale:
+            del self._jobs[jid]
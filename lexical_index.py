@@ -0,0 +1,285 @@
+"""
+Precomputed BM25 index over the knowledge base's Q/A texts.
+
+Questions and answers are indexed as two fields with the same rows as
+QAEmbeddingIndex (row `start + i` is `qa_pairs[i]` of a disease), so the
+lexical score mirrors the dense hybrid score:
+
+    alpha * BM25(query, question) + (1 - alpha) * BM25(query, answer)
+
+Each field is a term -> postings CSR matrix whose values are the finished
+BM25 term weights (idf and length normalisation folded in at build time),
+so scoring a query is one vectorised add per query term -- no encoder, no
+pass over the documents. Built next to the embedding index and keyed by
+the JSON content only; it does not depend on the encoder.
+
+    python -m src.lexical_index --qa-json dataset/dermatology_qa.json
+"""
+import argparse, hashlib, json, os, re, shutil, tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from src.embedding_index import top_k_order
+
+# Bump when the on-disk layout or the tokenizer changes.
+LEXICAL_FORMAT_VERSION = 1
+FIELDS = ("questions", "answers")
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can could did do does for from had has have how i if in into is it "
+    "its me my of on or should so than that the their them then there these they this to was we what "
+    "when where which while who why will with would you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased alphanumeric words, stopwords and single characters dropped."""
+    return [t for t in TOKEN_RE.findall(text.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+def lexical_key(qa_json_path: str, k1: float, b: float) -> str:
+    h = hashlib.sha256()
+    h.update(f"bm25-v{LEXICAL_FORMAT_VERSION}\0{k1}\0{b}\0".encode("utf-8"))
+    h.update(Path(qa_json_path).read_bytes())
+    return h.hexdigest()
+
+
+class BM25Index:
+    """
+    Layout on disk:
+        <index_dir>/bm25-v<version>-<key[:16]>/
+            meta.json                   # params, key, per-disease row ranges
+            vocab.json                  # term list, position = term id
+            <field>_indptr.npy          # (V+1,) int64
+            <field>_rows.npy            # (nnz,) int32, rows containing the term
+            <field>_weights.npy         # (nnz,) float32, BM25 weight of the term in that row
+    """
+
+    def __init__(self, path: Path, meta: dict, vocab: List[str], postings: dict):
+        self.path = path
+        self.meta = meta
+        self.term_ids = {t: i for i, t in enumerate(vocab)}
+        self.postings = postings        # field -> (indptr, rows, weights)
+        self.num_rows = meta["num_pairs"]
+
+        self.disease_names = list(meta["diseases"])
+        self.row_disease = np.zeros(self.num_rows, dtype=np.int32)
+        for i, name in enumerate(self.disease_names):
+            start, end = self.disease_rows(name)
+            self.row_disease[start:end] = i
+
+    # ---------- lookups (same row layout as QAEmbeddingIndex) ----------
+    def __contains__(self, disease: str) -> bool:
+        return disease in self.meta["diseases"]
+
+    def disease_rows(self, disease: str) -> Tuple[int, int]:
+        rng = self.meta["diseases"][disease]
+        return rng["start"], rng["end"]
+
+    def locate(self, row: int) -> Tuple[str, int]:
+        name = self.disease_names[self.row_disease[row]]
+        return name, int(row - self.meta["diseases"][name]["start"])
+
+    def row_of(self, disease: str, i: int) -> int:
+        return self.meta["diseases"][disease]["start"] + i
+
+    def rows_for(self, classes: Optional[Iterable[str]]) -> Optional[np.ndarray]:
+        if classes is None:
+            return None
+        ranges = [self.disease_rows(c) for c in classes if c in self]
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(a, b) for a, b in ranges])
+
+    # ---------- scoring ----------
+    def scores(self, query: str, alpha: float = 0.7) -> np.ndarray:
+        """(N,) lexical hybrid score of every row; 0 for rows sharing no term."""
+        out = np.zeros(self.num_rows, dtype=np.float32)
+        terms = [self.term_ids[t] for t in set(tokenize(query)) if t in self.term_ids]
+        for field, weight in zip(FIELDS, (alpha, 1.0 - alpha)):
+            if not weight:
+                continue
+            indptr, rows, weights = self.postings[field]
+            for t in terms:
+                a, b = indptr[t], indptr[t + 1]
+                out[rows[a:b]] += weight * weights[a:b]     # rows within one term are unique
+        return out
+
+    def search(
+        self,
+        query: str,
+        classes: Optional[Iterable[str]] = None,
+        top_k: int = 5,
+        alpha: float = 0.7,
+        rows: Optional[np.ndarray] = None,
+    ) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, BM25 score) among rows matching at least one query term,
+        restricted to `classes` or to explicit `rows`.
+        """
+        scores = self.scores(query, alpha)
+        cand = rows if rows is not None else self.rows_for(classes)
+        if cand is None:
+            cand = np.arange(self.num_rows)
+        cand_scores = scores[cand]
+        keep = cand_scores > 0
+        cand, cand_scores = cand[keep], cand_scores[keep]
+        order = top_k_order(cand_scores, top_k)
+        return [(int(cand[i]), float(cand_scores[i])) for i in order]
+
+    # ---------- build / load ----------
+    @staticmethod
+    def dir_for(index_dir: str, key: str) -> Path:
+        return Path(index_dir) / f"bm25-v{LEXICAL_FORMAT_VERSION}-{key[:16]}"
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "BM25Index":
+        path = Path(path)
+        with (path / "meta.json").open() as f:
+            meta = json.load(f)
+        with (path / "vocab.json").open() as f:
+            vocab = json.load(f)
+        mode = "r" if mmap else None
+        postings = {
+            field: tuple(np.load(path / f"{field}_{part}.npy", mmap_mode=mode) for part in ("indptr", "rows", "weights"))
+            for field in FIELDS
+        }
+        return cls(path, meta, vocab, postings)
+
+    @classmethod
+    def build(cls, qa_json_path: str, index_dir: str, k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        with Path(qa_json_path).open() as f:
+            derm_data = json.load(f)
+
+        key = lexical_key(qa_json_path, k1, b)
+        texts = {field: [] for field in FIELDS}
+        diseases = {}
+        for disease, entry in derm_data.items():
+            start = len(texts["questions"])
+            for qa in entry["qa_pairs"]:
+                texts["questions"].append(tokenize(qa["question"]))
+                texts["answers"].append(tokenize(qa["answer"]))
+            diseases[disease] = {"start": start, "end": len(texts["questions"])}
+        num_rows = len(texts["questions"])
+
+        vocab = sorted({t for docs in texts.values() for doc in docs for t in doc})
+        term_ids = {t: i for i, t in enumerate(vocab)}
+        arrays = {}
+        for field, docs in texts.items():
+            lengths = np.array([len(d) for d in docs], dtype=np.float32)
+            avgdl = float(lengths.mean()) if num_rows and lengths.sum() else 1.0
+            # (term, row, tf) triples, sorted by term for the CSR layout
+            triples = [(term_ids[t], row, tf) for row, doc in enumerate(docs) for t, tf in Counter(doc).items()]
+            triples.sort()
+            terms = np.array([t for t, _, _ in triples], dtype=np.int64)
+            rows = np.array([r for _, r, _ in triples], dtype=np.int32)
+            tf = np.array([f for _, _, f in triples], dtype=np.float32)
+            df = np.bincount(terms, minlength=len(vocab)).astype(np.float32)
+            idf = np.log1p((num_rows - df + 0.5) / (df + 0.5))
+            norm = k1 * (1.0 - b + b * lengths[rows] / avgdl)
+            weights = (idf[terms] * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32)
+            indptr = np.concatenate([[0], np.cumsum(df.astype(np.int64))])
+            arrays[field] = {"indptr": indptr, "rows": rows, "weights": weights}
+
+        meta = {
+            "format_version": LEXICAL_FORMAT_VERSION,
+            "key": key,
+            "k1": k1,
+            "b": b,
+            "qa_json": str(qa_json_path),
+            "num_pairs": num_rows,
+            "vocab_size": len(vocab),
+            "diseases": diseases,
+        }
+
+        # write into a temp dir first, then swap in atomically
+        final = cls.dir_for(index_dir, key)
+        final.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(prefix=".build-bm25-", dir=final.parent))
+        try:
+            for field, parts in arrays.items():
+                for part, arr in parts.items():
+                    np.save(tmp / f"{field}_{part}.npy", arr)
+            with (tmp / "vocab.json").open("w") as f:
+                json.dump(vocab, f)
+            with (tmp / "meta.json").open("w") as f:
+                json.dump(meta, f, indent=2)
+            if final.exists():
+                shutil.rmtree(final)
+            os.replace(tmp, final)
+        finally:
+            if tmp.exists():
+                shutil.rmtree(tmp, ignore_errors=True)
+
+        cls.prune(index_dir, keep=final)
+        return cls.load(final)
+
+    @classmethod
+    def load_or_build(cls, qa_json_path: str, index_dir: str, k1: float = 1.2, b: float = 0.75,
+                      force: bool = False) -> "BM25Index":
+        """Reuse the index matching (JSON content, k1, b); rebuild otherwise."""
+        path = cls.dir_for(index_dir, lexical_key(qa_json_path, k1, b))
+        if not force and (path / "meta.json").exists():
+            try:
+                return cls.load(path)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"BM25 index at {path} unreadable, rebuilding: {e}")
+        return cls.build(qa_json_path, index_dir, k1, b)
+
+    @staticmethod
+    def prune(index_dir: str, keep: Optional[Path] = None):
+        """Remove BM25 directories for stale JSON versions / parameters."""
+        for p in Path(index_dir).glob("bm25-v*-*"):
+            if p.is_dir() and (keep is None or p.resolve() != keep.resolve()):
+                shutil.rmtree(p, ignore_errors=True)
+
+
+def fuse_scores(dense: np.ndarray, lexical: np.ndarray, weight: float, method: str = "linear",
+                rrf_k: int = 60) -> np.ndarray:
+    """
+    Ranking score for candidates with both a dense (cosine) and a BM25 score.
+
+    linear: (1 - weight) * dense + weight * lexical / max(lexical)
+    rrf:    (1 - weight) / (rrf_k + dense rank) + weight / (rrf_k + lexical rank)
+    """
+    if method == "linear":
+        top = float(lexical.max()) if len(lexical) else 0.0
+        return (1.0 - weight) * dense + weight * (lexical / top if top > 0 else lexical)
+    if method == "rrf":
+        def ranks(s):
+            r = np.empty(len(s), dtype=np.float32)
+            r[np.argsort(-s, kind="stable")] = np.arange(len(s))
+            return r
+        return (1.0 - weight) / (rrf_k + ranks(dense)) + weight / (rrf_k + ranks(lexical))
+    raise ValueError(f"Unknown fusion method: {method}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the BM25 index used by lexical / hybrid RAG retrieval.")
+    parser.add_argument("--qa-json", default="dataset/dermatology_qa.json")
+    parser.add_argument("--index-dir", default="dataset/qa_index")
+    parser.add_argument("--k1", type=float, default=1.2)
+    parser.add_argument("--b", type=float, default=0.75)
+    parser.add_argument("--force", action="store_true", help="rebuild even if an up-to-date index exists")
+    parser.add_argument("--query", default=None, help="print the top matches for a question")
+    parser.add_argument("--disease", default=None, help="restrict --query to one disease")
+    args = parser.parse_args(argv)
+
+    index = BM25Index.load_or_build(args.qa_json, args.index_dir, args.k1, args.b, force=args.force)
+    print(f"BM25 index with {index.num_rows} pairs, {index.meta['vocab_size']} terms at {index.path}")
+
+    if args.query:
+        with Path(args.qa_json).open() as f:
+            derm_data = json.load(f)
+        classes = [args.disease] if args.disease else None
+        for row, score in index.search(args.query, classes=classes, top_k=5):
+            disease, i = index.locate(row)
+            print(f"{score:7.3f}  [{disease}] {derm_data[disease]['qa_pairs'][i]['question']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,24 @@
-from ollama import Client                     # tiny wrapper around the REST API
 import torch, json
+from concurrent.futures import TimeoutError as FutureTimeout
+from src.deadline import DeadlineExceeded
+from src.llm_cache import ChatCache, chat_key
+from src.ollama_client import LLMBusy, OllamaPool, StreamStalled, watch_stream
+from src.metrics import REGISTRY, record_stage, span
+
+LLM_CALLS = REGISTRY.counter(
+    "derm_llm_calls_total",
+    "Chat requests sent to Ollama (cache misses only).",
+    labelnames=("mode",),
+)
+PROMPT_EVAL_TOKENS = REGISTRY.histogram(
+    "derm_llm_prompt_eval_tokens",
+    "Prompt tokens Ollama evaluated per call (prefix reused from its KV cache excluded).",
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+
+def prompt_tokens(messages: list[dict]) -> int:
+    """Rough token count of a chat prompt (~4 characters per token)."""
+    return sum(len(m["content"]) for m in messages) // 4 + 4 * len(messages)
 
 class MedicalLLMHelper:
     """
@@ -7,33 +26,232 @@ class MedicalLLMHelper:
     with the model name you created above:  biomedllama-q8
     """
 
+    # prompt / output sizes used to budget a call before its prompt exists
+    REFORMULATE_PROMPT_TOKENS = 160
+    REFORMULATE_TOKENS = 48
+    SUMMARY_TOKENS = 200
+    ANSWER_PROMPT_TOKENS = 1200
+
     def __init__(
         self,
         model: str = "hf.co/unsloth/medgemma-4b-it-GGUF:Q8_K_XL",
         host: str = "http://localhost:11434",
         temperature: float = 0.6,
         top_p: float = 0.9,
+        cache_size: int = 512,
+        cache_ttl: float = 3600.0,
+        max_in_flight: int = 2,
+        queue_timeout: float = 30.0,
+        retries: int = 2,
+        keep_alive="30m",
+        pool_size: int = None,
+        decode_tokens_per_sec: float = 20.0,
+        prefill_tokens_per_sec: float = 400.0,
+        answer_tokens: int = 300,
+        min_answer_tokens: int = 48,
+        deadline_margin: float = 0.5,
     ):
-        self.client = Client(host=host)
+        """
+        With a request `deadline`, calls are budgeted from Ollama's token
+        rates (starting at decode/prefill_tokens_per_sec, then tracked from
+        its responses): an answer that would not fit gets num_predict capped
+        below `answer_tokens` (its usual length), and below
+        `min_answer_tokens` the call is not made at all. `deadline_margin`
+        seconds are kept in reserve for the rest of the request.
+        """
+        # every call goes through a bounded pool: at most `max_in_flight`
+        # generations hit Ollama at once, the rest queue (see OllamaPool)
+        self.pool = OllamaPool(
+            host=host,
+            max_in_flight=max_in_flight,
+            queue_timeout=queue_timeout,
+            pool_size=pool_size,
+            retries=retries,
+            keep_alive=keep_alive,
+        )
+        self.client = self.pool.client
         self.model = model
         self.gen_opts = {"temperature": temperature, "top_p": top_p}
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # identical prompts (e.g. the image-upload "question" that is just the
+        # disease name) are answered from cache; cache_size=0 disables it
+        self.cache = ChatCache(cache_size, cache_ttl) if cache_size else None
+
+        self.speed = {"decode": decode_tokens_per_sec, "prefill": prefill_tokens_per_sec}
+        self.answer_tokens = answer_tokens
+        self.min_answer_tokens = min_answer_tokens
+        self.deadline_margin = deadline_margin
 
     # ------------- internal helper -------------
-    def _chat(self, messages: list[dict]) -> str:
+    def _chat(self, messages: list[dict], use_cache: bool = True, deadline=None,
+              answer_tokens: int = None) -> str:
         """
         One-shot chat call.  `messages` must be a list of
         {"role": "system"/"user"/"assistant", "content": "..."} dicts.
+        Results are cached on (model, options, normalised messages) and
+        concurrent identical calls share one request to Ollama, as long as
+        the request running it has at least the caller's budget (see
+        `ChatCache.get_or_call`).
+        With a `deadline` the call is budgeted (see `_budget_options`) and
+        raises DeadlineExceeded instead of running past it.
+        """
+        options = self.gen_opts
+        if deadline is not None:
+            options = self._budget_options(messages, deadline, answer_tokens or self.answer_tokens)
+        if self.cache is None or not use_cache:
+            return self._chat_uncached(messages, options, deadline)
+        key = chat_key(self.model, options, messages)
+        if deadline is None:
+            return self.cache.get_or_call(key, lambda: self._chat_uncached(messages, options))
+        # identical calls are shared only with requests whose budget is at least ours
+        # (a call without a deadline joins only calls without one); we wait at most our
+        # own budget, and if the shared call still ran out of *its* budget, run it again
+        try:
+            return self.cache.get_or_call(
+                key,
+                lambda: self._chat_uncached(messages, options, deadline),
+                timeout=deadline.remaining(),
+                rerun_on=(DeadlineExceeded,),
+            )
+        except DeadlineExceeded:
+            raise
+        except FutureTimeout:       # (a TimeoutError, like DeadlineExceeded, on Python >= 3.11)
+            deadline.fail("llm.generate")
+
+    def _chat_uncached(self, messages: list[dict], options: dict = None, deadline=None) -> str:
+        LLM_CALLS.inc(mode="blocking")
+        options = options or self.gen_opts     # same fields as the CLI --temperature ...
+        with span("llm.chat"):
+            if deadline is None:
+                resp = self.pool.chat(model=self.model, messages=messages, options=options)
+                self._observe(resp)
+                return resp["message"]["content"]
+
+            # streamed under the hood, and watched, so the generation is cut off at the
+            # deadline even while Ollama is still queueing / prefilling (no chunk yet)
+            parts = []
+            stream = watch_stream(self.pool.chat_stream(
+                model=self.model,
+                messages=messages,
+                options=options,
+                queue_timeout=deadline.remaining(),
+            ), deadline.remaining)
+            try:
+                for chunk in stream:
+                    parts.append(chunk["message"]["content"])
+                    if chunk.get("done"):
+                        self._observe(chunk)
+                    elif deadline.expired():
+                        deadline.fail("llm.generate")
+            except StreamStalled:
+                deadline.fail("llm.generate")
+            except LLMBusy:
+                if deadline.expired():
+                    deadline.fail("llm.queue")
+                raise
+            finally:
+                stream.close()
+            return "".join(parts)
+
+    # ------------- latency budget -------------
+    def _observe(self, resp):
+        """
+        Follow Ollama's prefill / decode token rates (EWMA) from a finished
+        response, and record its prompt-eval tokens and time (the latter as
+        the "ollama.prompt_eval" stage of the request's breakdown).
         """
-        resp = self.client.chat(
-            model=self.model,
-            messages=messages,
-            options=self.gen_opts          # same fields as the CLI --temperature ...
+        if resp.get("prompt_eval_count") is not None:
+            PROMPT_EVAL_TOKENS.observe(resp["prompt_eval_count"])
+        if resp.get("prompt_eval_duration"):
+            record_stage("ollama.prompt_eval", resp["prompt_eval_duration"] / 1e9)
+        for kind, count, duration in (
+            ("prefill", "prompt_eval_count", "prompt_eval_duration"),
+            ("decode", "eval_count", "eval_duration"),
+        ):
+            n, ns = resp.get(count), resp.get(duration)
+            if n and ns:
+                self.speed[kind] += 0.2 * (n / (ns / 1e9) - self.speed[kind])
+
+    def estimate_seconds(self, prompt_tokens: int, new_tokens: int) -> float:
+        return prompt_tokens / self.speed["prefill"] + new_tokens / self.speed["decode"]
+
+    def can_afford(self, deadline, prompt_tokens: int, new_tokens: int) -> bool:
+        """Whether a call of this size still leaves time for a minimal answer."""
+        needed = (
+            self.estimate_seconds(prompt_tokens, new_tokens)
+            + self.estimate_seconds(self.ANSWER_PROMPT_TOKENS, self.min_answer_tokens)
+            + 2 * self.deadline_margin
         )
-        return resp["message"]["content"]
+        return deadline.remaining() >= needed
+
+    def can_reformulate(self, deadline) -> bool:
+        return self.can_afford(deadline, self.REFORMULATE_PROMPT_TOKENS, self.REFORMULATE_TOKENS)
+
+    def _budget_options(self, messages: list[dict], deadline, answer_tokens: int) -> dict:
+        """
+        gen_opts for a call under `deadline`: unchanged when `answer_tokens`
+        fit in the remaining time, otherwise with num_predict capped to what
+        does fit (recorded as a degradation).
+        """
+        spare = deadline.remaining() - self.deadline_margin - prompt_tokens(messages) / self.speed["prefill"]
+        fit = int(spare * self.speed["decode"])
+        if fit >= answer_tokens:
+            return self.gen_opts
+        if fit < min(self.min_answer_tokens, answer_tokens):
+            deadline.fail("llm.budget")
+        deadline.degrade("num_predict_capped", num_predict=fit)
+        return {**self.gen_opts, "num_predict": fit}
+
+    def cache_stats(self):
+        return self.cache.stats() if self.cache is not None else None
+
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def _chat_stream(self, messages: list[dict], deadline=None):
+        """
+        Streaming variant of `_chat`: yields content chunks as Ollama
+        produces them. At the deadline the answer stops where it is, or
+        raises DeadlineExceeded if nothing was produced yet.
+        """
+        options = self.gen_opts
+        if deadline is not None:
+            options = self._budget_options(messages, deadline, self.answer_tokens)
+        LLM_CALLS.inc(mode="stream")
+        with span("llm.chat_stream"):
+            stream = self.pool.chat_stream(
+                model=self.model,
+                messages=messages,
+                options=options,
+                queue_timeout=deadline.remaining() if deadline is not None else None,
+            )
+            if deadline is not None:
+                stream = watch_stream(stream, deadline.remaining)
+            produced = False
+            try:
+                for chunk in stream:
+                    content = chunk["message"]["content"]
+                    if content:
+                        produced = True
+                        yield content
+                    if chunk.get("done"):
+                        self._observe(chunk)
+                    elif deadline is not None and deadline.expired():
+                        deadline.degrade("answer_truncated")
+                        return
+            except StreamStalled:
+                if not produced:
+                    deadline.fail("llm.generate")
+                deadline.degrade("answer_truncated")
+            except LLMBusy:
+                if deadline is not None and deadline.expired():
+                    deadline.fail("llm.queue")
+                raise
+            finally:
+                stream.close()
 
     # ---------- 1) Question reformulation ----------
-    def reformulate_question(self, raw_question: str, disease: str) -> str:
+    def reformulate_question(self, raw_question: str, disease: str, deadline=None) -> str:
         messages = [
             {
                 "role": "system",
@@ -46,19 +264,20 @@ class MedicalLLMHelper:
             },
             {"role": "user", "content": raw_question},
         ]
-        return self._chat(messages)
+        with span("llm.reformulate"):
+            return self._chat(messages, deadline=deadline, answer_tokens=self.REFORMULATE_TOKENS)
 
     # ---------- 2) Final answer ----------
-    def generate_answer(self, disease_name: str, user_q: str, rag_out: dict) -> str:
-        if disease_name == "Normal_Image":
-            return (
-                "Your image does not appear to show any concerning skin disease. "
-                "Everything looks normal, so there is nothing to worry about. "
-                "If you have any other questions or notice new changes, feel free to let me know!"
-            )
+    NORMAL_IMAGE_ANSWER = (
+        "Your image does not appear to show any concerning skin disease. "
+        "Everything looks normal, so there is nothing to worry about. "
+        "If you have any other questions or notice new changes, feel free to let me know!"
+    )
 
-        # 1️⃣  Diyaloğu sürdüren sistem yönergesi
-        system_prompt = f"""
+    def _system_prompt(self, disease_name: str, description: str) -> str:
+        # Byte-identical for every turn of a chat, so Ollama can reuse its
+        # KV cache for this prefix; per-turn material goes after it.
+        return f"""
             You are DermAI, a friendly, medically accurate dermatology assistant.
 
             When replying:
@@ -68,27 +287,85 @@ class MedicalLLMHelper:
             4. **Invite follow-up** - end with an open question (e.g., “Would you like to know home-care tips?”).
             5. **Keep it brief** (≤ 150 words) unless the user asks for more detail.
 
+            Each question comes with relevant Q&A pairs from the knowledge base.
+
             ---
             **Disease:** {disease_name}
-            **Description:** {rag_out['description']}
-
-            **Relevant Q&A Pairs**
-            {chr(10).join([f"Q: {qa['question']}\nA: {qa['answer']}" for qa in rag_out['matched_qa_pairs']])}
+            **Description:** {description}
             """.strip()
 
-        # 2️⃣  Mesaj listesi (kullanıcı sorusunu ve varsa rafine hâlini ilet)
-        messages = [
+    def _answer_messages(self, disease_name: str, user_q: str, rag_out: dict,
+                         history: list[dict] = None, summary: str = None) -> list[dict]:
+        """
+        [system: instructions + disease + description (+ summary of older turns)]
+        [recent turns verbatim, oldest first]
+        [user: this turn's Q&A pairs + question]
+        """
+        system_prompt = self._system_prompt(disease_name, rag_out['description'])
+        if summary:
+            system_prompt += f"\n\n**Earlier in this conversation:** {summary}"
+
+        qa_block = "\n".join(
+            f"Q: {qa['question']}\nA: {qa['answer']}" for qa in rag_out['matched_qa_pairs']
+        )
+
+        # Mesaj listesi (kullanıcı sorusunu ve varsa rafine hâlini ilet)
+        return [
             {"role": "system", "content": system_prompt},
+            *(history or []),
             {
                 "role": "user",
                 "content": (
+                    f"**Relevant Q&A Pairs**\n{qa_block}\n\n"
                     f"User Question: {user_q}\n"
                     f"(refined: {rag_out['refined_question']})"
                 ),
             },
         ]
 
+    def generate_answer(self, disease_name: str, user_q: str, rag_out: dict, deadline=None,
+                        history: list[dict] = None, summary: str = None) -> str:
+        if disease_name == "Normal_Image":
+            return self.NORMAL_IMAGE_ANSWER
+
+        messages = self._answer_messages(disease_name, user_q, rag_out, history, summary)
+
         # 3️⃣  Model çağrısı (kendi LLM wrapper’ına göre uyarlarsın)
-        response = self._chat(messages)
+        with span("llm.generate"):
+            response = self._chat(messages, deadline=deadline)
         return response
 
+    def generate_answer_stream(self, disease_name: str, user_q: str, rag_out: dict, deadline=None,
+                               history: list[dict] = None, summary: str = None):
+        """Same prompt as `generate_answer`, yielding tokens as they arrive."""
+        if disease_name == "Normal_Image":
+            yield self.NORMAL_IMAGE_ANSWER
+            return
+
+        messages = self._answer_messages(disease_name, user_q, rag_out, history, summary)
+        yield from self._chat_stream(messages, deadline)
+
+    # ---------- 3) Conversation summary ----------
+    def summarize_conversation(self, previous: str, turns: list[dict], deadline=None) -> str:
+        """Fold `turns` ({"role", "content"}, oldest first) into the rolling summary `previous`."""
+        transcript = "\n".join(
+            f"{'Patient' if t['role'] == 'user' else 'Assistant'}: {t['content']}" for t in turns
+        )
+        if previous:
+            transcript = f"Summary so far: {previous}\n\n{transcript}"
+        messages = [
+            {
+                "role": "system",
+                "content": (
+                    "You summarize a conversation between a patient and a dermatology assistant.\n"
+                    "Keep the symptoms, history and concerns the patient mentioned, the advice already given and any open questions.\n"
+                    "Respond ONLY with the summary, at most 120 words."
+                ),
+            },
+            {"role": "user", "content": transcript},
+        ]
+        with span("llm.summarize"):
+            return self._chat(messages, deadline=deadline, answer_tokens=self.SUMMARY_TOKENS)
+
+    def can_summarize(self, deadline, turns: list[dict]) -> bool:
+        return self.can_afford(deadline, prompt_tokens(turns) + 100, self.SUMMARY_TOKENS)
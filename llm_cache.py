@@ -0,0 +1,122 @@
+import hashlib, json, re, threading, time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+_WS = re.compile(r"\s+")
+
+
+def chat_key(model: str, options: dict, messages: list[dict]) -> str:
+    """
+    Cache key for a chat call. Message contents are whitespace-normalised so
+    prompts that differ only in indentation/newlines (e.g. the triple-quoted
+    system prompt) share an entry.
+    """
+    norm = [
+        {"role": m["role"], "content": _WS.sub(" ", m["content"]).strip()}
+        for m in messages
+    ]
+    payload = json.dumps(
+        {"model": model, "options": options, "messages": norm},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ChatCache:
+    """
+    Bounded LRU + TTL cache for LLM completions with in-flight coalescing:
+    concurrent callers asking for the same key wait on the one call that is
+    already running instead of issuing their own.
+    """
+
+    def __init__(self, max_entries: int = 512, ttl: Optional[float] = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._inflight: dict[str, tuple[Future, Optional[float]]] = {}     # key -> (call, its give-up time)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "expired": 0, "errors": 0}
+
+    def get_or_call(self, key: str, fn: Callable[[], str], timeout: Optional[float] = None,
+                    rerun_on: tuple = ()) -> str:
+        """
+        Cached value for `key`, else `fn()`. `timeout` is the caller's budget:
+        it joins an in-flight call only if that call's own budget is at least
+        as long (a call without a timeout outlasts any), and waits at most
+        `timeout` seconds for it (concurrent.futures.TimeoutError after that).
+        A caller with a longer budget runs its own `fn` alongside (and later
+        callers join that one), so a call that gives up early never makes a
+        more patient caller fail. When a
+        joined call still fails with one of `rerun_on` -- errors that belong
+        to the caller who ran it, such as its request deadline -- the waiting
+        caller runs its own `fn` instead of inheriting the failure.
+        """
+        give_up = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    stored_at, value = entry
+                    if self.ttl is None or time.monotonic() - stored_at < self.ttl:
+                        self._entries.move_to_end(key)
+                        self._counters["hits"] += 1
+                        return value
+                    del self._entries[key]
+                    self._counters["expired"] += 1
+
+                running = self._inflight.get(key)
+                # a call that may give up before we would is not joined: ours runs
+                # alongside and takes over as the call later callers join
+                if running is None or (running[1] is not None and (give_up is None or running[1] < give_up)):
+                    self._counters["misses"] += 1
+                    pending = Future()
+                    self._inflight[key] = (pending, give_up)
+                    break
+                pending = running[0]
+                self._counters["coalesced"] += 1
+            try:
+                return pending.result(timeout=max(0.0, give_up - time.monotonic()) if give_up is not None else None)
+            except rerun_on:
+                continue
+
+        try:
+            value = fn()
+        except BaseException as e:
+            with self._lock:
+                self._release(key, pending)
+                self._counters["errors"] += 1
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            self._release(key, pending)
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        pending.set_result(value)
+        return value
+
+    def _release(self, key: str, pending: Future):
+        # only if no more patient call has taken the key over meanwhile
+        if self._inflight.get(key, (None,))[0] is pending:
+            del self._inflight[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"] + self._counters["coalesced"]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "inflight": len(self._inflight),
+                **self._counters,
+                "hit_rate": ((self._counters["hits"] + self._counters["coalesced"]) / lookups) if lookups else 0.0,
+            }
@@ -0,0 +1,319 @@
+"""
+LLM-as-a-judge scoring of leave-one-out answers (llm-as-a-judge.ipynb as a tool).
+
+Every generated answer is scored for accuracy, empathy and medical
+consistency against the reference answer by a judge model, with the same
+prompt as the notebook. Calls run concurrently under a requests/min budget,
+and every judgement is appended to a cache file keyed by a hash of
+(question, reference, generated answer, judge prompt, judge model): reruns
+and interrupted runs only call the judge for what is missing, and the cache
+can be shared between runs over overlapping outputs.
+
+    python -m src.llm_judge judge --input loo_eval_output_medgemma.json \
+        --out medgemma_scores.csv --concurrency 8 --rpm 120
+    python -m src.llm_judge report --scores medgemma_scores.csv
+
+--input takes the notebook's JSON layout or loo_eval's JSONL. Try it without
+Azure against a stub: `python -m src.llm_judge stub-server` and
+`--base-url http://127.0.0.1:8090/v1`.
+"""
+import argparse, asyncio, csv, hashlib, json, os, random, re, threading, time
+from typing import Optional
+
+from src.generate_qa import TokenBucket, make_client, serve_stub
+
+SCORE_FIELDS = ("accuracy_score", "emphaty_score", "medical_consistency_score")
+
+JUDGE_SYSTEM = (
+    "You are an expert in dermatology field. You will be given some question answer pairs and asked to evaluate their quality."
+    "There will be three inputs: question, original answer and generated answer. By looking to question and original answer, you should score the genrated answer."
+    "You should give scores on overall accuracy, emphaty and medical consistency. Your scores should be on 10."
+)
+JUDGE_USER = (
+    "Question:\n{question}"
+    "Original Answer:\n{reference}\n\n"
+    "Generated Answer:\n{generated}\n\n"
+    "Please evaluate the generated answer. Reply only in the following format:\n"
+    "Accuracy: X/10\nEmphaty: Y/10\nMedical Consistency: Z/10\n"
+    "Do not provide any other text, just the scores."
+)
+
+_SCORE_LINE = re.compile(r"(accuracy|emphaty|empathy|medical consistency)\s*:\s*(\d+(?:\.\d+)?)\s*(?:/\s*10)?", re.I)
+_FIELD_FOR = {
+    "accuracy": "accuracy_score",
+    "emphaty": "emphaty_score",
+    "empathy": "emphaty_score",
+    "medical consistency": "medical_consistency_score",
+}
+
+
+def parse_scores(text: str) -> dict:
+    """{"accuracy_score": 8, ...} from "Accuracy: 8/10" style lines; missing scores are None."""
+    scores = dict.fromkeys(SCORE_FIELDS)
+    for name, value in _SCORE_LINE.findall(text or ""):
+        value = float(value)
+        scores[_FIELD_FOR[name.lower()]] = int(value) if value.is_integer() else value
+    return scores
+
+
+def judge_key(question: str, reference: str, generated: str, model: str) -> str:
+    payload = json.dumps(
+        {
+            "question": question,
+            "reference": reference,
+            "generated": generated,
+            "prompt": [JUDGE_SYSTEM, JUDGE_USER],
+            "model": model,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_items(path: str) -> list:
+    """Flatten {class: {"per_question": [...]}} (or loo_eval JSONL) into scoring items."""
+    if path.endswith(".jsonl"):
+        raw = []
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        raw.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        raw.sort(key=lambda it: (it["class"], it.get("index", 0)))
+    else:
+        with open(path) as f:
+            data = json.load(f)
+        raw = [dict(item, **{"class": cls}) for cls, content in data.items() for item in content["per_question"]]
+    return [
+        {
+            "class": it["class"],
+            "question": it["original_question"],
+            "original_answer": it["original_answer"],
+            "generated_answer_long": it.get("generated_answer_long"),
+        }
+        for it in raw
+    ]
+
+
+class JudgeCache:
+    """Append-only JSONL of judgements; each line is flushed, so it doubles as the run checkpoint."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = {}
+        if os.path.exists(path):
+            with open(path, "rb+") as f:     # drop a half-written last line
+                data = f.read()
+                if data and not data.endswith(b"\n"):
+                    f.truncate(data.rfind(b"\n") + 1)
+            with open(path) as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._entries[rec["key"]] = rec
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        return self._entries.get(key)
+
+    def put(self, key: str, raw: str, scores: dict):
+        rec = {"key": key, "raw": raw, **scores, "ts": time.time()}
+        with self._lock:
+            self._entries[key] = rec
+            self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+async def judge_all(items: list, client, cache: JudgeCache, args) -> dict:
+    import openai
+
+    transient = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+    bucket = TokenBucket.per_minute(args.rpm)
+    sem = asyncio.Semaphore(args.concurrency)
+    counters = {"cached": 0, "judged": 0, "failed": 0, "skipped": 0}
+    started = time.perf_counter()
+
+    async def judge(item):
+        if not item["generated_answer_long"]:
+            counters["skipped"] += 1
+            return
+        key = judge_key(item["question"], item["original_answer"], item["generated_answer_long"], args.model)
+        if cache.get(key) is not None:
+            counters["cached"] += 1
+            return
+        messages = [
+            {"role": "system", "content": JUDGE_SYSTEM},
+            {"role": "user", "content": JUDGE_USER.format(
+                question=item["question"], reference=item["original_answer"], generated=item["generated_answer_long"])},
+        ]
+        async with sem:
+            for attempt in range(args.retries + 1):
+                if bucket:
+                    await bucket.acquire()
+                try:
+                    response = await client.chat.completions.create(
+                        model=args.model, messages=messages, max_tokens=200, temperature=args.temperature
+                    )
+                    raw = response.choices[0].message.content.strip()
+                    scores = parse_scores(raw)
+                    if any(v is None for v in scores.values()):
+                        raise ValueError(f"unparseable judgement: {raw!r}")
+                except (ValueError, *transient) as e:
+                    if attempt >= args.retries:
+                        counters["failed"] += 1
+                        print(f"LLM error for {item['class']} - {item['question']}: {e}")
+                        return
+                    await asyncio.sleep(min(30.0, args.backoff * 2 ** attempt) * random.uniform(0.5, 1.0))
+                    continue
+                except openai.APIError as e:
+                    # not worth retrying (e.g. BadRequestError); left uncached so a rerun tries again
+                    counters["failed"] += 1
+                    print(f"LLM error for {item['class']} - {item['question']}: {e}")
+                    return
+                cache.put(key, raw, scores)
+                counters["judged"] += 1
+                done = counters["judged"] + counters["failed"]
+                if done % 25 == 0:
+                    print(f"{done} judged ({done / (time.perf_counter() - started):.2f}/s)")
+                return
+
+    await asyncio.gather(*(judge(it) for it in items))
+    return counters
+
+
+def score_rows(items: list, cache: JudgeCache, model: str) -> list:
+    """The notebook's results table: one row per item, scores None where there is no judgement."""
+    rows = []
+    for it in items:
+        rec = None
+        if it["generated_answer_long"]:
+            rec = cache.get(judge_key(it["question"], it["original_answer"], it["generated_answer_long"], model))
+        rows.append({
+            "class": it["class"],
+            "question": it["question"],
+            "original_answer": it["original_answer"],
+            "generated_answer_long": it["generated_answer_long"],
+            **{f: (rec or {}).get(f) for f in SCORE_FIELDS},
+        })
+    return rows
+
+
+def aggregate(rows: list):
+    """
+    (overall means, [(class, means), ...] sorted by medical consistency,
+    best first) -- pandas' .mean()/.groupby("class").mean(), skipping None.
+    """
+    def means(subset):
+        out = {}
+        for f in SCORE_FIELDS:
+            vals = [r[f] for r in subset if r[f] not in (None, "")]
+            out[f] = sum(float(v) for v in vals) / len(vals) if vals else None
+        return out
+
+    by_class = {}
+    for r in rows:
+        by_class.setdefault(r["class"], []).append(r)
+    per_class = [(cls, means(subset)) for cls, subset in by_class.items()]
+    per_class.sort(key=lambda cm: -(cm[1]["medical_consistency_score"] or 0.0))
+    return means(rows), per_class
+
+
+def format_report(overall: dict, per_class: list) -> str:
+    fmt = lambda v: f"{v:>10.3f}" if v is not None else f"{'-':>10}"
+    width = max([len("class")] + [len(c) for c, _ in per_class])
+    lines = ["Overall means:"]
+    lines += [f"  {f:<26} {fmt(overall[f])}" for f in SCORE_FIELDS]
+    lines += ["", "Per-class means:", f"{'class':<{width}} " + " ".join(f"{f.split('_')[0][:10]:>10}" for f in SCORE_FIELDS)]
+    for cls, m in per_class:
+        lines.append(f"{cls:<{width}} " + " ".join(fmt(m[f]) for f in SCORE_FIELDS))
+    return "\n".join(lines)
+
+
+def write_csv(rows: list, path: str):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["class", "question", "original_answer", "generated_answer_long", *SCORE_FIELDS])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_csv(path: str) -> list:
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def judge_reply(body: dict) -> str:
+    """Stub judge: plausible random scores in the notebook's format."""
+    a, e, m = (random.randint(6, 10) for _ in range(3))
+    return f"Accuracy: {a}/10\nEmphaty: {e}/10\nMedical Consistency: {m}/10"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score generated answers with an LLM judge.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    j = sub.add_parser("judge", help="score a loo_eval output and print the aggregate table")
+    j.add_argument("--input", required=True, help="loo_eval JSON ({class: {per_question}}) or JSONL")
+    j.add_argument("--out", required=True, help="scores CSV (the notebook's columns)")
+    j.add_argument("--cache", default="judge_cache.jsonl", help="judgement cache / checkpoint file")
+    j.add_argument("--model", default="gpt-4o", help="judge model / Azure deployment name")
+    j.add_argument("--base-url", default=None, help="OpenAI-compatible endpoint (instead of Azure)")
+    j.add_argument("--azure-endpoint", default=os.environ.get("AZURE_OPENAI_ENDPOINT"))
+    j.add_argument("--api-version", default="2024-05-01-preview")
+    j.add_argument("--api-key", default=os.environ.get("AZURE_OPENAI_API_KEY") or os.environ.get("OPENAI_API_KEY"))
+    j.add_argument("--temperature", type=float, default=0.3)
+    j.add_argument("--concurrency", type=int, default=8)
+    j.add_argument("--rpm", type=float, default=120, help="requests per minute (0 = unlimited)")
+    j.add_argument("--retries", type=int, default=3)
+    j.add_argument("--backoff", type=float, default=1.0)
+    j.add_argument("--limit", type=int, default=None)
+
+    r = sub.add_parser("report", help="print the aggregate table of a scores CSV")
+    r.add_argument("--scores", required=True)
+
+    s = sub.add_parser("stub-server", help="local OpenAI-compatible judge with random scores")
+    s.add_argument("--host", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=8090)
+    s.add_argument("--rate-limit-rate", type=float, default=0.0)
+    s.add_argument("--latency", type=float, default=0.0)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "judge":
+        items = load_items(args.input)[:args.limit]
+        cache = JudgeCache(args.cache)
+        print(f"{len(items)} items, {len(cache)} cached judgements")
+        try:
+            counters = asyncio.run(judge_all(items, make_client(args), cache, args))
+            print(json.dumps(counters))
+            rows = score_rows(items, cache, args.model)
+        finally:
+            cache.close()
+        write_csv(rows, args.out)
+        print(f"Wrote {args.out}\n")
+        print(format_report(*aggregate(rows)))
+    elif args.cmd == "report":
+        print(format_report(*aggregate(read_csv(args.scores))))
+    else:
+        server = serve_stub(args.host, args.port, rate_limit_rate=args.rate_limit_rate,
+                            latency=args.latency, reply=judge_reply)
+        print(f"Stub judge on http://{args.host}:{args.port}/v1")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
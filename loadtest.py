@@ -0,0 +1,484 @@
+"""
+End-to-end load test of the web app.
+
+Boots app.py in-process with the model stand-ins from src/standins.py (a
+random-weight classifier, a hashing sentence encoder and a fake Ollama with
+a configurable token rate), registers N users and drives them through
+conversations at a fixed concurrency:
+
+    register -> new chat -> upload an image with a question -> K follow-up
+    questions (blocking or SSE) -> read the chat history
+
+and reports per-endpoint latency (p50/p95/p99) and requests/sec, plus the
+per-stage breakdown the app returns with ?timings=1 (upload.read,
+classifier.forward, rag.encode, llm.chat, db.commit, ...). The result can be
+saved as a JSON baseline and later runs compared against it:
+
+    python -m src.loadtest --users 32 --concurrency 8 --followups 3 \\
+        --tokens-per-sec 40 --save-baseline loadtest_baseline.json
+
+    python -m src.loadtest --users 32 --concurrency 8 --followups 3 \\
+        --tokens-per-sec 40 --compare loadtest_baseline.json --tolerance 0.2
+
+App settings are passed through with --env (e.g. --env OLLAMA_MAX_IN_FLIGHT=4
+--env CLASSIFIER_MAX_BATCH=1). The in-process server shares the GIL with the
+client threads; for numbers closer to production, start the app (with
+MODEL_STANDINS=1, STANDIN_QA_JSON and OLLAMA_HOST set) and the fake Ollama
+(`python -m src.standins ollama`) separately and point --url at it.
+"""
+import argparse, io, json, os, random, tempfile, threading, time, uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.client import HTTPConnection
+from http.cookies import SimpleCookie
+from typing import Optional
+from urllib.parse import urlencode, urlsplit
+
+import numpy as np
+from PIL import Image
+
+from src.standins import serve_fake_ollama, synthetic_qa
+
+QUESTIONS = [
+    "What is this condition and is it serious?",
+    "Is it contagious?",
+    "How long does it usually take to heal?",
+    "Which creams or ointments can I use?",
+    "Should I see a dermatologist?",
+    "What triggers a flare-up?",
+    "Can I wear makeup on it?",
+    "Does sun exposure make it worse?",
+    "Is it related to my diet?",
+    "Will it leave a scar?",
+    "Can children get this too?",
+    "How do I stop the itching?",
+]
+
+
+# ---------- HTTP client ----------
+def encode_multipart(fields: dict, files: dict) -> tuple:
+    """(body, content type) for multipart/form-data; files = {name: (filename, bytes, mimetype)}."""
+    boundary = uuid.uuid4().hex
+    out = io.BytesIO()
+    for name, value in fields.items():
+        out.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data, mimetype) in files.items():
+        out.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {mimetype}\r\n\r\n".encode()
+        )
+        out.write(data)
+        out.write(b"\r\n")
+    out.write(f"--{boundary}--\r\n".encode())
+    return out.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+
+class HttpSession:
+    """One user's browser: cookie jar + one connection per request (redirects are not followed)."""
+
+    def __init__(self, base_url: str, timeout: float = 300.0):
+        u = urlsplit(base_url)
+        self.host, self.port = u.hostname, u.port or 80
+        self.timeout = timeout
+        self.cookies = SimpleCookie()
+
+    def open(self, method: str, path: str, fields: dict = None, files: dict = None):
+        """Send a request; returns the live response (caller reads and closes it)."""
+        headers = {"Connection": "close"}
+        body = None
+        if files:
+            body, headers["Content-Type"] = encode_multipart(fields or {}, files)
+        elif fields is not None:
+            body = urlencode(fields).encode()
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={m.value}" for k, m in self.cookies.items())
+        conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        for header in resp.headers.get_all("Set-Cookie") or []:
+            self.cookies.load(header)
+        return resp
+
+    def request(self, method: str, path: str, fields: dict = None, files: dict = None):
+        """(status, parsed JSON or None)."""
+        resp = self.open(method, path, fields, files)
+        try:
+            data = resp.read()
+        finally:
+            resp.close()
+        try:
+            payload = json.loads(data) if data else None
+        except ValueError:
+            payload = None
+        return resp.status, payload
+
+
+def read_sse(resp):
+    """Yields (event, data) from a text/event-stream response."""
+    event, data = None, []
+    for raw in resp:
+        line = raw.decode("utf-8").rstrip("\r\n")
+        if not line:
+            if event is not None:
+                yield event, json.loads("\n".join(data)) if data else None
+            event, data = None, []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+
+# ---------- measurements ----------
+class Recorder:
+    """Thread-safe latency samples (ms) per endpoint and per stage."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.stages = defaultdict(list)
+        self.degradations = defaultdict(int)
+
+    def request(self, endpoint: str, ms: float, ok: bool):
+        with self._lock:
+            self.endpoints[endpoint].append(ms)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def stage(self, name: str, ms: float):
+        with self._lock:
+            self.stages[name].append(ms)
+
+    def timings(self, timings: Optional[dict]):
+        for name, t in (timings or {}).items():
+            self.stage(name, t["ms"])
+
+    def degraded(self, items: Optional[list]):
+        """Deadline degradations reported by a turn (see src/deadline.py)."""
+        with self._lock:
+            for item in items or []:
+                self.degradations[item["kind"]] += 1
+
+
+def summarize(samples: list) -> dict:
+    a = np.asarray(samples, dtype=np.float64)
+    p50, p95, p99 = np.percentile(a, [50, 95, 99])
+    return {
+        "count": int(a.size),
+        "mean_ms": round(float(a.mean()), 2),
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "max_ms": round(float(a.max()), 2),
+    }
+
+
+# ---------- workload ----------
+def make_images(n: int, size=(640, 480), seed: int = 0) -> list:
+    """n distinct JPEGs (smooth random colour fields, roughly photo-sized files)."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(n):
+        small = rng.integers(0, 256, size=(12, 16, 3), dtype=np.uint8)
+        img = Image.fromarray(small).resize(size, Image.BICUBIC)
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        images.append(buf.getvalue())
+    return images
+
+
+class Workload:
+    def __init__(self, base_url: str, args, images: list, recorder: Recorder):
+        self.base_url = base_url
+        self.args = args
+        self.images = images
+        self.rec = recorder
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def _call(self, endpoint, session, method, path, ok_status=(200,), **kw):
+        t0 = time.perf_counter()
+        try:
+            status, payload = session.request(method, path, **kw)
+            ok = status in ok_status and not (isinstance(payload, dict) and "error" in payload)
+        except OSError:
+            status, payload, ok = None, None, False
+        self.rec.request(endpoint, (time.perf_counter() - t0) * 1000.0, ok)
+        return ok, payload
+
+    def _stream(self, session, fields):
+        t0 = time.perf_counter()
+        ok, first = False, None
+        try:
+            resp = session.open("POST", "/api/message/stream", fields)
+            try:
+                for event, data in read_sse(resp):
+                    if event == "token" and first is None:
+                        first = time.perf_counter()
+                    elif event == "done":
+                        ok = True
+                        self.rec.degraded(data.get("degraded"))
+                    elif event == "error":
+                        break
+            finally:
+                resp.close()
+        except OSError:
+            pass
+        now = time.perf_counter()
+        self.rec.request("message.stream", (now - t0) * 1000.0, ok)
+        if first is not None:
+            self.rec.stage("stream.time_to_first_token", (first - t0) * 1000.0)
+
+    def _think(self):
+        if self.args.think_ms:
+            time.sleep(self.args.think_ms / 1000.0)
+
+    def user(self, u: int):
+        args = self.args
+        rng = random.Random(f"{self.run_id}-{u}")
+        s = HttpSession(self.base_url)
+        name = f"lt-{self.run_id}-{u}"
+        ok, _ = self._call("register", s, "POST", "/register", ok_status=(200, 302),
+                           fields={"username": name, "email": f"{name}@example.com", "password": "loadtest"})
+        if not ok:
+            return
+
+        for c in range(args.chats):
+            ok, chat = self._call("chat.create", s, "POST", "/api/chat", fields={})
+            if not ok:
+                continue
+            chat_id = chat["chat_id"]
+            image = self.images[(u * args.chats + c) % len(self.images)]
+            ok, resp = self._call(
+                "message.upload", s, "POST", "/api/message?timings=1",
+                fields={"chat_id": chat_id, "message": rng.choice(QUESTIONS)},
+                files={"image": ("photo.jpg", image, "image/jpeg")},
+            )
+            if ok:
+                self.rec.timings(resp.get("timings"))
+                self.rec.degraded(resp.get("degraded"))
+
+            for _ in range(args.followups):
+                self._think()
+                fields = {"chat_id": chat_id, "message": rng.choice(QUESTIONS)}
+                if args.stream:
+                    self._stream(s, fields)
+                    continue
+                ok, resp = self._call("message.followup", s, "POST", "/api/message?timings=1", fields=fields)
+                if ok:
+                    self.rec.timings(resp.get("timings"))
+                    self.rec.degraded(resp.get("degraded"))
+
+            self._call("history", s, "GET", f"/api/messages/{chat_id}")
+
+    def run(self, users: int, concurrency: int) -> float:
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="loadtest-user") as pool:
+            for fut in [pool.submit(self.user, u) for u in range(users)]:
+                fut.result()
+        return time.perf_counter() - t0
+
+
+# ---------- in-process app ----------
+def boot_app(args, workdir: str) -> str:
+    """Fake Ollama + app.py with stand-ins on free local ports; returns the app's base URL."""
+    from werkzeug.serving import make_server
+
+    qa_json = args.qa_json
+    if not qa_json:
+        qa_json = os.path.join(workdir, "standin_qa.json")
+        with open(qa_json, "w") as f:
+            json.dump(synthetic_qa(args.classes, args.pairs), f)
+
+    ollama = serve_fake_ollama(
+        "127.0.0.1", 0,
+        tokens_per_sec=args.tokens_per_sec,
+        prefill_tokens_per_sec=args.prefill_tokens_per_sec,
+        reply_tokens=args.reply_tokens,
+        parallel=args.ollama_parallel,
+    )
+    os.environ.update({
+        "MODEL_STANDINS": "1",
+        "STANDIN_QA_JSON": qa_json,
+        "STANDIN_INDEX_DIR": os.path.join(workdir, "qa_index"),
+        "STANDIN_FORWARD_MS": str(args.forward_ms),
+        "STANDIN_ENCODE_MS": str(args.encode_ms),
+        "OLLAMA_HOST": f"http://127.0.0.1:{ollama.server_address[1]}",
+        "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "loadtest.db"),
+        "DB_RESET_ON_START": "1",
+        "CLASSIFICATION_CACHE_PATH": os.path.join(workdir, "classification_cache.db"),
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "MODEL_LOAD_MODE": "eager",
+    })
+    for kv in args.env:
+        key, _, value = kv.partition("=")
+        os.environ[key] = value
+
+    import app as app_module     # reads the environment above at import
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="loadtest-app", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def wait_ready(base_url: str, timeout: float = 300.0):
+    s = HttpSession(base_url, timeout=5.0)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if s.request("GET", "/readyz")[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.5)
+    raise SystemExit(f"{base_url} not ready after {timeout:.0f}s")
+
+
+# ---------- report / baseline ----------
+def build_report(rec: Recorder, wall: float, args) -> dict:
+    endpoints = {}
+    for name, samples in sorted(rec.endpoints.items()):
+        endpoints[name] = {
+            **summarize(samples),
+            "errors": rec.errors.get(name, 0),
+            "requests_per_sec": round(len(samples) / wall, 2),
+        }
+    requests = sum(len(v) for v in rec.endpoints.values())
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {
+            k: getattr(args, k) for k in (
+                "users", "concurrency", "chats", "followups", "stream", "think_ms", "distinct_images",
+                "tokens_per_sec", "prefill_tokens_per_sec", "reply_tokens", "ollama_parallel",
+                "forward_ms", "encode_ms", "env",
+            )
+        },
+        "wall_seconds": round(wall, 3),
+        "requests": requests,
+        "errors": sum(rec.errors.values()),
+        "requests_per_sec": round(requests / wall, 2),
+        "conversations_per_sec": round(args.users * args.chats / wall, 3),
+        "endpoints": endpoints,
+        "stages": {name: summarize(samples) for name, samples in sorted(rec.stages.items())},
+        "degradations": dict(sorted(rec.degradations.items())),
+    }
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"{report['requests']} requests in {report['wall_seconds']:.1f}s -> "
+        f"{report['requests_per_sec']:.1f} req/s, {report['conversations_per_sec']:.2f} conversations/s, "
+        f"{report['errors']} errors",
+        "",
+    ]
+    header = f"{'endpoint':<24} {'count':>6} {'errors':>6} {'req/s':>7} {'p50':>9} {'p95':>9} {'p99':>9}"
+    lines += [header, "-" * len(header)]
+    for name, r in report["endpoints"].items():
+        lines.append(
+            f"{name:<24} {r['count']:>6} {r['errors']:>6} {r['requests_per_sec']:>7.1f} "
+            f"{r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms {r['p99_ms']:>7.1f}ms"
+        )
+    if report.get("degradations"):
+        lines += ["", "degradations: " + ", ".join(f"{k} x{n}" for k, n in report["degradations"].items())]
+    if report["stages"]:
+        header = f"{'stage':<31} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9}"
+        lines += ["", header, "-" * len(header)]
+        for name, r in report["stages"].items():
+            lines.append(
+                f"{name:<31} {r['count']:>6} {r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms {r['p99_ms']:>7.1f}ms"
+            )
+    return "\n".join(lines)
+
+
+def compare(report: dict, baseline: dict, tolerance: float = 0.2, min_delta_ms: float = 5.0) -> list:
+    """
+    Regressions of `report` against `baseline`: a p50/p95/p99 more than
+    `tolerance` (relative) and `min_delta_ms` (absolute) slower, throughput
+    more than `tolerance` lower, or new errors.
+    """
+    problems = []
+    if report["requests_per_sec"] < baseline["requests_per_sec"] * (1 - tolerance):
+        problems.append(f"throughput {baseline['requests_per_sec']:.1f} -> {report['requests_per_sec']:.1f} req/s")
+    if report["errors"] > baseline["errors"]:
+        problems.append(f"errors {baseline['errors']} -> {report['errors']}")
+    for section in ("endpoints", "stages"):
+        for name, cur in report[section].items():
+            base = baseline[section].get(name)
+            if base is None:
+                continue
+            for q in ("p50_ms", "p95_ms", "p99_ms"):
+                if cur[q] > base[q] * (1 + tolerance) and cur[q] - base[q] > min_delta_ms:
+                    problems.append(f"{name} {q[:-3]} {base[q]:.1f} -> {cur[q]:.1f}ms")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end load test with model stand-ins.")
+    parser.add_argument("--url", default=None, help="test a running server instead of booting app.py in-process")
+    parser.add_argument("--users", type=int, default=16, help="registered users, one conversation script each")
+    parser.add_argument("--concurrency", type=int, default=8, help="users active at the same time")
+    parser.add_argument("--chats", type=int, default=1, help="conversations per user")
+    parser.add_argument("--followups", type=int, default=3, help="questions after the upload")
+    parser.add_argument("--stream", action="store_true", help="ask follow-ups over /api/message/stream")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="pause between turns")
+    parser.add_argument("--distinct-images", type=int, default=0,
+                        help="images to cycle through (0 = one per conversation; fewer = classification cache hits)")
+    parser.add_argument("--warmup-users", type=int, default=1, help="conversations run before measuring")
+    # stand-ins (in-process mode)
+    parser.add_argument("--qa-json", default=None, help="knowledge base (default: synthetic)")
+    parser.add_argument("--classes", type=int, default=10, help="synthetic knowledge base classes")
+    parser.add_argument("--pairs", type=int, default=40, help="synthetic Q/A pairs per class")
+    parser.add_argument("--tokens-per-sec", type=float, default=40.0, help="fake Ollama generation speed")
+    parser.add_argument("--prefill-tokens-per-sec", type=float, default=2000.0)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--ollama-parallel", type=int, default=4)
+    parser.add_argument("--forward-ms", type=float, default=0.0, help="stand-in classifier cost per batch")
+    parser.add_argument("--encode-ms", type=float, default=0.0, help="stand-in encoder cost per call")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app setting")
+    # output
+    parser.add_argument("--out", default=None, help="write this run's report (JSON)")
+    parser.add_argument("--save-baseline", default=None, help="write the report as the new baseline")
+    parser.add_argument("--compare", default=None, help="baseline JSON to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--min-delta-ms", type=float, default=5.0)
+    args = parser.parse_args(argv)
+    args.distinct_images = args.distinct_images or args.users * args.chats
+
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        base_url = args.url or boot_app(args, workdir)
+        wait_ready(base_url)
+        images = make_images(args.distinct_images)
+
+        if args.warmup_users:
+            # own images, so the measured run does not start with classification cache hits
+            warm_images = make_images(args.warmup_users * args.chats, seed=1)
+            Workload(base_url, args, warm_images, Recorder()).run(args.warmup_users, args.warmup_users)
+        rec = Recorder()
+        wall = Workload(base_url, args, images, rec).run(args.users, args.concurrency)
+
+    report = build_report(rec, wall, args)
+    print(format_report(report))
+    for path in (args.out, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"\nWrote {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print(f"\nWarning: {args.compare} was recorded with a different configuration")
+        problems = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        print(f"\nCompared with {args.compare} (recorded {baseline.get('created_at')}): ", end="")
+        if problems:
+            print(f"{len(problems)} regression(s)")
+            for p in problems:
+                print(f"  {p}")
+            raise SystemExit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
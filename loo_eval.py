@@ -0,0 +1,178 @@
+"""
+Leave-one-out evaluation of the RAG + LLM pipeline over the whole QA set.
+
+Every Q/A pair in dermatology_qa.json is used once as the user question,
+with that pair removed from the retrievable set. Results stream to a JSONL
+file (one line per question) and a rerun skips questions already in it,
+so an interrupted run resumes where it stopped:
+
+    python -m src.loo_eval --out loo_eval_output_medgemma.jsonl \
+        --export-json loo_eval_output_medgemma.json --workers 4
+
+--export-json writes the {class: {"per_question": [...]}} layout that
+llm-as-a-judge.ipynb reads.
+"""
+import argparse, json, os, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import torch
+
+from src.llm import MedicalLLMHelper
+from src.rag import RetrievalAugmentedGeneration
+
+
+def repair_tail(out_path: str):
+    """Drop a half-written last line left by an interrupted run."""
+    with open(out_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def load_done(out_path: str) -> set:
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    repair_tail(out_path)
+    with open(out_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done.add((item["class"], item["index"]))
+    return done
+
+
+def export_json(jsonl_path: str, json_path: str):
+    grouped = {}
+    with open(jsonl_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            grouped.setdefault(item["class"], {"per_question": []})["per_question"].append(item)
+    for content in grouped.values():
+        content["per_question"].sort(key=lambda it: it["index"])
+    with open(json_path, "w") as f:
+        json.dump(grouped, f, indent=2, ensure_ascii=False)
+
+
+def run(
+    rag: RetrievalAugmentedGeneration,
+    out_path: str,
+    batch_size: int = 32,
+    workers: int = 4,
+    top_k: int = 5,
+    thresh: float = 0.75,
+    limit: int = None,
+):
+    done = load_done(out_path)
+    todo = [
+        (disease, i)
+        for disease, entry in rag.derm_data.items()
+        for i in range(len(entry["qa_pairs"]))
+        if (disease, i) not in done
+    ][:limit]
+    print(f"{len(done)} already done, {len(todo)} to go")
+
+    write_lock = threading.Lock()
+    started = time.perf_counter()
+    finished = 0
+
+    def generate(job):
+        disease, i, ctx = job
+        qa = rag.derm_data[disease]["qa_pairs"][i]
+        if ctx is None:
+            answer = None
+        else:
+            answer = rag.helper.generate_answer(disease, qa["question"], ctx)
+        return {
+            "class": disease,
+            "index": i,
+            "original_question": qa["question"],
+            "original_answer": qa["answer"],
+            "refined_question": ctx["refined_question"] if ctx else None,
+            "retrieved_qa_pairs": ctx["matched_qa_pairs"] if ctx else [],
+            "generated_answer_long": answer,
+        }
+
+    with open(out_path, "a") as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        for b in range(0, len(todo), batch_size):
+            chunk = todo[b:b + batch_size]
+            queries = [(d, rag.derm_data[d]["qa_pairs"][i]["question"]) for d, i in chunk]
+            contexts = rag.retrieve_many(
+                queries,
+                top_k=top_k,
+                thresh=thresh,
+                exclude_rows=[[rag.catalog.row_of(d, i)] for d, i in chunk],
+                max_workers=workers,
+            )
+            futures = [pool.submit(generate, (d, i, ctx)) for (d, i), ctx in zip(chunk, contexts)]
+            for fut in futures:
+                try:
+                    item = fut.result()
+                except Exception as e:
+                    print(f"Generation failed: {e}")
+                    continue
+                with write_lock:
+                    out.write(json.dumps(item, ensure_ascii=False) + "\n")
+                    out.flush()
+                finished += 1
+            rate = finished / (time.perf_counter() - started)
+            print(f"{len(done) + finished}/{len(done) + len(todo)} questions ({rate:.2f}/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Leave-one-out RAG evaluation over the full QA set.")
+    parser.add_argument("--qa-json", default="dataset/dermatology_qa.json")
+    parser.add_argument("--encoder", default="dmis-lab/biobert-base-cased-v1.1")
+    parser.add_argument("--index-dir", default="dataset/qa_index")
+    parser.add_argument("--model", default="hf.co/unsloth/medgemma-4b-it-GGUF:Q8_K_XL")
+    parser.add_argument("--host", default="http://localhost:11434")
+    parser.add_argument("--out", required=True, help="JSONL results file (appended to / resumed from)")
+    parser.add_argument("--export-json", default=None, help="also write the notebook's JSON layout")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=4, help="concurrent LLM calls")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--thresh", type=float, default=0.75)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    # one Ollama slot per worker, and no queue timeout: an offline run should wait
+    # for a slot rather than drop questions as LLMBusy
+    helper = MedicalLLMHelper(model=args.model, host=args.host, max_in_flight=args.workers, queue_timeout=None)
+    rag = RetrievalAugmentedGeneration(
+        helper=helper,
+        qa_json_path=args.qa_json,
+        encoder_name=args.encoder,
+        device=device,
+        index_dir=args.index_dir,
+    )
+
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    run(
+        rag,
+        args.out,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        top_k=args.top_k,
+        thresh=args.thresh,
+        limit=args.limit,
+    )
+    if args.export_json:
+        export_json(args.out, args.export_json)
+        print(f"Wrote {args.export_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+Minimal in-process metrics: latency histograms, counters and callback
+gauges rendered in the Prometheus text exposition format, plus `span()`
+timers that also feed an optional per-request timing breakdown.
+
+    with span("rag.encode"):
+        emb = encoder.encode(q)
+"""
+import threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_num(v: float) -> str:
+    v = float(v)
+    return str(int(v)) if v.is_integer() and abs(v) < 1e15 else repr(v)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_num(v)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict = {}     # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(key)
+            if s is None:
+                s = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        inf = 'le="+Inf"'
+        for key, s in sorted(series.items()):
+            cum = 0
+            for b, c in zip(self.buckets, s):
+                cum += c
+                le = f'le="{_fmt_num(b)}"'
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cum}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, inf)} {s[-1]}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {s[-2]!r}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {s[-1]}")
+        return lines
+
+
+class CallbackGauge:
+    """Gauge(s) read at scrape time: `fn()` returns {labels-tuple: value} or a number."""
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: Iterable[str] = ()):
+        self.name, self.help, self.fn, self.labelnames = name, help, fn, tuple(labelnames)
+
+    def render(self) -> list[str]:
+        try:
+            values = self.fn()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {_escape(e)}"]
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, v in sorted(values.items()):
+            if v is None:
+                continue
+            key = key if isinstance(key, tuple) else (key,)
+            lines.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {_fmt_num(v)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, name, factory):
+        with self._lock:
+            m = self._metrics.get(name)
+            if m is None:
+                m = self._metrics[name] = factory()
+            return m
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._get_or_create(name, lambda: Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(name, lambda: Histogram(name, help, labelnames, buckets))
+
+    def gauge_callback(self, name, help, fn, labelnames=()) -> CallbackGauge:
+        gauge = CallbackGauge(name, help, fn, labelnames)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_LATENCY = REGISTRY.histogram(
+    "derm_stage_duration_seconds",
+    "Latency of individual pipeline stages.",
+    labelnames=("stage",),
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "derm_stage_errors_total",
+    "Exceptions raised inside pipeline stages.",
+    labelnames=("stage",),
+)
+
+# per-request breakdown: stage -> [total seconds, count]
+_request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a pipeline stage into the stage histogram (and the current request's breakdown)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - t0)
+
+
+def record_stage(stage: str, seconds: float):
+    """Record a duration measured elsewhere (e.g. reported by Ollama) like a `span`."""
+    STAGE_LATENCY.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        entry = timings.setdefault(stage, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+
+
+def start_request_timings():
+    """Begin collecting a per-request breakdown in the current context; returns a reset token."""
+    return _request_timings.set({})
+
+
+def end_request_timings(token):
+    _request_timings.reset(token)
+
+
+def request_timings() -> Optional[dict]:
+    """{stage: {"ms": total, "count": n}} for the current request, or None."""
+    timings = _request_timings.get()
+    if timings is None:
+        return None
+    return {
+        stage: {"ms": round(total * 1000.0, 2), "count": count}
+        for stage, (total, count) in timings.items()
+    }
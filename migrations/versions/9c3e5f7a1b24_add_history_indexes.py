@@ -0,0 +1,34 @@
+"""composite (parent, created_at, id) indexes for keyset pagination
+
+Revision ID: 9c3e5f7a1b24
+Revises: 4b1d0c2a9e71
+Create Date: 2026-10-17 09:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c3e5f7a1b24'
+down_revision = '4b1d0c2a9e71'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_chat_user_created': ('chat', ['user_id', 'created_at', 'id']),
+    'ix_message_chat_created': ('message', ['chat_id', 'created_at', 'id']),
+}
+
+
+def upgrade():
+    # databases created with db.create_all() after the indexes were added already have them
+    inspector = sa.inspect(op.get_bind())
+    for name, (table, columns) in INDEXES.items():
+        if name not in {ix['name'] for ix in inspector.get_indexes(table)}:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, (table, _) in INDEXES.items():
+        op.drop_index(name, table_name=table)
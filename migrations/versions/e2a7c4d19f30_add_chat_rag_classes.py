@@ -0,0 +1,28 @@
+"""chat.rag_classes: the diseases a chat's retrieval session searches
+
+Revision ID: e2a7c4d19f30
+Revises: 9c3e5f7a1b24
+Create Date: 2026-10-17 11:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c4d19f30'
+down_revision = '9c3e5f7a1b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases created with db.create_all() after the column was added already have it
+    inspector = sa.inspect(op.get_bind())
+    if 'rag_classes' not in {c['name'] for c in inspector.get_columns('chat')}:
+        op.add_column('chat', sa.Column('rag_classes', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('chat') as batch_op:
+        batch_op.drop_column('rag_classes')
@@ -2,22 +2,124 @@ import torch
 from PIL import Image
 import torchvision.transforms as transforms
 import os
-from src.classifier import ConvNeXtTinyClassifier
+from src.classifier import ConvNeXtTinyClassifier, build_class_list
 from src.llm import MedicalLLMHelper
 from src.rag import RetrievalAugmentedGeneration
-from pathlib import Path
-import glob
+from src.batching import MicroBatcher
+from src.classification_cache import ClassificationCache, content_hash
+from src.conversation import ConversationMemory
+from src.deadline import DeadlineExceeded
+from src.metrics import span
+from src.ollama_client import LLMBusy
+from src.retrieval_session import SessionCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import functools
+import threading
+import time
 
 class DermatologyAssistant:
-    def __init__(self):
-        # Initialize classifier
-        self.classifier = self._load_classifier()
+    NO_IMAGE_REPLY = "I notice you haven't uploaded an image yet. To provide the most accurate medical advice, please upload a clear image of the affected area. Once you do, I can analyze it and provide specific guidance about your condition."
+    CLASSIFICATION_ERROR_REPLY = "I apologize, but I had trouble analyzing your image. Could you please try uploading a clearer image? Make sure the affected area is well-lit and in focus."
+    NO_CONTEXT_REPLY = "I apologize, but I couldn't find relevant information for your question. Could you please rephrase your question or provide more details about your concern?"
+    GENERATION_ERROR_REPLY = "I apologize, but I encountered an error while generating the response."
+    BUSY_REPLY = "I'm answering a lot of questions right now. Please try again in a moment."
+    TIMEOUT_REPLY = "I'm sorry, this is taking longer than expected. Please ask again in a moment."
+    # not worth repeating to the LLM as conversation history
+    CANNED_REPLIES = (NO_IMAGE_REPLY, CLASSIFICATION_ERROR_REPLY, NO_CONTEXT_REPLY,
+                      GENERATION_ERROR_REPLY, BUSY_REPLY, TIMEOUT_REPLY)
+
+    COMPONENTS = ("classifier", "llm", "rag")
+
+    def __init__(
+        self,
+        batch_max_size: int = 8,
+        batch_max_wait_ms: float = 10.0,
+        classifier_opts: dict = None,
+        rag_opts: dict = None,
+        llm_opts: dict = None,
+        load_mode: str = "eager",
+        warmup: bool = False,
+        cache_path: str = None,
+        cache_max_entries: int = 10000,
+        cache_top_k: int = 3,
+        session_cache_size: int = 1024,
+        session_ttl: float = 3600.0,
+        followup_reformulate: bool = False,
+        session_carry: float = 0.0,
+        history_tokens: int = 1024,
+        loaders: dict = None,
+    ):
+        """
+        load_mode:
+            "eager"       load every component in parallel before returning (default)
+            "background"  start the same parallel load in a background thread
+            "lazy"        load each component on first use
+        warmup: run one dummy inference per component right after it loads.
+        cache_path: SQLite file for the (image hash, model version) -> top-k
+            classification cache; None disables caching.
+        session_cache_size: chats whose retrieval session (candidate
+            embeddings, description, matched pairs) is kept in memory so
+            follow-up questions skip the per-turn setup; 0 disables it.
+        followup_reformulate: also rewrite follow-up questions with the LLM
+            before encoding them (the first turn always is).
+        session_carry: weight of the previous turns' scores when re-ranking.
+        history_tokens: prompt budget for earlier turns of the chat; older
+            turns are folded into a per-chat rolling summary. 0 answers
+            every question on its own.
+        loaders: {component: factory(assistant)} replacing the default
+            loaders, e.g. the load-test stand-ins (src/standins.py).
+        """
+        if load_mode not in ("eager", "background", "lazy"):
+            raise ValueError(f"Unknown load_mode: {load_mode}")
+        unknown = set(loaders or {}) - set(self.COMPONENTS)
+        if unknown:
+            raise ValueError(f"Unknown components in loaders: {sorted(unknown)}")
+
+        # Extra ConvNeXtTinyClassifier kwargs, e.g. backend / artifact_path / num_threads
+        self.classifier_opts = classifier_opts or {}
+        # Extra RetrievalAugmentedGeneration kwargs, e.g. search_mode / retrieval_mode / shortlist
+        self.rag_opts = rag_opts or {}
+        # Extra MedicalLLMHelper kwargs, e.g. host / max_in_flight / keep_alive
+        self.llm_opts = llm_opts or {}
+        self.load_mode = load_mode
+        self.warmup = warmup
+
+        # Components are loaded once, on demand, behind a per-component lock
+        self._components = {}
+        self._status = {name: {"state": "pending"} for name in self.COMPONENTS}
+        self._locks = {name: threading.Lock() for name in self.COMPONENTS}
+        self._loaders = {
+            "classifier": self._load_classifier,
+            "llm": self._load_llm,
+            "rag": self._load_rag,
+        }
+        for name, factory in (loaders or {}).items():
+            self._loaders[name] = functools.partial(factory, self)
+        self._warmers = {
+            "classifier": self._warmup_classifier,
+            "llm": self._warmup_llm,
+            "rag": self._warmup_rag,
+        }
+
+        # Concurrent uploads share one forward pass (batch_max_size <= 1 disables)
+        self.batcher = None
+        if batch_max_size and batch_max_size > 1:
+            self.batcher = MicroBatcher(
+                lambda imgs, **kw: self.classifier.predict_batch(imgs, **kw),
+                max_batch_size=batch_max_size,
+                max_wait_ms=batch_max_wait_ms,
+                name="classifier",
+            )
         
-        # Initialize LLM
-        self.llm = self._load_llm()
+        # Re-uploads of the same photo skip the classifier
+        self.cache_top_k = cache_top_k
+        self.cache = ClassificationCache(cache_path, cache_max_entries) if cache_path else None
         
-        # Initialize RAG
-        self.rag = self._load_rag()
+        # Follow-up messages in a chat re-rank that chat's cached candidates
+        self.sessions = SessionCache(session_cache_size, session_ttl) if session_cache_size else None
+        self.followup_reformulate = followup_reformulate
+        self.session_carry = session_carry
+        self.memory = ConversationMemory(history_tokens, session_cache_size or 1024, session_ttl) if history_tokens else None
         
         # Image preprocessing
         self.transform = transforms.Compose([
@@ -26,16 +128,97 @@ class DermatologyAssistant:
             transforms.Normalize([0.5]*3, [0.5]*3),
         ])
 
+        if load_mode == "eager":
+            self.load_all()
+        elif load_mode == "background":
+            threading.Thread(target=self.load_all, name="model-loader", daemon=True).start()
+
+    # ---------- component loading ----------
+    @property
+    def classifier(self):
+        return self._component("classifier")
+
+    @property
+    def llm(self):
+        return self._component("llm")
+
+    @property
+    def rag(self):
+        return self._component("rag")
+
+    def _component(self, name):
+        comp = self._components.get(name)
+        if comp is not None:
+            return comp
+        with self._locks[name]:
+            if name in self._components:
+                return self._components[name]
+            status = self._status[name]
+            status.update(state="loading", started_at=time.time())
+            t0 = time.perf_counter()
+            try:
+                comp = self._loaders[name]()
+            except Exception as e:
+                status.update(state="failed", error=str(e), load_seconds=round(time.perf_counter() - t0, 3))
+                raise
+            status.update(state="ready", load_seconds=round(time.perf_counter() - t0, 3))
+            self._components[name] = comp
+        if self.warmup:
+            self._warm(name)
+        return comp
+
+    def _warm(self, name):
+        t0 = time.perf_counter()
+        try:
+            self._warmers[name]()
+            self._status[name]["warmup_seconds"] = round(time.perf_counter() - t0, 3)
+        except Exception as e:
+            print(f"Warm-up of {name} failed: {e}")
+            self._status[name]["warmup_error"] = str(e)
+
+    def load_all(self):
+        """Load all components concurrently (model loading releases the GIL for I/O and torch ops)."""
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=len(self.COMPONENTS), thread_name_prefix="load") as pool:
+            futures = {pool.submit(self._component, name): name for name in self.COMPONENTS}
+            for fut in as_completed(futures):
+                if fut.exception() is not None:
+                    print(f"Failed to load {futures[fut]}: {fut.exception()}")
+        self.total_load_seconds = round(time.perf_counter() - t0, 3)
+
+    def is_ready(self) -> bool:
+        if self.load_mode == "lazy":
+            return not any(st["state"] == "failed" for st in self._status.values())
+        return all(st["state"] == "ready" for st in self._status.values())
+
+    def status(self) -> dict:
+        return {
+            "load_mode": self.load_mode,
+            "ready": self.is_ready(),
+            "total_load_seconds": getattr(self, "total_load_seconds", None),
+            "components": {name: dict(st) for name, st in self._status.items()},
+            # effective retrieval mode, so a BM25 fallback shows up in /healthz and /readyz
+            "retrieval": self.rag.retrieval_status() if "rag" in self._components else None,
+        }
+
+    def _warmup_classifier(self):
+        self.classifier.predict_batch([Image.new("RGB", (224, 224))])
+
+    def _warmup_llm(self):
+        # an empty prompt makes Ollama load the model into memory without generating
+        self.llm.pool.warmup(self.llm.model)
+
+    def _warmup_rag(self):
+        if self.rag.encoder is not None:
+            self.rag.encoder.encode("warm-up", convert_to_numpy=True)
+        if self.rag.lexical is not None:
+            self.rag.lexical.scores("warm-up")
+
     def build_class_list(self, dataset_root: str = "dataset/train") -> list[str]:
         """
         dataset/train/<class_name>/**  dizin yapısından sınıf adlarını alır
         """
-        class_dirs = sorted(
-            [Path(p).name for p in glob.glob(os.path.join(dataset_root, "*")) if os.path.isdir(p)]
-        )
-        if not class_dirs:
-            raise RuntimeError(f"No class folders found in {dataset_root}")
-        return class_dirs
+        return build_class_list(dataset_root)
     
     def _load_classifier(self):
         # Load the classifier with your trained weights
@@ -44,69 +227,267 @@ class DermatologyAssistant:
         return ConvNeXtTinyClassifier(
             weights_path=weights_path,
             class_names=class_names,
-            device="cuda" if torch.cuda.is_available() else "cpu"
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            **self.classifier_opts
         )
     
     def _load_llm(self):
-        return MedicalLLMHelper(
-            model="hf.co/unsloth/medgemma-4b-it-GGUF:Q8_K_XL",
-            host=" ",
-            temperature=0.6,
-            top_p=0.9
-        )
+        opts = {
+            "model": "hf.co/unsloth/medgemma-4b-it-GGUF:Q8_K_XL",
+            "host": " ",
+            "temperature": 0.6,
+            "top_p": 0.9,
+            **self.llm_opts,
+        }
+        return MedicalLLMHelper(**opts)
     
     def _load_rag(self):
         return RetrievalAugmentedGeneration(
             helper=self.llm,
             qa_json_path="dataset/dermatology_qa.json",
             encoder_name="dmis-lab/biobert-base-cased-v1.1",
-            device="cuda" if torch.cuda.is_available() else "cpu"
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            **self.rag_opts
         )
     
-    def predict_image(self, image_path):
-        """Predict the class of a dermatology image."""
+    def predict_image(self, image, image_hash=None):
+        """Predict the class of a dermatology image (file path, raw bytes or PIL image)."""
+        return self.classify(image, image_hash=image_hash)[0]
+    
+    def classify(self, image, image_hash=None):
+        """(top-1 class, top-k [(class, prob), ...]); the top-k is empty on error."""
         try:
-            prediction = self.classifier.predict(image_path)
-            return prediction
+            with span("classify"):
+                topk = self.predict_image_topk(image, image_hash=image_hash)
+            return topk[0][0], topk
         except Exception as e:
             print(f"Error in image prediction: {e}")
-            return "Error in image classification"
+            return "Error in image classification", []
     
-    def generate_response(self, image_class, user_message, rag_context=None):
-        """Generate a response using the LLM with optional RAG context."""
+    def predict_image_topk(self, image, image_hash=None):
+        """
+        Top-`cache_top_k` [(class, prob), ...] for an image, served from the
+        classification cache when this exact image was seen by this model.
+        """
+        if self.cache is not None and image_hash is None:
+            image_hash = self._hash_image(image)
+        if self.cache is not None and image_hash:
+            with span("classify.cache_lookup"):
+                cached = self.cache.get(image_hash, self.classifier.model_version)
+            if cached is not None:
+                return cached
+        
+        kwargs = {"top_k": self.cache_top_k, "return_probs": True}
+        with span("classify.model"):
+            if self.batcher is not None:
+                result = self.batcher.predict(image, **kwargs)
+            else:
+                result = self.classifier.predict_batch([image], **kwargs)[0]
+        
+        if self.cache is not None and image_hash:
+            self.cache.put(image_hash, self.classifier.model_version, result)
+        return result
+    
+    @staticmethod
+    def _hash_image(image):
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return content_hash(bytes(image))
+        if isinstance(image, (str, os.PathLike)):
+            with open(image, "rb") as f:
+                return content_hash(f.read())
+        return None     # PIL images etc. are not cached
+    
+    def generate_response(self, image_class, user_message, rag_context=None, chat_id=None, deadline=None,
+                          history=None, classes=None):
+        """
+        Generate a response using the LLM with optional RAG context.
+        With `chat_id`, missing context comes from that chat's retrieval session,
+        rebuilt over `classes` (the diseases of its upload turn) when evicted.
+        With a `deadline` (src/deadline.py) retrieval and generation shrink to
+        fit the remaining budget; past it the reply is TIMEOUT_REPLY.
+        `history`: the chat's earlier text messages, oldest first, as
+        {"id", "role", "content"} (see src/conversation.py).
+        """
+        with span("generate_response"):
+            return self._generate_response(image_class, user_message, rag_context, chat_id, deadline, history,
+                                           classes)
+    
+    def _generate_response(self, image_class, user_message, rag_context=None, chat_id=None, deadline=None,
+                           history=None, classes=None):
         try:
             # If no image class is provided, use a default response
             if image_class is None:
-                return "I notice you haven't uploaded an image yet. To provide the most accurate medical advice, please upload a clear image of the affected area. Once you do, I can analyze it and provide specific guidance about your condition."
+                return self.NO_IMAGE_REPLY
             
             # If image class is "Error in image classification"
             if image_class == "Error in image classification":
-                return "I apologize, but I had trouble analyzing your image. Could you please try uploading a clearer image? Make sure the affected area is well-lit and in focus."
+                return self.CLASSIFICATION_ERROR_REPLY
             
             # Get RAG context if not provided
             if rag_context is None:
-                rag_context = self.rag.retrieve(image_class, user_message)
+                rag_context = self._followup_context(image_class, user_message, chat_id, deadline, classes)
             
             if rag_context is None:
-                return "I apologize, but I couldn't find relevant information for your question. Could you please rephrase your question or provide more details about your concern?"
+                return self.NO_CONTEXT_REPLY
             
+            summary, recent = self._conversation(chat_id, history, deadline)
             response = self.llm.generate_answer(
                 disease_name=image_class,
                 user_q=user_message,
-                rag_out=rag_context
+                rag_out=rag_context,
+                deadline=deadline,
+                history=recent,
+                summary=summary
             )
             return response
+        except DeadlineExceeded as e:
+            print(f"Deadline exceeded: {e}")
+            return self.TIMEOUT_REPLY
+        except LLMBusy as e:
+            print(f"LLM busy: {e}")
+            return self.BUSY_REPLY
         except Exception as e:
             print(f"Error in response generation: {e}")
-            return "I apologize, but I encountered an error while generating the response."
+            return self.GENERATION_ERROR_REPLY
     
-    def get_rag_context(self, user_message, image_class):
-        """Retrieve relevant context for RAG."""
+    def generate_response_stream(self, image_class, user_message, rag_context=None, chat_id=None, deadline=None,
+                                 history=None, classes=None):
+        """
+        Streaming variant of `generate_response`: yields the answer in chunks
+        as the LLM produces them. Canned replies are yielded as one chunk.
+        """
         try:
-            return self.rag.retrieve(image_class, user_message)
+            # Canned replies aren't streamed
+            if image_class is None:
+                yield self.NO_IMAGE_REPLY
+                return
+            
+            if image_class == "Error in image classification":
+                yield self.CLASSIFICATION_ERROR_REPLY
+                return
+            
+            if rag_context is None:
+                rag_context = self._followup_context(image_class, user_message, chat_id, deadline, classes)
+            
+            if rag_context is None:
+                yield self.NO_CONTEXT_REPLY
+                return
+            
+            summary, recent = self._conversation(chat_id, history, deadline)
+        except DeadlineExceeded as e:
+            print(f"Deadline exceeded: {e}")
+            yield self.TIMEOUT_REPLY
+            return
         except Exception as e:
-            print(f"Error in RAG context retrieval: {e}")
+            print(f"Error in response generation: {e}")
+            yield self.GENERATION_ERROR_REPLY
+            return
+        
+        produced = False
+        try:
+            for token in self.llm.generate_answer_stream(
+                disease_name=image_class,
+                user_q=user_message,
+                rag_out=rag_context,
+                deadline=deadline,
+                history=recent,
+                summary=summary
+            ):
+                produced = True
+                yield token
+        except DeadlineExceeded as e:
+            print(f"Deadline exceeded: {e}")
+            if not produced:
+                yield self.TIMEOUT_REPLY
+        except LLMBusy as e:
+            print(f"LLM busy: {e}")
+            yield self.BUSY_REPLY
+        except Exception as e:
+            print(f"Error in streamed response generation: {e}")
+            if not produced:
+                yield self.GENERATION_ERROR_REPLY
+    
+    def _conversation(self, chat_id, history, deadline=None):
+        """(summary, recent turns) of the chat's earlier messages for the answer prompt."""
+        history = [m for m in history or [] if m["content"] not in self.CANNED_REPLIES]
+        if self.memory is None or not history:
+            return None, []
+        with span("conversation.context"):
+            return self.memory.context(self.llm, chat_id, history, deadline)
+    
+    def batching_stats(self):
+        """Achieved batch sizes and queueing delay of the classifier batcher."""
+        return self.batcher.stats() if self.batcher is not None else None
+
+    def cache_stats(self):
+        """Hit rate and size of the classification cache."""
+        return self.cache.stats() if self.cache is not None else None
+
+    def llm_cache_stats(self):
+        """Hit/miss/coalesced counters of the LLM completion cache (None until the LLM is loaded)."""
+        if "llm" not in self._components:
+            return None
+        return self.llm.cache_stats()
+
+    def llm_pool_stats(self):
+        """In-flight/waiting/retry counters of the Ollama client pool (None until the LLM is loaded)."""
+        if "llm" not in self._components:
             return None
+        return self.llm.pool_stats()
 
-# Create a singleton instance
-assistant = DermatologyAssistant() 
\ No newline at end of file
+    def get_rag_context(self, user_message, image_class, classes=None, chat_id=None, deadline=None):
+        """
+        Retrieve relevant context for RAG. `classes` widens the search to
+        several diseases, e.g. the classifier's top-k. With `chat_id` a fresh
+        retrieval session is opened for the chat's follow-up questions.
+        """
+        try:
+            with span("rag.context"):
+                if chat_id is None or self.sessions is None:
+                    return self.rag.retrieve(image_class, user_message, classes=classes, deadline=deadline)
+                session = self.rag.open_session(image_class, classes)
+                if session is None:
+                    return None
+                self.sessions.put(chat_id, session)
+                return self.rag.retrieve_in_session(session, user_message, deadline=deadline)
+        except Exception as e:
+            print(f"Error in RAG context retrieval: {e}")
+            return None 
+    
+    def _followup_context(self, image_class, user_message, chat_id=None, deadline=None, classes=None):
+        """Context for a text-only turn, reusing the chat's session when there is one."""
+        if chat_id is None or self.sessions is None:
+            return self.rag.retrieve(image_class, user_message, classes=classes, deadline=deadline)
+        with span("rag.context"):
+            session = self.sessions.get(chat_id)
+            if session is None or not session.covers(image_class, classes):
+                # evicted or restarted: rebuild from the chat's classification
+                session = self.rag.open_session(image_class, classes)
+                if session is None:
+                    return None
+                self.sessions.put(chat_id, session)
+            return self.rag.retrieve_in_session(
+                session,
+                user_message,
+                reformulate=self.followup_reformulate,
+                carry=self.session_carry,
+                deadline=deadline,
+            )
+    
+    def session_stats(self):
+        """Hit rate and size of the per-chat retrieval session cache."""
+        return self.sessions.stats() if self.sessions is not None else None
+
+    def summarized_upto(self, chat_id):
+        """Last message id covered by the chat's conversation summary; the caller loads the rest."""
+        return self.memory.summarized_upto(chat_id) if self.memory is not None else None
+
+    def conversation_stats(self):
+        """Hit rate and size of the per-chat conversation summary cache."""
+        return self.memory.stats() if self.memory is not None else None
+
+    def query_cache_stats(self):
+        """Hit rate and size of the query embedding cache (None until RAG is loaded / without it)."""
+        if "rag" not in self._components or not hasattr(self.rag.encoder, "stats"):
+            return None
+        return self.rag.encoder.stats()
\ No newline at end of file
@@ -0,0 +1,234 @@
+import queue, random, threading, time
+from typing import Callable, Iterator, Optional, Union
+
+import httpx
+from ollama import Client, ResponseError
+
+from src.metrics import REGISTRY
+
+QUEUE_WAIT = REGISTRY.histogram(
+    "derm_llm_queue_wait_seconds",
+    "Time an LLM request waited for a free Ollama slot.",
+    labelnames=("mode",),
+)
+GENERATION_TIME = REGISTRY.histogram(
+    "derm_llm_generation_seconds",
+    "Time from acquiring an Ollama slot to the end of generation.",
+    labelnames=("mode",),
+)
+RETRIES = REGISTRY.counter(
+    "derm_llm_retries_total",
+    "Ollama calls retried after a transient error.",
+    labelnames=("mode",),
+)
+REJECTED = REGISTRY.counter(
+    "derm_llm_rejected_total",
+    "LLM requests that gave up waiting for a free Ollama slot.",
+    labelnames=("mode",),
+)
+
+# HTTP statuses Ollama returns while loading a model / under memory pressure
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class LLMBusy(Exception):
+    """Raised when no Ollama slot frees up within the queue timeout."""
+
+
+class StreamStalled(Exception):
+    """Raised by `watch_stream` when no chunk arrives in time."""
+
+
+def is_transient(exc: BaseException) -> bool:
+    if isinstance(exc, (httpx.TransportError, ConnectionError)):
+        return True
+    if isinstance(exc, ResponseError):
+        return getattr(exc, "status_code", None) in RETRY_STATUSES
+    return False
+
+
+def watch_stream(stream: Iterator[dict], timeout: Callable[[], float]) -> Iterator[dict]:
+    """
+    Re-yield `stream`'s chunks, read on a helper thread so that waiting for
+    any of them -- including the first, i.e. Ollama's queueing and prefill --
+    gives up after `timeout()` seconds with StreamStalled instead of blocking
+    until the HTTP timeout. Closing the watcher stops the reader at its next
+    chunk, which closes `stream` (and frees its pool slot) from that thread.
+    """
+    chunks = queue.Queue()
+    stop = threading.Event()
+
+    def read():
+        try:
+            for chunk in stream:
+                if stop.is_set():
+                    return
+                chunks.put(("chunk", chunk))
+            chunks.put(("end", None))
+        except Exception as e:
+            chunks.put(("error", e))
+        finally:
+            stream.close()
+
+    threading.Thread(target=read, name="ollama-stream", daemon=True).start()
+    try:
+        while True:
+            wait = max(0.0, timeout())
+            try:
+                kind, value = chunks.get(timeout=wait)
+            except queue.Empty:
+                raise StreamStalled(f"No response from Ollama within {wait:.1f}s") from None
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
+
+
+class OllamaPool:
+    """
+    Bounded access to one Ollama server.
+
+    - one `ollama.Client` whose httpx connection pool holds at most
+      `pool_size` connections (kept alive between requests),
+    - at most `max_in_flight` generations at a time; extra callers wait up
+      to `queue_timeout` seconds for a slot and then get `LLMBusy`,
+    - transient errors (connection reset, 5xx while a model loads) are
+      retried `retries` times with jittered exponential backoff,
+    - `keep_alive` is sent with every request so Ollama keeps the model
+      resident between bursts.
+
+    Streaming calls hold their slot until the stream is exhausted or closed,
+    and are only retried before the first chunk has been yielded. A call's
+    `queue_timeout` (e.g. a request's remaining budget) can only shorten
+    the pool's.
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        max_in_flight: int = 2,
+        queue_timeout: Optional[float] = 30.0,
+        pool_size: Optional[int] = None,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        keep_alive: Union[str, float, None] = "30m",
+        request_timeout: Optional[float] = 300.0,
+    ):
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.keep_alive = keep_alive
+
+        pool_size = pool_size or max_in_flight + 2
+        self.client = Client(
+            host=host,
+            timeout=request_timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+        self._counters = {"requests": 0, "retries": 0, "rejected": 0, "errors": 0}
+
+    # ------------- slots -------------
+    def _acquire(self, mode: str, timeout: Optional[float] = None):
+        if timeout is None or (self.queue_timeout is not None and self.queue_timeout < timeout):
+            timeout = self.queue_timeout
+        with self._lock:
+            self._waiting += 1
+            self._counters["requests"] += 1
+        t0 = time.perf_counter()
+        try:
+            acquired = self._slots.acquire(timeout=timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        QUEUE_WAIT.observe(time.perf_counter() - t0, mode=mode)
+        if not acquired:
+            with self._lock:
+                self._counters["rejected"] += 1
+            REJECTED.inc(mode=mode)
+            raise LLMBusy(f"No Ollama slot free after {timeout}s ({self.max_in_flight} in flight)")
+        with self._lock:
+            self._in_flight += 1
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _sleep_before_retry(self, attempt: int, mode: str):
+        with self._lock:
+            self._counters["retries"] += 1
+        RETRIES.inc(mode=mode)
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    # ------------- calls -------------
+    def chat(self, queue_timeout: Optional[float] = None, **kwargs) -> dict:
+        kwargs.setdefault("keep_alive", self.keep_alive)
+        self._acquire("blocking", queue_timeout)
+        t0 = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    return self.client.chat(**kwargs)
+                except Exception as e:
+                    if attempt >= self.retries or not is_transient(e):
+                        with self._lock:
+                            self._counters["errors"] += 1
+                        raise
+                self._sleep_before_retry(attempt, "blocking")
+        finally:
+            GENERATION_TIME.observe(time.perf_counter() - t0, mode="blocking")
+            self._release()
+
+    def chat_stream(self, queue_timeout: Optional[float] = None, **kwargs) -> Iterator[dict]:
+        kwargs.setdefault("keep_alive", self.keep_alive)
+        kwargs["stream"] = True
+        self._acquire("stream", queue_timeout)
+        t0 = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                started = False
+                try:
+                    for chunk in self.client.chat(**kwargs):
+                        started = True
+                        yield chunk
+                    return
+                except Exception as e:
+                    if started or attempt >= self.retries or not is_transient(e):
+                        with self._lock:
+                            self._counters["errors"] += 1
+                        raise
+                self._sleep_before_retry(attempt, "stream")
+        finally:
+            GENERATION_TIME.observe(time.perf_counter() - t0, mode="stream")
+            self._release()
+
+    def warmup(self, model: str):
+        """Load `model` into Ollama memory without generating anything."""
+        self._acquire("warmup")
+        try:
+            self.client.generate(model=model, prompt="", keep_alive=self.keep_alive)
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "queue_timeout_seconds": self.queue_timeout,
+                "keep_alive": self.keep_alive,
+                **self._counters,
+            }
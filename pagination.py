@@ -0,0 +1,97 @@
+"""
+Keyset (cursor) pagination over (created_at, id).
+
+A cursor is an opaque URL-safe token for one row's (created_at, id). Pages
+are fetched with a range condition on that pair, so each page costs one
+index range scan on (parent_id, created_at, id) no matter how deep it is,
+unlike OFFSET which rescans every skipped row.
+"""
+import base64
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import tuple_
+
+MAX_LIMIT = 200
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Inverse of `encode_cursor`; raises ValueError for a malformed token."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor!r}") from e
+
+
+def parse_limit(value: Optional[str]) -> Optional[int]:
+    """Page size from a query parameter; None (no limit) when it is absent."""
+    if value in (None, ""):
+        return None
+    limit = int(value)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return min(limit, MAX_LIMIT)
+
+
+def keyset_page(
+    query,
+    model,
+    limit: Optional[int],
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    since: Optional[datetime] = None,
+    newest_first: bool = True,
+):
+    """
+    One page of `query` (already filtered to a user / chat).
+
+    before: rows older than this cursor (the page nearest to it)
+    after:  rows newer than this cursor
+    since:  rows created after this timestamp (polling for new messages)
+    Without any of them the newest `limit` rows are returned (all rows when
+    `limit` is None).
+
+    Returns (rows, has_more) with rows ordered newest-first or oldest-first
+    per `newest_first`; has_more says whether further rows exist beyond the
+    page in the direction it was fetched.
+    """
+    key = tuple_(model.created_at, model.id)
+    ascending = False
+    if before:
+        query = query.filter(key < decode_cursor(before))
+    if after:
+        query = query.filter(key > decode_cursor(after))
+        ascending = not before
+    if since is not None:
+        query = query.filter(model.created_at > since)
+        ascending = not before
+
+    order = (model.created_at.asc(), model.id.asc()) if ascending else (model.created_at.desc(), model.id.desc())
+    query = query.order_by(*order)
+    if limit is None:
+        rows, has_more = query.all(), False
+    else:
+        rows = query.limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    if ascending == newest_first:
+        rows.reverse()
+    return rows, has_more
+
+
+def page_headers(rows, has_more: bool) -> dict:
+    """Cursor headers for a page: X-Before-Cursor pages older, X-After-Cursor polls newer."""
+    headers = {"X-Has-More": "1" if has_more else "0"}
+    if rows:
+        oldest = min(rows, key=lambda r: (r.created_at, r.id))
+        newest = max(rows, key=lambda r: (r.created_at, r.id))
+        headers["X-Before-Cursor"] = encode_cursor(oldest.created_at, oldest.id)
+        headers["X-After-Cursor"] = encode_cursor(newest.created_at, newest.id)
+    return headers
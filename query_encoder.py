@@ -0,0 +1,372 @@
+"""
+Fast CPU path for the per-turn query embedding.
+
+The knowledge-base side of retrieval is precomputed (src/embedding_index.py),
+so a chat turn only encodes its own question. This module exports the
+sentence encoder's transformer to ONNX with int8 dynamic quantization, runs
+it with a truncated max sequence length, and puts a small LRU cache of
+query embeddings in front of whichever encoder is used. Queries are matched
+against the index built by the full fp32 encoder, so the artifact must come
+from the same encoder; `parity` checks how often the top-k still agrees on
+held-out queries (perturbed knowledge-base questions whose own pair is left
+out of the search).
+
+    # int8 ONNX export of BioBERT (+ tokenizer and pooling config)
+    python -m src.query_encoder export --out src/biobert_query_int8
+
+    # top-k agreement with the fp32 encoder and per-query latency
+    python -m src.query_encoder parity --artifact src/biobert_query_int8 --tolerance 0.05
+"""
+import argparse, json, os, random, shutil, statistics, tempfile, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_ENCODER = "dmis-lab/biobert-base-cased-v1.1"
+CONFIG_NAME = "encoder.json"
+MODEL_NAME = "model.onnx"
+
+
+def pool(hidden: np.ndarray, mask: np.ndarray, mode: str) -> np.ndarray:
+    """Sentence vectors from token states, like sentence_transformers' Pooling."""
+    if mode == "cls":
+        return hidden[:, 0]
+    mask = mask[..., None].astype(hidden.dtype)
+    if mode == "max":
+        return np.where(mask > 0, hidden, -1e9).max(axis=1)
+    if mode == "mean":
+        return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+    raise ValueError(f"Unsupported pooling mode: {mode}")
+
+
+class OnnxQueryEncoder:
+    """
+    SentenceTransformer-compatible `encode` over an exported ONNX transformer
+    (see `export_query_encoder`). Inputs longer than `max_seq_length` tokens
+    are truncated; the default is the one chosen at export time.
+    """
+
+    def __init__(self, artifact_dir: str, max_seq_length: Optional[int] = None, num_threads: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.path = Path(artifact_dir)
+        with (self.path / CONFIG_NAME).open() as f:
+            self.config = json.load(f)
+        self.encoder_name = self.config["encoder_name"]
+        self.pooling = self.config["pooling"]
+        self.max_seq_length = max_seq_length or self.config["max_seq_length"]
+        self.tokenizer = AutoTokenizer.from_pretrained(self.path)
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            str(self.path / MODEL_NAME), sess_options=opts, providers=["CPUExecutionProvider"]
+        )
+        self._inputs = [i.name for i in self.session.get_inputs()]
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.config["dim"]
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, **_):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = []
+        for b in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[b:b + batch_size], padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors="np",
+            )
+            hidden = self.session.run(None, {name: enc[name].astype(np.int64) for name in self._inputs})[0]
+            out.append(pool(hidden, enc["attention_mask"], self.pooling))
+        emb = np.concatenate(out).astype(np.float32) if out else np.zeros((0, self.config["dim"]), np.float32)
+        if normalize_embeddings:
+            emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        return emb[0] if single else emb
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU of query text -> embedding in front of an encoder. Only
+    single-string calls (one chat turn) are cached; batches such as index
+    builds and offline evaluation go straight to the encoder. Other
+    attributes are forwarded, so it can stand in for the encoder itself.
+    """
+
+    def __init__(self, encoder, max_entries: int = 256):
+        self.encoder = encoder
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __getattr__(self, name):
+        if name == "encoder":       # not set yet (e.g. while unpickling)
+            raise AttributeError(name)
+        return getattr(self.encoder, name)
+
+    def encode(self, sentences, **kwargs):
+        if not isinstance(sentences, str):
+            return self.encoder.encode(sentences, **kwargs)
+        key = (sentences, bool(kwargs.get("normalize_embeddings", False)))
+        with self._lock:
+            emb = self._entries.get(key)
+            if emb is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return emb.copy()
+            self._counters["misses"] += 1
+
+        emb = np.array(self.encoder.encode(sentences, **kwargs), copy=True)
+        with self._lock:
+            self._entries[key] = emb
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        return emb.copy()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                **self._counters,
+                "hit_rate": (self._counters["hits"] / lookups) if lookups else 0.0,
+            }
+
+
+# ---------- export ----------
+def export_query_encoder(encoder_name: str, out_dir: str, quantize: str = "dynamic",
+                         max_seq_length: int = 128, opset: int = 17):
+    """Write model.onnx, the tokenizer and encoder.json (pooling, dim, defaults) to `out_dir`."""
+    import torch
+    import torch.nn as nn
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Pooling
+
+    st = SentenceTransformer(encoder_name, device="cpu")
+    transformer = st[0].auto_model.eval()
+    pooling = next((m.get_pooling_mode_str() for m in st if isinstance(m, Pooling)), "mean")
+    sample = st.tokenizer(["Is this rash contagious?"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class _Hidden(nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(input_names, inputs))).last_hidden_state
+
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix="query-encoder-onnx-")
+    fp32_path = str(out / MODEL_NAME) if quantize == "none" else os.path.join(tmp_dir, "model_fp32.onnx")
+    try:
+        with torch.no_grad():
+            torch.onnx.export(
+                _Hidden(),
+                tuple(sample[n] for n in input_names),
+                fp32_path,
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes={n: {0: "batch", 1: "seq"} for n in input_names + ["last_hidden_state"]},
+                opset_version=opset,
+            )
+        if quantize == "dynamic":
+            quantize_dynamic(fp32_path, str(out / MODEL_NAME), weight_type=QuantType.QInt8)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    st.tokenizer.save_pretrained(out)
+    with (out / CONFIG_NAME).open("w") as f:
+        json.dump({
+            "encoder_name": encoder_name,
+            "pooling": pooling,
+            "dim": st.get_sentence_embedding_dimension(),
+            "max_seq_length": max_seq_length,
+            "quantize": quantize,
+        }, f, indent=2)
+
+
+# ---------- parity ----------
+def _latency_summary(lat: list) -> dict:
+    s = sorted(lat)
+    return {
+        "mean_ms": statistics.fmean(s),
+        "p50_ms": s[len(s) // 2],
+        "p95_ms": s[min(len(s) - 1, int(0.95 * len(s)))],
+    }
+
+
+def _time_encode(encoder, texts: list, warmup: int = 3):
+    for t in texts[:warmup]:
+        encoder.encode(t, convert_to_numpy=True, normalize_embeddings=True)
+    embs, lat = [], []
+    for t in texts:
+        t0 = time.perf_counter()
+        embs.append(np.asarray(encoder.encode(t, convert_to_numpy=True, normalize_embeddings=True), dtype=np.float32))
+        lat.append((time.perf_counter() - t0) * 1000.0)
+    return np.stack(embs), lat
+
+
+def perturb(question: str, rng: random.Random, drop: float) -> str:
+    """A crude paraphrase: drop a share of the words and swap one adjacent pair."""
+    words = [w for w in question.split() if rng.random() >= drop] or question.split()[:1]
+    if len(words) > 2:
+        i = rng.randrange(len(words) - 1)
+        words[i], words[i + 1] = words[i + 1], words[i]
+    return " ".join(words)
+
+
+def parity_check(
+    artifact_dir: str,
+    qa_json_path: str,
+    index_dir: str,
+    queries: int = 200,
+    top_k: int = 5,
+    alpha: float = 0.7,
+    tolerance: float = 0.05,
+    max_seq_length: Optional[int] = None,
+    num_threads: Optional[int] = None,
+    seed: int = 0,
+    drop: float = 0.3,
+) -> dict:
+    """
+    Encode held-out queries with the fp32 reference encoder and the exported
+    one, search the reference index with both, and compare the top-k and
+    the scores. Queries are knowledge-base questions perturbed by `perturb`,
+    searched with their own pair excluded, so neither encoder can just find
+    a near-copy of the query. Passes when the mean top-k overlap is at least
+    1 - tolerance.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    from src.embedding_index import QAEmbeddingIndex
+
+    cand = OnnxQueryEncoder(artifact_dir, max_seq_length, num_threads)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    ref = SentenceTransformer(cand.encoder_name, device="cpu")
+    index = QAEmbeddingIndex.load_or_build(ref, cand.encoder_name, qa_json_path, index_dir)
+
+    with Path(qa_json_path).open() as f:
+        derm_data = json.load(f)
+    # row order of the index: diseases in JSON order, then their pairs
+    questions = [qa["question"] for entry in derm_data.values() for qa in entry["qa_pairs"]]
+    rng = random.Random(seed)
+    rows = rng.sample(range(len(questions)), min(queries, len(questions)))
+    texts = [perturb(questions[row], rng, drop) for row in rows]
+
+    ref_emb, ref_lat = _time_encode(ref, texts)
+    cand_emb, cand_lat = _time_encode(cand, texts)
+    cached = QueryEmbeddingCache(cand, max_entries=len(texts))
+    for t in texts:
+        cached.encode(t, normalize_embeddings=True)
+    _, cached_lat = _time_encode(cached, texts, warmup=0)
+
+    exclude = [[row] for row in rows]
+    ref_results = index.search_many(ref_emb, top_k=top_k, alpha=alpha, exclude=exclude)
+    cand_results = index.search_many(cand_emb, top_k=top_k, alpha=alpha, exclude=exclude)
+    combined = index.combined(alpha)
+    overlap, top1, score_gap = [], [], []
+    for r, c, ref_res, cand_res in zip(ref_emb, cand_emb, ref_results, cand_results):
+        ref_hits = [row for row, _ in ref_res]
+        cand_hits = [row for row, _ in cand_res]
+        overlap.append(len(set(ref_hits) & set(cand_hits)) / max(len(ref_hits), 1))
+        top1.append(bool(ref_hits) and bool(cand_hits) and ref_hits[0] == cand_hits[0])
+        if ref_hits:
+            # how far the candidate's scores drift on the pairs the reference ranks first
+            score_gap.append(float(np.abs(combined[ref_hits] @ (c - r)).mean()))
+    cosine = np.sum(ref_emb * cand_emb, axis=1)
+
+    ref_stats, cand_stats = _latency_summary(ref_lat), _latency_summary(cand_lat)
+    mean_overlap = float(np.mean(overlap))
+    return {
+        "queries": len(texts),
+        "query_drop": drop,
+        "artifact": str(artifact_dir),
+        "artifact_mb": os.path.getsize(Path(artifact_dir) / MODEL_NAME) / 2**20,
+        "quantize": cand.config["quantize"],
+        "max_seq_length": cand.max_seq_length,
+        "top_k": top_k,
+        "cosine_to_reference": {"mean": float(cosine.mean()), "min": float(cosine.min())},
+        "cosine_gap": {"mean": float(1.0 - cosine.mean()), "max": float(1.0 - cosine.min())},
+        f"top{top_k}_score_gap": {
+            "mean": float(np.mean(score_gap)) if score_gap else None,
+            "max": float(np.max(score_gap)) if score_gap else None,
+        },
+        f"top{top_k}_overlap": {"mean": mean_overlap, "min": float(np.min(overlap))},
+        "top1_agreement": float(np.mean(top1)),
+        "tolerance": tolerance,
+        "passed": 1.0 - mean_overlap <= tolerance,
+        "reference": ref_stats,
+        "candidate": cand_stats,
+        "candidate_cached": _latency_summary(cached_lat),
+        "speedup": ref_stats["mean_ms"] / cand_stats["mean_ms"],
+    }
+
+
+# ---------- CLI ----------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export / validate the ONNX int8 query encoder for RAG retrieval.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    ex = sub.add_parser("export", help="write an ONNX query encoder directory")
+    ex.add_argument("--encoder", default=DEFAULT_ENCODER)
+    ex.add_argument("--quantize", choices=("none", "dynamic"), default="dynamic")
+    ex.add_argument("--max-seq-length", type=int, default=128)
+    ex.add_argument("--out", required=True)
+
+    pc = sub.add_parser("parity", help="compare an exported encoder with the fp32 reference")
+    pc.add_argument("--artifact", required=True)
+    pc.add_argument("--qa-json", default="dataset/dermatology_qa.json")
+    pc.add_argument("--index-dir", default="dataset/qa_index")
+    pc.add_argument("--queries", type=int, default=200)
+    pc.add_argument("--drop", type=float, default=0.3, help="share of words dropped from each query")
+    pc.add_argument("--top-k", type=int, default=5)
+    pc.add_argument("--alpha", type=float, default=0.7)
+    pc.add_argument("--tolerance", type=float, default=0.05, help="allowed loss of mean top-k overlap")
+    pc.add_argument("--max-seq-length", type=int, default=None)
+    pc.add_argument("--threads", type=int, default=None)
+    pc.add_argument("--json", default=None, help="also write the report to this file")
+
+    args = parser.parse_args(argv)
+
+    if args.cmd == "export":
+        export_query_encoder(args.encoder, args.out, args.quantize, args.max_seq_length)
+        size = os.path.getsize(Path(args.out) / MODEL_NAME) / 2**20
+        print(f"Wrote {args.out} ({size:.1f} MB)")
+        return
+
+    report = parity_check(
+        args.artifact,
+        args.qa_json,
+        args.index_dir,
+        queries=args.queries,
+        top_k=args.top_k,
+        alpha=args.alpha,
+        tolerance=args.tolerance,
+        max_seq_length=args.max_seq_length,
+        num_threads=args.threads,
+        drop=args.drop,
+    )
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if not report["passed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
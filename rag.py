@@ -1,9 +1,20 @@
-from sentence_transformers import SentenceTransformer, util
-import torch, json
+from concurrent.futures import ThreadPoolExecutor
+import torch, json, logging, os
+import numpy as np
 from pathlib import Path
 from src.llm import MedicalLLMHelper
+from src.embedding_index import QAEmbeddingIndex, index_key, top_k_order
+from src.lexical_index import BM25Index, fuse_scores
+from src.query_encoder import OnnxQueryEncoder, QueryEmbeddingCache
+from src.retrieval_session import RetrievalSession
+from src.metrics import span
 from huggingface_hub import login
-login(token=" ")
+if os.environ.get("HF_TOKEN"):
+    login(token=os.environ["HF_TOKEN"])
+
+RETRIEVAL_MODES = ("dense", "hybrid", "bm25")
+
+logger = logging.getLogger(__name__)
 
 class RetrievalAugmentedGeneration:
     def __init__(
@@ -13,46 +24,324 @@ class RetrievalAugmentedGeneration:
         encoder_name: str = "dmis-lab/biobert-base-cased-v1.1",
         device: str = "cuda",
         hybrid_alpha: float = 0.7,
+        index_dir: str = "dataset/qa_index",
+        search_mode: str = "exact",
+        ann_nprobe: int = 8,
+        encoder=None,
+        retrieval_mode: str = "dense",
+        shortlist: int = 64,
+        lexical_weight: float = 0.3,
+        fusion: str = "linear",
+        lexical_fallback: bool = True,
+        query_encoder: str = None,
+        max_seq_length: int = None,
+        query_cache_size: int = 256,
+        encoder_threads: int = None,
     ):
+        """
+        encoder: ready-made object with SentenceTransformer's `encode` (e.g.
+        the load-test stand-in); `encoder_name` still keys the index.
+        retrieval_mode:
+            "dense"   encoder similarity against every candidate pair (default)
+            "hybrid"  BM25 picks `shortlist` candidates, only those are scored
+                      densely; the ranking fuses both scores (`fusion`:
+                      "linear" | "rrf", `lexical_weight` is BM25's share)
+            "bm25"    lexical only, the encoder is not loaded
+        `hybrid_alpha` weighs question vs answer similarity in both the dense
+        and the BM25 score. `thresh` always applies to the dense score, so
+        "bm25" retrieval returns the best pairs sharing a term with the question.
+        lexical_fallback: serve BM25 retrieval instead of failing when the
+            full encoder cannot be loaded (model files unreachable, package
+            missing); logged as a warning and reported by `retrieval_status`.
+            A bad `query_encoder` always fails.
+        query_encoder: directory written by `python -m src.query_encoder
+            export` (ONNX, int8) used for questions instead of the full
+            encoder; it must come from `encoder_name`, whose index it searches.
+            The full encoder is then only loaded to (re)build that index.
+        max_seq_length: truncate questions to this many tokens.
+        query_cache_size: LRU of question -> embedding; 0 disables it.
+        """
+        if retrieval_mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval_mode: {retrieval_mode}")
+        if fusion not in ("linear", "rrf"):
+            raise ValueError(f"Unknown fusion method: {fusion}")
         self.device = torch.device(device)
         self.helper = helper
-        self.encoder = SentenceTransformer(encoder_name, device=device)
 
         with Path(qa_json_path).open() as f:
             self.derm_data = json.load(f)
 
+        self.encoder = None
+        self.index = None
+        self.configured_mode = retrieval_mode
+        self.fallback_reason = None
+        if retrieval_mode != "bm25":
+            # a configured query encoder is not covered by the BM25 fallback:
+            # a bad path, a broken export or an encoder mismatch fails startup
+            fast = OnnxQueryEncoder(query_encoder, max_seq_length, encoder_threads) if query_encoder else None
+            if fast is not None and fast.encoder_name != encoder_name:
+                raise ValueError(f"{query_encoder} was exported from {fast.encoder_name}, not {encoder_name}")
+            path = QAEmbeddingIndex.dir_for(index_dir, index_key(qa_json_path, encoder_name))
+            if fast is not None and encoder is None and (path / "meta.json").exists():
+                try:
+                    self.index = QAEmbeddingIndex.load(path)
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning("Embedding index at %s unreadable, rebuilding: %s", path, e)
+            # the full encoder encodes questions without a query encoder and (re)builds the index
+            reference = encoder
+            if reference is None and self.index is None:
+                try:
+                    reference = self._load_encoder(encoder_name, device)
+                except (OSError, ImportError) as e:
+                    if not lexical_fallback:
+                        raise
+                    logger.warning("Encoder %s unavailable, falling back to BM25 retrieval: %s", encoder_name, e)
+                    self.fallback_reason = f"{type(e).__name__}: {e}"
+                    retrieval_mode = "bm25"
+            if retrieval_mode != "bm25":
+                if self.index is None:
+                    # question/answer embeddings are computed once and memory-mapped;
+                    # rebuilt automatically when the JSON or the encoder changes
+                    self.index = QAEmbeddingIndex.load_or_build(
+                        reference, encoder_name, qa_json_path, index_dir
+                    )
+                self.encoder = fast or reference
+                if max_seq_length and fast is None:
+                    self.encoder.max_seq_length = max_seq_length
+                if query_cache_size:
+                    self.encoder = QueryEmbeddingCache(self.encoder, query_cache_size)
+
+        # BM25 postings are precomputed next to the embeddings (keyed by the JSON only)
+        self.lexical = BM25Index.load_or_build(qa_json_path, index_dir) if retrieval_mode != "dense" else None
+        # row layout shared by both indexes: membership checks and row -> pair lookups
+        self.catalog = self.index if self.index is not None else self.lexical
+
+        self.retrieval_mode = retrieval_mode
+        self.shortlist = shortlist
+        self.lexical_weight = lexical_weight
+        self.fusion = fusion
         self.alpha = hybrid_alpha
+        # "exact" scores every candidate; "ann" probes an IVF index (large knowledge bases)
+        self.search_mode = search_mode
+        self.ann_nprobe = ann_nprobe
+
+    @staticmethod
+    def _load_encoder(encoder_name: str, device: str):
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(encoder_name, device=device)
+
+    def retrieval_status(self) -> dict:
+        """Configured vs effective retrieval mode (they differ after an encoder fallback)."""
+        return {
+            "mode": self.retrieval_mode,
+            "configured_mode": self.configured_mode,
+            "fallback_reason": self.fallback_reason,
+        }
 
     # ---------- retrieval ----------
-    def retrieve(self, disease: str, user_q: str, top_k=5, thresh=0.75) -> dict:
-        if disease not in self.derm_data:
+    def retrieve(self, disease: str, user_q: str, top_k=5, thresh=0.75, classes=None, deadline=None,
+                 reformulate: bool = True) -> dict:
+        """
+        classes: diseases whose Q/A pairs are searched (e.g. the classifier's
+        top-k); defaults to just `disease`.
+        deadline: request budget; without room for both a reformulation and
+        an answer the raw question is searched instead.
+        """
+        if deadline is not None:
+            deadline.check("rag")
+        classes = [c for c in (classes or [disease]) if c in self.catalog]
+        if not classes:
             return
 
-        entry = self.derm_data[disease]
-        qas, desc = entry["qa_pairs"], entry["description"]
+        desc_class = disease if disease in self.derm_data else classes[0]
+        desc = self.derm_data[desc_class]["description"]
 
-        refined_q = self.helper.reformulate_question(user_q, disease)
+        refined_q = self._refine(user_q, disease, deadline) if reformulate else user_q
+        hits = self._search(refined_q, classes, top_k, thresh)
+        filt = [self._pair(row) for row, _ in hits]
 
-        q_texts = [qa["question"] for qa in qas]
-        a_texts = [qa["answer"] for qa in qas]
+        return {
+            "refined_question": refined_q,
+            "description": desc,
+            "matched_qa_pairs": filt,
+        }
 
-        q_emb = self.encoder.encode(q_texts, convert_to_tensor=True)
-        a_emb = self.encoder.encode(a_texts, convert_to_tensor=True)
-        user_emb = self.encoder.encode(refined_q, convert_to_tensor=True)
+    def _search(self, text: str, classes: list, top_k: int, thresh, exclude=None) -> list:
+        """Top-k (row, score) for a question among `classes`, per `retrieval_mode`."""
+        if self.retrieval_mode != "dense":
+            rows = self.catalog.rows_for(classes)
+            if exclude:
+                rows = np.setdiff1d(rows, exclude)
+            with span("rag.lexical"):
+                lexical = self.lexical.search(
+                    text, rows=rows, alpha=self.alpha,
+                    top_k=top_k if self.retrieval_mode == "bm25" else self.shortlist,
+                )
+            if self.retrieval_mode == "bm25":
+                return lexical
+            if lexical:
+                # dense scores for the shortlist only
+                cand = np.array([r for r, _ in lexical])
+                user_emb = self._encode(text)
+                with span("rag.search"):
+                    dense = self.index.combined(self.alpha)[cand] @ user_emb
+                    ranking = fuse_scores(dense, np.array([s for _, s in lexical], dtype=np.float32),
+                                          self.lexical_weight, self.fusion)
+                    keep = np.flatnonzero(dense >= thresh) if thresh is not None else np.arange(len(cand))
+                    order = top_k_order(ranking[keep], top_k)
+                return [(int(cand[keep[i]]), float(ranking[keep[i]])) for i in order]
+            # no question term occurs in the candidates: fall through to a full dense search
 
-        q_sim = util.pytorch_cos_sim(user_emb, q_emb)[0]
-        a_sim = util.pytorch_cos_sim(user_emb, a_emb)[0]
-        hybrid = self.alpha * q_sim + (1 - self.alpha) * a_sim
+        # only the question goes through the encoder; the knowledge-base
+        # side comes from the precomputed index
+        user_emb = self._encode(text)
+        with span("rag.search"):
+            if exclude:
+                return self.index.search_many(
+                    user_emb[None], classes=[classes], top_k=top_k, alpha=self.alpha,
+                    thresh=thresh, exclude=[exclude],
+                )[0]
+            return self.index.search(
+                user_emb,
+                classes=classes,
+                top_k=top_k,
+                alpha=self.alpha,
+                thresh=thresh,
+                mode=self.search_mode,
+                nprobe=self.ann_nprobe,
+            )
 
-        top_scores, top_idx = torch.topk(hybrid, k=len(q_texts))
-        filt = [
-            qas[i]
-            for i, sc in zip(top_idx, top_scores)
-            if sc.item() >= thresh
-        ][:top_k]
+    # ---------- per-chat sessions ----------
+    def open_session(self, disease: str, classes=None):
+        """
+        Snapshot of everything `retrieve` recomputes per call for a fixed
+        disease / class set: description plus the candidates' embeddings
+        (none without an encoder). Returns None when none of the classes is
+        in the index.
+        """
+        requested = list(classes or [disease])
+        classes = [c for c in requested if c in self.catalog]
+        if not classes:
+            return None
+        desc_class = disease if disease in self.derm_data else classes[0]
+        rows = self.catalog.rows_for(classes)
+        matrix = np.ascontiguousarray(self.index.combined(self.alpha)[rows]) if self.index is not None else None
+        # keyed by the requested classes so `covers` matches the same request again
+        return RetrievalSession(disease, requested, self.derm_data[desc_class]["description"], rows, matrix)
 
+    def retrieve_in_session(self, session: RetrievalSession, user_q: str, top_k=5, thresh=0.75,
+                            reformulate: bool = True, carry: float = 0.0, deadline=None) -> dict:
+        """
+        `retrieve` against a session's cached candidates (same output layout).
+        The candidates are already narrowed to the chat's diseases, so in
+        "hybrid" mode BM25 only contributes to the ranking, not a shortlist.
+        """
+        if deadline is not None:
+            deadline.check("rag")
+        refined_q = self._refine(user_q, session.disease, deadline) if reformulate else user_q
+        if session.matrix is None or self.retrieval_mode == "bm25":
+            with span("rag.lexical"):
+                hits = self.lexical.search(refined_q, rows=session.rows, top_k=top_k, alpha=self.alpha)
+        else:
+            fuse = None
+            if self.retrieval_mode == "hybrid":
+                with span("rag.lexical"):
+                    lexical = self.lexical.scores(refined_q, self.alpha)[session.rows]
+                fuse = lambda dense: fuse_scores(dense, lexical, self.lexical_weight, self.fusion)
+            user_emb = self._encode(refined_q)
+            with span("rag.search"):
+                hits = session.rank(user_emb, top_k=top_k, thresh=thresh, carry=carry, fuse=fuse)
         return {
             "refined_question": refined_q,
-            "description": desc,
-            "matched_qa_pairs": filt,
-        }
\ No newline at end of file
+            "description": session.description,
+            "matched_qa_pairs": [self._pair(row) for row, _ in hits],
+        }
+
+    def _refine(self, user_q: str, disease: str, deadline=None) -> str:
+        if deadline is not None and not self.helper.can_reformulate(deadline):
+            deadline.degrade("reformulation_skipped")
+            return user_q
+        return self.helper.reformulate_question(user_q, disease, deadline=deadline)
+
+    def _refine_or_raw(self, user_q: str, disease: str) -> str:
+        """Reformulation for batch runs: one failed LLM call keeps the raw question."""
+        try:
+            return self.helper.reformulate_question(user_q, disease)
+        except Exception as e:
+            print(f"Reformulation failed for {disease!r}, using the raw question: {e}")
+            return user_q
+
+    def _encode(self, text: str) -> np.ndarray:
+        with span("rag.encode"):
+            return self.encoder.encode(
+                text, convert_to_numpy=True, normalize_embeddings=True
+            ).astype(np.float32)
+
+    def retrieve_many(
+        self,
+        queries: list,
+        top_k=5,
+        thresh=0.75,
+        classes: list = None,
+        exclude_rows: list = None,
+        reformulate: bool = True,
+        max_workers: int = 8,
+    ) -> list:
+        """
+        Batched `retrieve` for offline evaluation.
+
+        queries:      [(disease, user_q), ...]
+        classes:      optional per-query list of diseases to search (default [disease])
+        exclude_rows: optional per-query index rows to leave out (leave-one-out)
+
+        Reformulation LLM calls run concurrently; all refined questions are
+        then encoded in one encoder pass and ranked with one matrix multiply.
+        Returns one `retrieve`-style dict per query (None for unknown diseases).
+        """
+        if reformulate:
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                refined = list(pool.map(lambda dq: self._refine_or_raw(dq[1], dq[0]), queries))
+        else:
+            refined = [q for _, q in queries]
+
+        search_classes = []
+        for i, (disease, _) in enumerate(queries):
+            wanted = classes[i] if classes is not None and classes[i] else [disease]
+            search_classes.append([c for c in wanted if c in self.catalog])
+
+        if self.retrieval_mode != "dense":
+            # BM25 shortlists differ per query; rank them one by one
+            hits = [
+                self._search(q, wanted, top_k, thresh, exclude=exclude_rows[i] if exclude_rows else None)
+                if wanted else []
+                for i, (q, wanted) in enumerate(zip(refined, search_classes))
+            ]
+        else:
+            user_embs = self.encoder.encode(
+                refined, convert_to_numpy=True, normalize_embeddings=True
+            ).astype(np.float32)
+            hits = self.index.search_many(
+                user_embs,
+                classes=search_classes,
+                top_k=top_k,
+                alpha=self.alpha,
+                thresh=thresh,
+                exclude=exclude_rows,
+            )
+
+        out = []
+        for (disease, _), refined_q, wanted, row_hits in zip(queries, refined, search_classes, hits):
+            if not wanted:
+                out.append(None)
+                continue
+            desc_class = disease if disease in self.derm_data else wanted[0]
+            out.append({
+                "refined_question": refined_q,
+                "description": self.derm_data[desc_class]["description"],
+                "matched_qa_pairs": [self._pair(row) for row, _ in row_hits],
+            })
+        return out
+
+    def _pair(self, row: int) -> dict:
+        disease, i = self.catalog.locate(row)
+        return self.derm_data[disease]["qa_pairs"][i]
@@ -0,0 +1,114 @@
+import threading, time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from src.embedding_index import top_k_order
+
+
+class RetrievalSession:
+    """
+    Retrieval state for one chat: the diseases it was opened for, their
+    description and a contiguous copy of the candidate rows' hybrid
+    embeddings.
+
+    A follow-up question only needs its own embedding; ranking is one small
+    matrix-vector product over the cached candidates. With `carry` > 0 the
+    previous turn's scores are blended in (exponentially decayed), so pairs
+    that matched the conversation so far stay ahead of unrelated ones.
+    """
+
+    def __init__(self, disease: str, classes: List[str], description: str, rows: np.ndarray, matrix: np.ndarray):
+        self.disease = disease
+        self.classes = list(classes)
+        self.description = description
+        self.rows = rows
+        self.matrix = matrix
+        self.turns = 0
+        self._prev_scores: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def covers(self, disease: str, classes: Optional[List[str]] = None) -> bool:
+        """Whether the session searches what a turn for `disease` / `classes` needs (None: any class set)."""
+        return disease == self.disease and (classes is None or list(classes) == self.classes)
+
+    def rank(self, query: np.ndarray, top_k: int = 5, thresh: Optional[float] = None, carry: float = 0.0,
+             fuse: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, score) among the session's candidates for a unit-norm query.
+        `fuse` maps the dense scores to the ranking scores (e.g. blended with
+        BM25); `thresh` still applies to the dense scores.
+        """
+        scores = self.matrix @ query
+        with self._lock:
+            if carry and self._prev_scores is not None:
+                scores = (1.0 - carry) * scores + carry * self._prev_scores
+            self._prev_scores = scores
+            self.turns += 1
+
+            ranking = fuse(scores) if fuse is not None else scores
+            cand = np.arange(len(scores))
+            if thresh is not None:
+                cand = cand[scores >= thresh]
+            order = top_k_order(ranking[cand], top_k)
+            return [(int(self.rows[cand[i]]), float(ranking[cand[i]])) for i in order]
+
+
+class SessionCache:
+    """Bounded LRU + TTL map of chat id -> RetrievalSession."""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple[float, RetrievalSession]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key: Hashable) -> Optional[RetrievalSession]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            touched_at, session = entry
+            if self.ttl is not None and time.monotonic() - touched_at >= self.ttl:
+                del self._entries[key]
+                self._counters["expired"] += 1
+                self._counters["misses"] += 1
+                return None
+            self._entries[key] = (time.monotonic(), session)
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return session
+
+    def peek(self, key: Hashable) -> Optional[RetrievalSession]:
+        """Like `get`, without counting a lookup or refreshing the entry's TTL."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[0] >= self.ttl):
+                return None
+            return entry[1]
+
+    def put(self, key: Hashable, session: RetrievalSession):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), session)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                **self._counters,
+                "hit_rate": (self._counters["hits"] / lookups) if lookups else 0.0,
+            }
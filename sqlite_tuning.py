@@ -0,0 +1,33 @@
+"""
+Connection settings for the app's SQLite database in production.
+
+WAL lets readers run alongside the single writer instead of blocking on it,
+synchronous=NORMAL drops the fsync on every commit (still crash-safe in WAL
+mode, only the last transactions can be lost on power failure), and
+busy_timeout makes a writer wait for the lock instead of failing at once
+with "database is locked".
+"""
+import sqlite3
+
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", "5000"),
+    ("cache_size", "-20000"),       # KiB, i.e. ~20 MB page cache per connection
+    ("temp_store", "MEMORY"),
+)
+
+
+def apply_pragmas(conn: sqlite3.Connection, pragmas=SQLITE_PRAGMAS):
+    cur = conn.cursor()
+    try:
+        for name, value in pragmas:
+            cur.execute(f"PRAGMA {name}={value}")
+    finally:
+        cur.close()
+
+
+def on_connect(dbapi_conn, _record):
+    """SQLAlchemy "connect" event listener; ignores non-SQLite connections."""
+    if isinstance(dbapi_conn, sqlite3.Connection):
+        apply_pragmas(dbapi_conn)
@@ -0,0 +1,335 @@
+"""
+Lightweight stand-ins for the real models, for load tests and benchmarks.
+
+    TinyClassifier     random-weight CNN behind the ConvNeXtTinyClassifier API
+                       (same preprocessing, batching and spans), with an
+                       optional fixed per-batch forward cost
+    HashingEncoder     feature-hashing sentence encoder with the
+                       SentenceTransformer `encode` signature
+    fake Ollama        local HTTP server speaking /api/chat and /api/generate
+                       (blocking and NDJSON streaming) at a configurable
+                       prefill / generation token rate and parallelism
+
+The app uses the first two with MODEL_STANDINS=1 (see `standin_loaders`)
+and talks to the fake Ollama through OLLAMA_HOST, so the whole request
+path -- uploads, classification cache, micro-batching, retrieval sessions,
+the Ollama pool, SQLite -- runs without GPUs or model downloads.
+
+    python -m src.standins ollama --port 11435 --tokens-per-sec 40 --parallel 4
+    python -m src.standins qa-json --out /tmp/standin_qa.json --classes 10 --pairs 40
+"""
+import argparse, hashlib, json, os, random, re, threading, time
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.classifier import ConvNeXtTinyClassifier, INPUT_SIZE, default_transform
+from src.rag import RetrievalAugmentedGeneration
+
+WORDS = (
+    "skin rash lesion itch redness scaling patch plaque bump blister dry oily swelling pain "
+    "treatment cream ointment moisturizer dermatologist infection allergy trigger sun exposure "
+    "contagious chronic flare symptoms diagnosis biopsy steroid antifungal antibiotic hygiene"
+).split()
+
+
+class TinyClassifier(ConvNeXtTinyClassifier):
+    """
+    ConvNeXtTinyClassifier with a random-weight 2-layer CNN instead of the
+    fine-tuned checkpoint. Preprocessing, `predict_batch` / `predict_tensor`
+    and the result layout are inherited unchanged; `forward_ms` adds a
+    fixed cost per forward pass (per batch, like a real model on CPU).
+    """
+
+    def __init__(self, class_names: List[str], forward_ms: float = 0.0, seed: int = 0, device="cpu"):
+        self.class_names = class_names
+        self.backend = "eager"
+        self.device = torch.device(device)
+        self.channels_last = False
+        self.session = None
+        self.forward_ms = forward_ms
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            self.model = nn.Sequential(
+                nn.Conv2d(3, 16, kernel_size=8, stride=8),
+                nn.ReLU(),
+                nn.AdaptiveAvgPool2d(1),
+                nn.Flatten(),
+                nn.Linear(16, len(class_names)),
+            ).eval().to(self.device)
+        self.transform = default_transform()
+        self.draft_size = INPUT_SIZE
+        h = hashlib.sha256(f"standin\0{seed}\0".encode() + "\0".join(class_names).encode("utf-8"))
+        self.model_version = f"standin-{h.hexdigest()[:16]}"
+
+    def _forward(self, batch_tensor: torch.Tensor) -> torch.Tensor:
+        logits = super()._forward(batch_tensor)
+        if self.forward_ms:
+            time.sleep(self.forward_ms / 1000.0)
+        return logits
+
+
+class HashingEncoder:
+    """
+    Bag of words + word bigrams hashed into `dim` signed buckets. Texts that
+    share words get similar vectors, so retrieval ranks sensibly; `encode_ms`
+    adds a fixed cost per call.
+    """
+
+    def __init__(self, dim: int = 768, encode_ms: float = 0.0):
+        self.dim = dim
+        self.encode_ms = encode_ms
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _vector(self, text: str) -> np.ndarray:
+        vec = np.zeros(self.dim, dtype=np.float32)
+        words = re.findall(r"\w+", text.lower())
+        for feat in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            h = int.from_bytes(hashlib.blake2b(feat.encode("utf-8"), digest_size=8).digest(), "little")
+            vec[h % self.dim] += 1.0 if (h >> 63) else -1.0
+        return vec
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False, **_):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if self.encode_ms:
+            time.sleep(self.encode_ms / 1000.0)
+        emb = np.stack([self._vector(t) for t in texts]) if texts else np.zeros((0, self.dim), np.float32)
+        if normalize_embeddings:
+            norms = np.linalg.norm(emb, axis=1, keepdims=True)
+            emb = emb / np.maximum(norms, 1e-12)
+        return emb[0] if single else emb
+
+
+def synthetic_qa(n_classes: int = 10, pairs_per_class: int = 40, seed: int = 0) -> dict:
+    """dermatology_qa.json-shaped knowledge base of random sentences."""
+    rng = random.Random(seed)
+
+    def sentence(n):
+        return " ".join(rng.choice(WORDS) for _ in range(n))
+
+    return {
+        f"Condition_{c:02d}": {
+            "description": sentence(60),
+            "qa_pairs": [
+                {"question": sentence(10) + "?", "answer": sentence(50) + "."}
+                for _ in range(pairs_per_class)
+            ],
+        }
+        for c in range(n_classes)
+    }
+
+
+def standin_loaders(
+    qa_json_path: str,
+    index_dir: str,
+    forward_ms: float = 0.0,
+    encode_ms: float = 0.0,
+    dim: int = 768,
+    seed: int = 0,
+) -> dict:
+    """
+    DermatologyAssistant `loaders` replacing the classifier and the RAG
+    encoder; the classes are the knowledge base's diseases. The LLM stays
+    real and is pointed at a fake Ollama through its host.
+    """
+    def classifier(assistant):
+        with Path(qa_json_path).open() as f:
+            class_names = list(json.load(f))
+        return TinyClassifier(class_names, forward_ms=forward_ms, seed=seed)
+
+    def rag(assistant):
+        return RetrievalAugmentedGeneration(
+            helper=assistant.llm,
+            qa_json_path=qa_json_path,
+            encoder_name=f"standin-hashing-{dim}",
+            device="cpu",
+            index_dir=index_dir,
+            encoder=HashingEncoder(dim, encode_ms),
+            **assistant.rag_opts
+        )
+
+    return {"classifier": classifier, "rag": rag}
+
+
+# ---------- fake Ollama ----------
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def make_ollama_handler(
+    tokens_per_sec: float = 40.0,
+    prefill_tokens_per_sec: float = 2000.0,
+    reply_tokens: int = 120,
+    parallel: int = 4,
+):
+    """
+    Ollama-compatible handler. At most `parallel` generations run at once
+    (OLLAMA_NUM_PARALLEL); each spends prompt_tokens / prefill_tokens_per_sec
+    before its first token and then emits `reply_tokens` (capped by
+    options.num_predict) at `tokens_per_sec`. Replies are deterministic per
+    prompt, and the done message reports Ollama's token counts and durations.
+
+    The last `parallel` prompts stand in for Ollama's per-slot KV caches: a
+    prefix shared with one of them is not evaluated again and, like in
+    Ollama, not counted in prompt_eval_count.
+    """
+    slots = threading.BoundedSemaphore(parallel)
+    kv_lock = threading.Lock()
+    kv_prompts = deque(maxlen=parallel)
+
+    class OllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path == "/api/tags":
+                return self._send(200, {"models": []})
+            if self.path == "/api/version":
+                return self._send(200, {"version": "0.0.0-standin"})
+            self._send(200, "Ollama is running")
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/api/chat":
+                prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+            elif self.path == "/api/generate":
+                prompt = body.get("prompt", "")
+            else:
+                return self._send(404, {"error": f"unknown endpoint {self.path}"})
+
+            model = body.get("model", "standin")
+            if not prompt:
+                # empty prompt = load the model (warm-up), nothing to generate
+                return self._send(200, {**self._base(model), "response": "", "done": True, "done_reason": "load"})
+
+            num_predict = (body.get("options") or {}).get("num_predict")
+            n_tokens = min(reply_tokens, num_predict) if num_predict and num_predict > 0 else reply_tokens
+            rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+            tokens = [("" if i == 0 else " ") + rng.choice(WORDS) for i in range(n_tokens)]
+            with kv_lock:
+                reused = max((len(os.path.commonprefix([prompt, p])) for p in kv_prompts), default=0)
+                kv_prompts.append(prompt)
+            prompt_tokens = _estimate_tokens(prompt[reused:])
+            stream = body.get("stream", True)
+            chat = self.path == "/api/chat"
+
+            with slots:
+                started = time.perf_counter()
+                time.sleep(prompt_tokens / prefill_tokens_per_sec)
+                prefilled = time.perf_counter()
+                if stream:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for tok in tokens:
+                        time.sleep(1.0 / tokens_per_sec)
+                        self._chunk({**self._base(model), **self._content(chat, tok), "done": False})
+                else:
+                    time.sleep(len(tokens) / tokens_per_sec)
+                finished = time.perf_counter()
+
+            done = {
+                **self._base(model),
+                **self._content(chat, "" if stream else "".join(tokens)),
+                "done": True,
+                "done_reason": "length" if n_tokens < reply_tokens else "stop",
+                "total_duration": int((finished - started) * 1e9),
+                "load_duration": 0,
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int((prefilled - started) * 1e9),
+                "eval_count": len(tokens),
+                "eval_duration": int((finished - prefilled) * 1e9),
+            }
+            if stream:
+                self._chunk(done)
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                self._send(200, done)
+
+        @staticmethod
+        def _base(model):
+            return {"model": model, "created_at": datetime.now(timezone.utc).isoformat()}
+
+        @staticmethod
+        def _content(chat, text):
+            return {"message": {"role": "assistant", "content": text}} if chat else {"response": text}
+
+        def _chunk(self, payload):
+            data = json.dumps(payload).encode() + b"\n"
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _send(self, status, payload):
+            data = (json.dumps(payload) if not isinstance(payload, str) else payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json" if not isinstance(payload, str) else "text/plain")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return OllamaHandler
+
+
+def serve_fake_ollama(host: str = "127.0.0.1", port: int = 11435, **kw) -> ThreadingHTTPServer:
+    """Start the fake Ollama in a background thread; returns it (call .shutdown() to stop)."""
+    server = ThreadingHTTPServer((host, port), make_ollama_handler(**kw))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Model stand-ins for load tests.")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    o = sub.add_parser("ollama", help="fake Ollama server")
+    o.add_argument("--host", default="127.0.0.1")
+    o.add_argument("--port", type=int, default=11435)
+    o.add_argument("--tokens-per-sec", type=float, default=40.0, help="generation speed per request")
+    o.add_argument("--prefill-tokens-per-sec", type=float, default=2000.0)
+    o.add_argument("--reply-tokens", type=int, default=120)
+    o.add_argument("--parallel", type=int, default=4, help="concurrent generations (OLLAMA_NUM_PARALLEL)")
+
+    q = sub.add_parser("qa-json", help="write a synthetic dermatology_qa.json")
+    q.add_argument("--out", required=True)
+    q.add_argument("--classes", type=int, default=10)
+    q.add_argument("--pairs", type=int, default=40, help="Q/A pairs per class")
+    q.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args(argv)
+    if args.cmd == "qa-json":
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(synthetic_qa(args.classes, args.pairs, args.seed), f, indent=2)
+        print(f"Wrote {args.out}")
+        return
+
+    server = serve_fake_ollama(
+        args.host, args.port,
+        tokens_per_sec=args.tokens_per_sec,
+        prefill_tokens_per_sec=args.prefill_tokens_per_sec,
+        reply_tokens=args.reply_tokens,
+        parallel=args.parallel,
+    )
+    print(f"Fake Ollama on http://{args.host}:{args.port} ({args.tokens_per_sec:g} tok/s, {args.parallel} parallel)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()